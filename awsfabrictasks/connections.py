@@ -0,0 +1,100 @@
+"""
+Process-wide reuse of AWS connections.
+"""
+from threading import Lock, local
+from time import time
+
+from awsfabrictasks.conf import awsfab_settings
+
+
+class ConnectionRegistry(object):
+    """
+    Thread-safe registry of boto connections keyed by service, region and
+    credentials (``awsfab_settings.AUTH``), with separate connections for
+    each thread.
+
+    boto connections keep their HTTP(S) connections alive in a pool, so
+    reusing the same connection object for all requests to a region avoids
+    a new TCP and TLS handshake for every request (E.g.: every poll in
+    :func:`awsfabrictasks.ec2.api.wait_for_state`). boto connections are not
+    thread-safe, so a connection is only reused by the thread that created
+    it (E.g.: each worker thread of :func:`awsfabrictasks.utils.parallel_map`
+    gets its own connections). The connections of a thread are released
+    when the thread exits.
+
+    A connection that has been idle for more than
+    ``awsfab_settings.CONNECTION_MAX_IDLE`` seconds is not reused (see
+    :meth:`.is_fresh`), since the server has probably closed its idle HTTP
+    connections. This is not a health check: Use :meth:`.discard` to replace
+    a connection that you know is broken.
+
+    Use the :obj:`connection_registry` instance instead of creating your own.
+    """
+    def __init__(self):
+        self._local = local()
+        self._lock = Lock()
+        self._generation = 0
+
+    def _get_key(self, service, region):
+        credentials = tuple(sorted(awsfab_settings.AUTH.iteritems()))
+        return service, region, credentials
+
+    def _get_connections(self):
+        """
+        Get the ``{key: (connection, last_used)}`` dict of the current thread.
+        """
+        with self._lock:
+            generation = self._generation
+        if getattr(self._local, 'generation', None) != generation:
+            self._local.connections = {}
+            self._local.generation = generation
+        return self._local.connections
+
+    def is_fresh(self, connection, last_used):
+        """
+        Return ``True`` if ``connection``, last used at the ``last_used``
+        timestamp, has not been idle for more than
+        ``awsfab_settings.CONNECTION_MAX_IDLE`` seconds.
+        """
+        return (connection is not None and
+                time() - last_used <= awsfab_settings.CONNECTION_MAX_IDLE)
+
+    def get(self, service, region, connect):
+        """
+        Get the connection for ``service`` in ``region``, creating it with
+        ``connect(region_name=region, **awsfab_settings.AUTH)`` if the current
+        thread has no fresh connection for them (see :meth:`.is_fresh`).
+
+        :param service: Name of the service (E.g.: ``"ec2"``).
+        :param region: Name of the region.
+        :param connect:
+            The connect function of the service (E.g.:
+            ``boto.ec2.connect_to_region``).
+        :return: The connection, or ``None`` if ``connect`` returns ``None``.
+        """
+        key = self._get_key(service, region)
+        connections = self._get_connections()
+        connection, last_used = connections.get(key, (None, None))
+        if not self.is_fresh(connection, last_used):
+            connection = connect(region_name=region, **awsfab_settings.AUTH)
+        if connection is not None:
+            connections[key] = (connection, time())
+        return connection
+
+    def discard(self, service, region):
+        """
+        Remove the connection for ``service`` in ``region`` used by the current
+        thread, so the next :meth:`.get` in this thread creates a new
+        connection.
+        """
+        self._get_connections().pop(self._get_key(service, region), None)
+
+    def clear(self):
+        """
+        Remove all connections (in all threads).
+        """
+        with self._lock:
+            self._generation += 1
+
+#: The :class:`ConnectionRegistry` used by awsfabrictasks.
+connection_registry = ConnectionRegistry()
@@ -9,6 +9,13 @@ AUTH = {}
 #: The default AWS region to use with the commands where REGION is supported.
 DEFAULT_REGION = 'eu-west-1'
 
+#: EC2 and RDS connections are reused for all requests to a region (one
+#: connection per thread). A connection that has not been used for this many
+#: seconds is replaced by a new connection.
+#:
+#: .. seealso:: :class:`awsfabrictasks.connections.ConnectionRegistry`
+CONNECTION_MAX_IDLE = 300
+
 #: Default ssh user if the ``awsfab-ssh-user`` tag is not set
 EC2_INSTANCE_DEFAULT_SSHUSER = 'root'
 
@@ -20,9 +27,56 @@ KEYPAIR_PATH = ['.', '~/.ssh/']
 #: Extra SSH arguments. Used with ``ssh`` and ``rsync``.
 EXTRA_SSH_ARGS = '-o StrictHostKeyChecking=no'
 
+#: Reuse one SSH connection for all ``ssh`` and ``rsync`` commands that
+#: awsfab runs against an instance (using OpenSSH ControlMaster). This makes
+#: repeated commands against the same instance start a lot faster.
+#: Fabric's own connections (``run``, ``sudo``, ``put``, ...) are not
+#: affected.
+#:
+#: This is disabled by default, so the ``ssh`` and ``rsync`` based tasks
+#: (``ec2_login``, the rsync tasks, ``ec2_distribute_hostsfile``, ...) only
+#: get the speedup if you set it to ``True`` in your ``awsfab_settings.py``.
+#: The master connections are not closed when awsfab exits. They exit by
+#: themselves when they have been idle for :obj:`SSH_CONTROLPERSIST`, or when
+#: you run the ``ec2_close_ssh_masters`` task.
+SSH_CONTROLMASTER = False
+
+#: Directory for the ControlMaster sockets used when
+#: :obj:`SSH_CONTROLMASTER` is ``True``. Keep this path short, since unix
+#: socket paths are limited to about 100 characters.
+SSH_CONTROL_DIR = '~/.awsfab/ssh/'
+
+#: How long an idle ControlMaster connection is kept open (the ssh
+#: ``ControlPersist`` option). The default keeps the connections open for the
+#: commands of a single awsfab run, and lets them exit shortly after. Use a
+#: longer time (E.g.: ``'10m'``) to reuse connections across awsfab runs, and
+#: the ``ec2_close_ssh_masters`` task to close them.
+SSH_CONTROLPERSIST = '60s'
+
 #: Configuration for ec2_launch_instance (see the docs)
 EC2_LAUNCH_CONFIGS = {}
 
+#: Number of rsync commands run at the same time by the tasks that rsync to
+#: or from many EC2 instances (E.g.:
+#: :func:`awsfabrictasks.ec2.tasks.ec2_rsync_upload_dir_many`).
+RSYNC_CONCURRENCY = 8
+
+#: Directory where information about all EC2 instances in a region is cached
+#: between awsfab runs, which makes ``--ec2names``, ``--ec2ids`` and
+#: ``--ec2tags`` a lot faster on accounts with many instances. ``None``
+#: disables the on-disk cache (instances are still cached for the duration
+#: of an awsfab run). The directory is created with mode ``0700``, and
+#: should not be writable by other users. Example::
+#:
+#:      EC2_INVENTORY_CACHE_DIR = '~/.awsfab/cache/'
+#:
+#: .. seealso:: :class:`awsfabrictasks.ec2.api.Ec2Inventory`
+EC2_INVENTORY_CACHE_DIR = None
+
+#: Number of seconds the on-disk EC2 instance cache is used before it is
+#: refreshed. Use the ``ec2_clear_inventory_cache`` task to clear the cache.
+EC2_INVENTORY_CACHE_TTL = 300
+
 
 #: S3 bucket suffix. This is used for all tasks taking bucketname as parameter.
 #: The actual bucketname used become::
@@ -42,3 +96,37 @@ EC2_LAUNCH_CONFIGS = {}
 #:      :meth:`awsfabrictasks.s3.api.S3ConnectionWrapper.get_bucket_using_pattern`,
 #:      :func:`awsfabrictasks.s3.api.settingsformat_bucketname`
 S3_BUCKET_PATTERN = '{bucketname}'
+
+#: Size of each part (in bytes) when uploading streams of unknown length using
+#: S3 multipart uploads. S3 requires every part except the last to be at
+#: least 5MB.
+#:
+#: .. seealso:: :meth:`awsfabrictasks.s3.api.S3File.set_contents_from_stream`
+S3_MULTIPART_PARTSIZE = 8 * 1024 * 1024
+
+#: Number of parts uploaded concurrently in multipart uploads. The memory used
+#: by a multipart upload is roughly
+#: ``S3_MULTIPART_PARTSIZE * (S3_MULTIPART_CONCURRENCY + 2)``.
+S3_MULTIPART_CONCURRENCY = 4
+
+#: Max bandwidth (bytes per second) used by all S3 transfers in an awsfab
+#: process. ``None`` means no limit. The S3 tasks that transfer data can
+#: override this with their ``max_bandwidth`` parameter.
+#:
+#: .. seealso:: :class:`awsfabrictasks.s3.api.TransferGovernor`
+S3_MAX_BANDWIDTH = None
+
+#: Max number of S3 requests per second made by an awsfab process. ``None``
+#: means no limit.
+S3_MAX_REQUESTS_PER_SEC = None
+
+#: Files larger than this (in bytes) are copied using multipart copy, with
+#: parts of this size, when copying files within S3. S3 does not support
+#: single-request copies of files larger than 5GB.
+#:
+#: .. seealso:: :meth:`awsfabrictasks.s3.api.S3File.copy_to`
+S3_MULTIPART_COPY_PARTSIZE = 512 * 1024 * 1024
+
+#: Number of files transferred concurrently by tasks that transfer many files
+#: (E.g.: :func:`awsfabrictasks.s3.tasks.s3_sync_prefix`).
+S3_CONCURRENCY = 8
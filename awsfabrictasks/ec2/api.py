@@ -1,11 +1,31 @@
-from os.path import exists, join, expanduser, abspath
+from os import makedirs, remove, listdir, walk, lstat, stat, rename, fdopen, getuid
+from os.path import exists, join, expanduser, abspath, getmtime
+from os.path import relpath, dirname, basename
 from warnings import warn
+from pipes import quote
 from pprint import pformat
+from threading import Lock
+from tempfile import mkstemp
+from hashlib import md5
+import socket
+from time import time, sleep
+from random import uniform
+import cPickle as pickle
+import json
+from StringIO import StringIO
 from boto.ec2 import connect_to_region
-from fabric.api import local, env, abort
+from boto.ec2 import regions as get_regions
+from boto.ec2.ec2object import EC2Object
+from boto.regioninfo import RegionInfo
+from boto.connection import AWSAuthConnection
+from fabric.api import local, env, abort, run, sudo, put, hide
 
 from awsfabrictasks.conf import awsfab_settings
+from awsfabrictasks.connections import connection_registry
 from awsfabrictasks.utils import rsyncformat_path
+from awsfabrictasks.utils import force_noslashend
+from awsfabrictasks.utils import parallel_map
+from awsfabrictasks.s3.api import get_s3_agent_source
 
 def zipit(ss):
     """
@@ -21,6 +41,78 @@ def zipit(ss):
     f.close()
     return out.getvalue()
 
+def get_ssh_control_path(ssh_uri):
+    """
+    Get the path of the SSH ControlMaster socket for ``ssh_uri``. The socket
+    is named by a hash of ``ssh_uri`` within
+    ``awsfab_settings.SSH_CONTROL_DIR`` (created if it does not exist), which
+    keeps the path short enough for a unix socket.
+    """
+    control_dir = expanduser(awsfab_settings.SSH_CONTROL_DIR)
+    if not exists(control_dir):
+        makedirs(control_dir, 0700)
+    return join(control_dir, md5(ssh_uri).hexdigest()[:20])
+
+def ec2_ssh_args(instancewrapper, controlmaster=True):
+    """
+    Get the arguments for ``ssh`` used to connect to the given
+    :class:`Ec2InstanceWrapper`: The key from
+    :meth:`Ec2InstanceWrapper.get_ssh_key_filename`,
+    ``awsfab_settings.EXTRA_SSH_ARGS``, and the ControlMaster options if
+    ``awsfab_settings.SSH_CONTROLMASTER`` is enabled.
+
+    :param controlmaster:
+        Set this to ``False`` to never use ControlMaster options, e.g.: when
+        the connection has to forward an ssh-agent (a ControlMaster
+        connection forwards the agent of the ssh process that created it).
+    """
+    key_filename = instancewrapper.get_ssh_key_filename()
+    extra_ssh_args = awsfab_settings.EXTRA_SSH_ARGS
+    ssh_args = '-i {key_filename} {extra_ssh_args}'.format(**vars())
+    if controlmaster and awsfab_settings.SSH_CONTROLMASTER:
+        control_path = get_ssh_control_path(instancewrapper.get_ssh_uri())
+        control_persist = awsfab_settings.SSH_CONTROLPERSIST
+        ssh_args += (' -o ControlMaster=auto -o ControlPath={control_path} '
+                     '-o ControlPersist={control_persist}').format(**vars())
+    return ssh_args
+
+def ec2_ssh_command(instancewrapper, command=None):
+    """
+    Get the ``ssh`` command for logging into the given
+    :class:`Ec2InstanceWrapper`, or for running ``command`` on it (see
+    :func:`ec2_ssh_args`).
+
+    :param command:
+        A command to run on the instance. It is added to the ssh command
+        as-is, so quote it as required by the local shell.
+    """
+    ssh_cmd = 'ssh {ssh_args} {ssh_uri}'.format(ssh_args=ec2_ssh_args(instancewrapper),
+                                               ssh_uri=instancewrapper.get_ssh_uri())
+    if command:
+        ssh_cmd += ' ' + command
+    return ssh_cmd
+
+def close_ssh_masters():
+    """
+    Ask all the SSH ControlMaster processes with a socket in
+    ``awsfab_settings.SSH_CONTROL_DIR`` to exit, and remove sockets left
+    behind by masters that are not running anymore.
+
+    :return: The number of sockets closed or removed.
+    """
+    control_dir = expanduser(awsfab_settings.SSH_CONTROL_DIR)
+    if not exists(control_dir):
+        return 0
+    count = 0
+    for filename in listdir(control_dir):
+        control_path = join(control_dir, filename)
+        # The mux client does not use the hostname, but ssh requires one.
+        local('ssh -q -O exit -o ControlPath={0} awsfab 2>/dev/null || true'.format(control_path))
+        if exists(control_path):
+            remove(control_path)
+        count += 1
+    return count
+
 def ec2_rsync_upload_command(instancewrapper, local_dir, remote_dir,
                              rsync_args='-av', sync_content=False):
     """
@@ -30,10 +122,9 @@ def ec2_rsync_upload_command(instancewrapper, local_dir, remote_dir,
     object.
     """
     ssh_uri = instancewrapper.get_ssh_uri()
-    key_filename = instancewrapper.get_ssh_key_filename()
-    extra_ssh_args = awsfab_settings.EXTRA_SSH_ARGS
+    ssh_args = ec2_ssh_args(instancewrapper)
     local_dir = rsyncformat_path(local_dir, sync_content)
-    rsync_cmd = ('rsync {rsync_args} -e "ssh -i {key_filename} {extra_ssh_args}" '
+    rsync_cmd = ('rsync {rsync_args} -e "ssh {ssh_args}" '
                  '{local_dir} {ssh_uri}:{remote_dir}').format(**vars())
     return rsync_cmd
 
@@ -52,6 +143,120 @@ def ec2_rsync_upload(local_dir, remote_dir, rsync_args='-av', sync_content=False
                                          rsync_args, sync_content)
     local(rsync_cmd)
 
+def _scan_rsync_weights(local_dir, file_cost):
+    weights = {}
+    children = {}
+    for root, dirs, files in walk(local_dir, topdown=False):
+        relroot = relpath(root, local_dir)
+        if relroot == '.':
+            relroot = ''
+        weight = file_cost
+        children[relroot] = []
+        for filename in files:
+            path = join(relroot, filename)
+            weights[path] = lstat(join(root, filename)).st_size + file_cost
+            weight += weights[path]
+            children[relroot].append(path)
+        for subdirname in dirs:
+            path = join(relroot, subdirname)
+            weights.setdefault(path, file_cost) # Symlinks to directories are not walked
+            weight += weights[path]
+            children[relroot].append(path)
+        weights[relroot] = weight
+    return weights, children
+
+def get_rsync_shard_units(local_dir, shards, file_cost=64*1024, max_units_per_shard=50):
+    """
+    Scan ``local_dir``, and split it into units (files and directories) that
+    can be distributed between ``shards`` rsync processes. We start with the
+    top-level files and directories, and replace the heaviest directory with
+    its children until no directory is heavier than ``1/shards`` of the
+    total. A directory is never split if that would give more than
+    ``shards * max_units_per_shard`` units, so a directory with a huge number
+    of files is kept as a single unit.
+
+    :param file_cost:
+        The weight of each file and directory in addition to its size in
+        bytes. This models the per-file overhead of rsync.
+    :return:
+        Sorted list of ``(path, weight)`` tuples, where ``path`` is relative
+        to ``local_dir``.
+    """
+    weights, children = _scan_rsync_weights(local_dir, file_cost)
+    units = list(children.get('', []))
+    target = weights.get('', 0) / float(shards)
+    max_units = shards * max_units_per_shard
+    while True:
+        splittable = [unit for unit in units
+                      if children.get(unit) and weights[unit] > target
+                      and len(units) - 1 + len(children[unit]) <= max_units]
+        if not splittable:
+            break
+        heaviest = max(splittable, key=weights.get)
+        units.remove(heaviest)
+        units.extend(children[heaviest])
+    return sorted((unit, weights[unit]) for unit in units)
+
+def balance_shards(units, shards):
+    """
+    Distribute weighted units between at most ``shards`` shards, with the
+    total weight of the shards as equal as possible (each unit is assigned
+    to the lightest shard, heaviest unit first).
+
+    :param units: List of ``(unit, weight)`` tuples.
+    :return: List of non-empty lists of units. The units in each shard are sorted.
+    """
+    buckets = [(0, index, []) for index in xrange(shards)]
+    for unit, weight in sorted(units, key=lambda item: (-item[1], item[0])):
+        buckets.sort()
+        total, index, bucketunits = buckets[0]
+        bucketunits.append(unit)
+        buckets[0] = (total + weight, index, bucketunits)
+    return [sorted(bucketunits) for total, index, bucketunits in sorted(buckets, key=lambda bucket: bucket[1])
+            if bucketunits]
+
+def ec2_rsync_upload_sharded_commands(instancewrapper, local_dir, remote_dir,
+                                      filelist_dir, shards=4, rsync_args='-av'):
+    """
+    Get rsync commands that together upload ``local_dir`` into
+    ``remote_dir`` (just like :func:`ec2_rsync_upload_command` without
+    ``sync_content``), but with the files split between up to ``shards``
+    rsync commands that can run in parallel (see
+    :func:`get_rsync_shard_units` and :func:`balance_shards`).
+
+    The units of each shard are written, NUL-separated, to a file in
+    ``filelist_dir``, and the command reads them with ``--files-from``
+    (relative to the parent directory of ``local_dir``, with ``--relative``
+    and ``--recursive``), so the command line does not grow with the number
+    of units. Each command uses ``--stats`` (see
+    :func:`awsfabrictasks.utils.parse_rsync_stats`). Do not use
+    ``--delete`` in ``rsync_args``, since each command only sees its own
+    units.
+
+    :param filelist_dir:
+        An existing directory for the file lists. It must exist until the
+        commands are done, and the caller is responsible for removing it.
+    :return: List of rsync commands.
+    """
+    local_dir = force_noslashend(abspath(local_dir))
+    units = get_rsync_shard_units(local_dir, shards)
+    if not units:
+        return [ec2_rsync_upload_command(instancewrapper, local_dir, remote_dir, rsync_args)]
+    ssh_uri = instancewrapper.get_ssh_uri()
+    ssh_args = ec2_ssh_args(instancewrapper)
+    parent_dir, name = dirname(local_dir), basename(local_dir)
+    source = quote(join(parent_dir, '.') + '/')
+    commands = []
+    for index, shard in enumerate(balance_shards(units, shards)):
+        filelist = join(filelist_dir, 'shard-{0}.list'.format(index + 1))
+        with open(filelist, 'wb') as fp:
+            for unit in shard:
+                fp.write(join(name, unit) + '\0')
+        filelist = quote(filelist)
+        commands.append(('rsync {rsync_args} --recursive --relative --from0 --files-from={filelist} '
+                         '--stats -e "ssh {ssh_args}" {source} {ssh_uri}:{remote_dir}').format(**vars()))
+    return commands
+
 def ec2_rsync(*args, **kwargs):
     """
     .. deprecated:: 1.0.13
@@ -69,10 +274,9 @@ def ec2_rsync_download_command(instancewrapper, remote_dir, local_dir,
     object.
     """
     ssh_uri = instancewrapper.get_ssh_uri()
-    key_filename = instancewrapper.get_ssh_key_filename()
-    extra_ssh_args = awsfab_settings.EXTRA_SSH_ARGS
+    ssh_args = ec2_ssh_args(instancewrapper)
     remote_dir = rsyncformat_path(remote_dir, sync_content)
-    rsync_cmd = ('rsync {rsync_args} -e "ssh -i {key_filename} {extra_ssh_args}" '
+    rsync_cmd = ('rsync {rsync_args} -e "ssh {ssh_args}" '
                  '{ssh_uri}:{remote_dir} {local_dir}').format(**vars())
     return rsync_cmd
 
@@ -93,6 +297,150 @@ def ec2_rsync_download(remote_dir, local_dir, rsync_args='-av', sync_content=Fal
     local(rsync_cmd)
 
 
+def get_transfer_host(source, destination):
+    """
+    Get the host that the ``source`` :class:`Ec2InstanceWrapper` should use
+    to connect to the ``destination`` :class:`Ec2InstanceWrapper`: The
+    private IP address of ``destination`` if both instances are in the same
+    VPC, and the public DNS name of ``destination`` if they are not.
+
+    :raise ValueError:
+        If the instances are not in the same VPC, and ``destination`` has no
+        public DNS name.
+    """
+    vpc_id = destination['vpc_id']
+    private_ip_address = destination['private_ip_address']
+    if vpc_id and vpc_id == source['vpc_id'] and private_ip_address:
+        return private_ip_address
+    if not destination['public_dns_name']:
+        raise ValueError('{0} is not in the same VPC as {1}, and has no public DNS name.'.format(
+            destination.prettyname(), source.prettyname()))
+    return destination['public_dns_name']
+
+def ec2_transfer_command(source, destination, source_dir, destination_dir,
+                         method='rsync', rsync_args='-av', sync_content=False):
+    """
+    Get a local shell command that copies ``source_dir`` on the ``source``
+    :class:`Ec2InstanceWrapper` into ``destination_dir`` on the
+    ``destination`` :class:`Ec2InstanceWrapper`, directly from one instance to
+    the other (the data does not pass through the local host).
+
+    The command starts a temporary ``ssh-agent`` that only holds the key for
+    ``destination``, and forwards it to ``source`` for this one command. The
+    agent is killed when the command exits. ``source`` connects to the host
+    returned by :func:`get_transfer_host`.
+
+    :param method:
+        ``rsync`` to use ``rsync`` (must be installed on both instances), or
+        ``tar`` to pipe a gzipped tar archive over ``ssh``.
+    :param rsync_args: Arguments for ``rsync``. Ignored with ``method='tar'``.
+    :param sync_content: Normally ``source_dir`` is copied into
+        ``destination_dir``. With ``sync_content=True``, the content of
+        ``source_dir`` is copied into ``destination_dir`` instead.
+    """
+    destination_uri = destination.get_ssh_uri(host=get_transfer_host(source, destination))
+    inner_ssh = ' '.join(['ssh', awsfab_settings.EXTRA_SSH_ARGS]).strip()
+    if method == 'rsync':
+        source_dir = rsyncformat_path(source_dir, sync_content)
+        transfer_cmd = 'rsync {rsync_args} -e {ssh} {source_dir} {destination_uri}:{destination_dir}'.format(
+                rsync_args=rsync_args, ssh=quote(inner_ssh),
+                source_dir=quote(source_dir), destination_uri=destination_uri,
+                destination_dir=quote(destination_dir))
+    elif method == 'tar':
+        source_dir = force_noslashend(source_dir)
+        if sync_content:
+            tar_args = '-C {0} .'.format(quote(source_dir))
+        else:
+            tar_args = '-C {0} {1}'.format(quote(dirname(source_dir) or '/'),
+                                           quote(basename(source_dir)))
+        extract_cmd = 'mkdir -p {0} && tar -xzf - -C {0}'.format(quote(destination_dir))
+        transfer_cmd = 'tar -czf - {tar_args} | {ssh} {destination_uri} {extract_cmd}'.format(
+                tar_args=tar_args, ssh=inner_ssh, destination_uri=destination_uri,
+                extract_cmd=quote(extract_cmd))
+    else:
+        raise ValueError('Invalid transfer method: {0!r}. Use "rsync" or "tar".'.format(method))
+    return ('(eval "$(ssh-agent -s)" > /dev/null'
+            ' && trap \'ssh-agent -k > /dev/null\' EXIT'
+            ' && ssh-add -q {destination_key}'
+            ' && ssh -A {source_ssh_args} {source_uri} {transfer_cmd})').format(
+                    destination_key=quote(destination.get_ssh_key_filename()),
+                    source_ssh_args=ec2_ssh_args(source, controlmaster=False),
+                    source_uri=source.get_ssh_uri(),
+                    transfer_cmd=quote(transfer_cmd))
+
+
+def s3_download_script(remote_dir, manifest, concurrency=4):
+    """
+    Get a shell script that downloads the files in ``manifest`` into
+    ``remote_dir`` with ``curl``, with at most ``concurrency`` downloads at
+    the same time, and verifies all of them with ``md5sum``. A new download
+    is started as soon as one finishes, and no new downloads are started
+    after a download fails. The script exits with a non-zero status if any
+    download fails, or if any file does not match its checksum.
+
+    :param remote_dir:
+        The directory to download the files into. A leading ``~`` or ``~/``
+        is expanded to ``$HOME`` on the remote host (``~user`` is not
+        supported). Other paths are relative to the working directory of the
+        script, so use absolute paths.
+    :param manifest:
+        List of ``(path, md5sum, url)`` tuples (see
+        :func:`awsfabrictasks.s3.api.get_presigned_manifest`).
+    """
+    for path, md5sum, url in manifest:
+        if '\n' in path:
+            raise ValueError('Newlines are not supported in filenames: {0!r}'.format(path))
+    # A path line followed by a URL line for each file
+    downloads = ''.join('{0}\n{1}\n'.format(path, url) for path, md5sum, url in manifest)
+    checksums = ''.join('{0}  {1}\n'.format(md5sum, path) for path, md5sum, url in manifest)
+    if remote_dir == '~':
+        remote_dir = '"$HOME"'
+    elif remote_dir.startswith('~/'):
+        remote_dir = '"$HOME"' + quote(remote_dir[1:])
+    else:
+        remote_dir = quote(remote_dir)
+    script = """set -e
+mkdir -p {remote_dir}
+cd {remote_dir}
+# A failed download exits with 255, which makes xargs stop starting new
+# downloads and exit with a non-zero status.
+tr '\\n' '\\0' <<'AWSFAB_DOWNLOADS' | xargs -0 -r -n 2 -P {concurrency} \\
+    sh -c 'mkdir -p "$(dirname "$1")" && curl -sfS --retry 3 -o "$1" "$2" || exit 255' sh
+{downloads}AWSFAB_DOWNLOADS
+""".format(**vars())
+    if checksums:
+        script += """md5sum -c --quiet <<'AWSFAB_CHECKSUMS'
+{checksums}AWSFAB_CHECKSUMS
+""".format(**vars())
+    return script
+
+def run_s3_agent(job, use_sudo=False, quiet=False):
+    """
+    Run a :mod:`awsfabrictasks.s3.agent` job on the current host. The agent
+    and the job are uploaded to a temporary directory (removed when the job
+    is done), and run with ``python3`` or ``python``, whichever is
+    available on the host. The progress output of the agent is streamed
+    back like any other output from :func:`fabric.api.run`.
+
+    :param job: The job as a dict (see :mod:`awsfabrictasks.s3.agent`).
+    :param use_sudo: Run the agent as root?
+    :param quiet: Hide the output of the agent?
+    :return: The output of the agent.
+    """
+    tempdir = run('mktemp -d -t awsfab-s3agent.XXXXXX')
+    try:
+        put(StringIO(get_s3_agent_source()), tempdir + '/agent.py')
+        put(StringIO(json.dumps(job)), tempdir + '/job.json', mode=0600)
+        runner = sudo if use_sudo else run
+        command = '"$(command -v python3 || command -v python)" {0}/agent.py {0}/job.json'.format(tempdir)
+        if quiet:
+            with hide('stdout'):
+                return runner(command)
+        else:
+            return runner(command)
+    finally:
+        run('rm -rf {0}'.format(tempdir))
+
 def _parse_instanceident(instanceid_with_optional_region):
     if ':' in instanceid_with_optional_region:
         region, instanceid = instanceid_with_optional_region.split(':', 1)
@@ -123,6 +471,107 @@ def parse_instancename(instancename_with_optional_region):
     return _parse_instanceident(instancename_with_optional_region)
 
 
+def parse_regionnames(regionnames):
+    """
+    Parse a list of region names separated by ``,`` or ``;`` (``;`` is
+    easier to use in task arguments). ``"all"`` gives the names of all EC2
+    regions (sorted).
+
+    :return: List of region names.
+    """
+    if regionnames == 'all':
+        return sorted(region.name for region in get_regions(**awsfab_settings.AUTH))
+    return _split_list(regionnames)
+
+
+def _split_list(values):
+    return [value.strip() for value in values.replace(';', ',').split(',')
+            if value.strip()]
+
+
+def parse_tagvalues(tagvalues):
+    """
+    Parse a list of ``tagname=value`` pairs separated by ``,`` or ``;``
+    (``;`` is easier to use in task arguments).
+
+    :return: Dict mapping tag names to values.
+    """
+    return dict(tagvalue.split('=', 1) for tagvalue in _split_list(tagvalues))
+
+
+def get_instance_filters(state=None, tags=None, instance_type=None, vpc=None):
+    """
+    Build DescribeInstances filters.
+
+    :param state:
+        Instance state name (E.g.: ``running``). Separate multiple values
+        with ``,`` or ``;``.
+    :param tags:
+        Dict of tag name/value pairs, or a string parsed with
+        :func:`parse_tagvalues`. All the tags must match.
+    :param instance_type:
+        Instance type (E.g.: ``m1.small``). Separate multiple values with
+        ``,`` or ``;``.
+    :param vpc:
+        VPC ID. Separate multiple values with ``,`` or ``;``.
+    :return: A filters dict for ``get_all_reservations()`` and friends.
+    """
+    filters = {}
+    for filtername, values in (('instance-state-name', state),
+                               ('instance-type', instance_type),
+                               ('vpc-id', vpc)):
+        if values:
+            filters[filtername] = _split_list(values)
+    if isinstance(tags, basestring):
+        tags = parse_tagvalues(tags)
+    for tagname, value in (tags or {}).iteritems():
+        filters['tag:' + tagname] = value
+    return filters
+
+
+def iter_reservations(connection, filters=None, page_size=200):
+    """
+    Iterate over the reservations matching ``filters``, requesting one page of
+    at most ``page_size`` instances at a time (DescribeInstances with
+    MaxResults/NextToken), and yielding the reservations of each page as it
+    arrives.
+
+    :param connection: A :class:`boto.ec2.connection.EC2Connection`.
+    :param filters: See :func:`get_instance_filters`.
+    """
+    next_token = None
+    while True:
+        reservations = connection.get_all_reservations(filters=filters,
+                                                       max_results=page_size,
+                                                       next_token=next_token)
+        for reservation in reservations:
+            yield reservation
+        next_token = reservations.next_token
+        if not next_token:
+            break
+
+
+def map_regions(func, regionnames):
+    """
+    Run ``func(regionname)`` concurrently for each of the given regions.
+    A failure in one region does not affect the other regions.
+
+    :return:
+        List of ``(regionname, result, error)`` tuples sorted by region name,
+        where ``error`` is the exception raised by ``func`` (``result`` is
+        ``None`` in that case), or ``None`` on success.
+    """
+    regionnames = sorted(set(regionnames))
+    def run(regionname):
+        try:
+            return func(regionname), None
+        except Exception, e:
+            return None, e
+    results = parallel_map(run, regionnames, len(regionnames) or 1)
+    return [(regionname, result, error)
+            for regionname, (result, error) in zip(regionnames, results)]
+
+
 class Ec2RegionConnectionError(Exception):
     """
     Raised when we fail to connect to a region.
@@ -155,6 +604,267 @@ class NotExactlyOneInstanceError(InstanceLookupError):
     Raised when more than one instance is found when expecting exactly one instance.
     """
 
+class Ec2InstanceIndex(object):
+    """
+    Indexes the instances in a list of reservations (as returned by
+    ``get_all_instances()``) by instance ID, Name-tag and tags, so lookups
+    can be answered without contacting AWS.
+
+    :ivar reservations: The reservations the index was created from.
+    """
+    def __init__(self, reservations):
+        self.reservations = list(reservations)
+        self._by_id = {}
+        self._by_name = {}
+        for reservation in self.reservations:
+            for instance in reservation.instances:
+                self._by_id[instance.id] = instance
+                name = instance.tags.get('Name')
+                if name is not None:
+                    self._by_name.setdefault(name, []).append((reservation.id, instance))
+
+    def iterinstances(self):
+        """
+        Iterate over all indexed instances.
+        """
+        for reservation in self.reservations:
+            for instance in reservation.instances:
+                yield instance
+
+    def get_by_name(self, name):
+        """
+        Get the instance with the given Name-tag.
+
+        :raise InstanceLookupError:
+            The same subclasses as :meth:`Ec2InstanceWrapper.get_by_nametag`
+            raises in the same situations.
+        :return: A :class:`boto.ec2.instance.Instance`.
+        """
+        matches = self._by_name.get(name, [])
+        if len(matches) == 0:
+            raise NoInstanceWithNameFound('No ec2 instances with tag:Name={0}'.format(name))
+        if len(set(reservationid for reservationid, instance in matches)) > 1:
+            raise MultipleInstancesWithSameNameError('More than one ec2 reservations with tag:Name={0}'.format(name))
+        if len(matches) != 1:
+            raise NotExactlyOneInstanceError('Did not get exactly one instance with tag:Name={0}'.format(name))
+        return matches[0][1]
+
+    def get_by_id(self, instanceid):
+        """
+        Get the instance with the given ``instanceid``.
+
+        :raise LookupError: If the instance is not in the index.
+        :return: A :class:`boto.ec2.instance.Instance`.
+        """
+        try:
+            return self._by_id[instanceid]
+        except KeyError:
+            raise LookupError('No ec2 instances with instanceid={0}'.format(instanceid))
+
+    def filter_by_tags(self, tags):
+        """
+        Get all instances tagged with all the given ``tags`` (dict of
+        tagname:value pairs), in the order they were returned by AWS.
+        """
+        return [instance for instance in self.iterinstances()
+                if all(instance.tags.get(tagname) == value
+                       for tagname, value in tags.iteritems())]
+
+
+def get_ec2_connection(region):
+    """
+    Get a connection to the given EC2 ``region`` using
+    ``awsfab_settings.AUTH``. The connection is shared by the entire process
+    (see :class:`awsfabrictasks.connections.ConnectionRegistry`).
+
+    :raise Ec2RegionConnectionError: If connecting to the region fails.
+    """
+    connection = connection_registry.get('ec2', region, connect_to_region)
+    if not connection:
+        raise Ec2RegionConnectionError(region)
+    return connection
+
+
+def _replace_connections(obj, connection, seen=None):
+    """
+    Set the ``connection`` attribute of ``obj``, and all the boto EC2 objects
+    it references, to ``connection``. Used to detach objects from their
+    connection before pickling (``connection=None``), and to re-attach them
+    after unpickling.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return
+    seen.add(id(obj))
+    if isinstance(obj, (list, tuple)):
+        values = obj
+    elif isinstance(obj, dict):
+        values = obj.values()
+    elif hasattr(obj, '__dict__'):
+        values = [value for attrname, value in vars(obj).iteritems() if attrname != 'connection']
+        if isinstance(obj, (EC2Object, RegionInfo)):
+            if connection is None and isinstance(getattr(obj, 'connection', None), AWSAuthConnection):
+                obj.connection = None
+            elif connection is not None and getattr(obj, 'connection', None) is None:
+                obj.connection = connection
+    else:
+        return
+    for value in values:
+        _replace_connections(value, connection, seen)
+
+
+class Ec2Inventory(object):
+    """
+    Cache of all the EC2 instances in each region, used by the lookup
+    methods in :class:`Ec2InstanceWrapper`.
+
+    There are two cache levels:
+
+        - An in-process cache, which lives for the entire awsfab run.
+        - An optional on-disk cache shared between runs, enabled with
+          ``awsfab_settings.EC2_INVENTORY_CACHE_DIR``. Entries older than
+          ``awsfab_settings.EC2_INVENTORY_CACHE_TTL`` seconds are ignored.
+
+    The on-disk cache is pickled, so the cache directory is created with mode
+    ``0700`` and the cache files with mode ``0600``, and cache files that are
+    not owned by the current user, or are writable by other users, are
+    ignored.
+
+    A region is loaded with a single ``get_all_instances()`` call the
+    first time it is needed. Code that changes the state of instances (launch,
+    start, stop, tagging, ...) should call :meth:`.invalidate`.
+
+    Use the :obj:`ec2_inventory` instance instead of creating your own.
+    """
+    def __init__(self):
+        self._indexes = {}
+        self._lock = Lock()
+
+    def _get_cachefile_suffix(self):
+        accesskey = awsfab_settings.AUTH.get('aws_access_key_id', '')
+        return '-{account}.pickle'.format(account=md5(accesskey).hexdigest()[:12])
+
+    def _get_cachefile(self, region):
+        cachedir = awsfab_settings.EC2_INVENTORY_CACHE_DIR
+        if not cachedir:
+            return None
+        return join(expanduser(cachedir),
+                    'ec2inventory-{region}{suffix}'.format(region=region,
+                                                           suffix=self._get_cachefile_suffix()))
+
+    def _connect(self, region):
+        return get_ec2_connection(region)
+
+    def _load_cachefile(self, region):
+        cachefile = self._get_cachefile(region)
+        if not cachefile or not exists(cachefile):
+            return None
+        if time() - getmtime(cachefile) > awsfab_settings.EC2_INVENTORY_CACHE_TTL:
+            return None
+        filestat = stat(cachefile)
+        if filestat.st_uid != getuid() or filestat.st_mode & 022:
+            warn('Ignoring EC2 inventory cache file {0}: It is not owned by the current user, '
+                 'or it is writable by other users.'.format(cachefile))
+            return None
+        try:
+            with open(cachefile, 'rb') as fp:
+                reservations = pickle.load(fp)
+        except Exception, e:
+            warn('Ignoring invalid EC2 inventory cache file {0}: {1}'.format(cachefile, e))
+            return None
+        _replace_connections(reservations, self._connect(region))
+        return reservations
+
+    def _save_cachefile(self, region, reservations):
+        cachefile = self._get_cachefile(region)
+        if not cachefile:
+            return
+        cachedir = expanduser(awsfab_settings.EC2_INVENTORY_CACHE_DIR)
+        if not exists(cachedir):
+            makedirs(cachedir, 0700)
+        connection = reservations and reservations[0].connection
+        _replace_connections(reservations, None)
+        try:
+            # mkstemp creates the file with mode 0600, and the rename
+            # replaces the cache file atomically.
+            fd, tmpfile = mkstemp(prefix='.ec2inventory-', dir=cachedir)
+            try:
+                with fdopen(fd, 'wb') as fp:
+                    pickle.dump(reservations, fp, pickle.HIGHEST_PROTOCOL)
+                rename(tmpfile, cachefile)
+            except Exception:
+                remove(tmpfile)
+                raise
+        finally:
+            _replace_connections(reservations, connection)
+
+    def get_cached_index(self, region):
+        """
+        Get the :class:`Ec2InstanceIndex` for ``region`` if it is in the
+        in-process or on-disk cache, without contacting AWS. Returns ``None``
+        if the region is not cached.
+        """
+        with self._lock:
+            if region not in self._indexes:
+                reservations = self._load_cachefile(region)
+                if reservations is None:
+                    return None
+                self._indexes[region] = Ec2InstanceIndex(reservations)
+            return self._indexes[region]
+
+    def get_index(self, region=None):
+        """
+        Get the :class:`Ec2InstanceIndex` for ``region``, loading all
+        instances in the region if it is not cached.
+
+        :param region: Defaults to ``awsfab_settings.DEFAULT_REGION``.
+        :raise Ec2RegionConnectionError: If connecting to the region fails.
+        """
+        region = region or awsfab_settings.DEFAULT_REGION
+        index = self.get_cached_index(region)
+        if index is None:
+            reservations = self._connect(region).get_all_instances()
+            self.set_reservations(region, reservations)
+            index = self._indexes[region]
+        return index
+
+    def set_reservations(self, region, reservations):
+        """
+        Replace the cached instances for ``region`` with the instances in
+        ``reservations`` (must be all the instances in the region).
+        """
+        with self._lock:
+            self._indexes[region] = Ec2InstanceIndex(reservations)
+            self._save_cachefile(region, self._indexes[region].reservations)
+
+    def invalidate(self, region=None):
+        """
+        Remove ``region`` from the in-process and on-disk cache. Removes all
+        regions if ``region`` is ``None``. Only the on-disk cache for the
+        current credentials (``awsfab_settings.AUTH``) is removed.
+        """
+        with self._lock:
+            if region is None:
+                regions = self._indexes.keys()
+                cachedir = awsfab_settings.EC2_INVENTORY_CACHE_DIR
+                if cachedir and exists(expanduser(cachedir)):
+                    suffix = self._get_cachefile_suffix()
+                    for filename in listdir(expanduser(cachedir)):
+                        if filename.startswith('ec2inventory-') and filename.endswith(suffix):
+                            remove(join(expanduser(cachedir), filename))
+            else:
+                regions = [region]
+                cachefile = self._get_cachefile(region)
+                if cachefile and exists(cachefile):
+                    remove(cachefile)
+            for region in regions:
+                self._indexes.pop(region, None)
+
+#: The :class:`Ec2Inventory` used by :class:`Ec2InstanceWrapper`.
+ec2_inventory = Ec2Inventory()
+
+
 class Ec2InstanceWrapper(object):
     """
     Wraps a :class:`boto.ec2.instance.Instance` with convenience functions.
@@ -203,14 +913,27 @@ class Ec2InstanceWrapper(object):
         else:
             return instanceid
 
-    def get_ssh_uri(self):
+    def get_ssh_host(self):
+        """
+        Get the hostname or IP used to SSH to the instance: The public DNS
+        name, the public IP, or the private IP for instances without a public
+        address (E.g.: VPC-only instances reached through a VPN).
+
+        :return: The host, or ``None`` if the instance has no address (E.g.:
+            a stopped instance outside a VPC).
+        """
+        return (self['public_dns_name'] or self['ip_address']
+                or self['private_ip_address'] or None)
+
+    def get_ssh_uri(self, host=None):
         """
         Get the SSH URI for the instance.
 
-        :return: "<instance.tags['awsfab-ssh-user']>@<instance.public_dns_name>"
+        :param host: Use this host instead of :meth:`get_ssh_host`.
+        :return: "<instance.tags['awsfab-ssh-user']>@<host>"
         """
         user = self['tags'].get('awsfab-ssh-user', awsfab_settings.EC2_INSTANCE_DEFAULT_SSHUSER)
-        host = self['public_dns_name']
+        host = host or self.get_ssh_host()
         return '{user}@{host}'.format(**vars())
 
     def get_ssh_key_filename(self):
@@ -230,13 +953,17 @@ class Ec2InstanceWrapper(object):
 
     def add_instance_to_env(self):
         """
-        Add ``self`` to ``fabric.api.env.ec2instances[self.get_ssh_uri()]``,
-        and register the key-pair for the instance in
+        Add ``self`` to ``fabric.api.env.ec2instances[self.get_ssh_uri()]``
+        and to ``fabric.api.env.ec2instances_by_id[instance.id]`` (see
+        :meth:`get_selected`), and register the key-pair for the instance in
         ``fabric.api.env.key_filename``.
         """
         if not 'ec2instances' in env:
             env['ec2instances'] = {}
+        if not 'ec2instances_by_id' in env:
+            env['ec2instances_by_id'] = {}
         env['ec2instances'][self.get_ssh_uri()] = self
+        env['ec2instances_by_id'][self.instance.id] = self
         if not env.key_filename:
             env.key_filename = []
         key_filename = self.get_ssh_key_filename()
@@ -246,7 +973,7 @@ class Ec2InstanceWrapper(object):
     @classmethod
     def get_by_nametag(cls, instancename_with_optional_region):
         """
-        Connect to AWS and get the EC2 instance with the given Name-tag.
+        Get the EC2 instance with the given Name-tag from :obj:`ec2_inventory`.
 
         :param instancename_with_optional_region:
             Parsed with :func:`parse_instancename` to find the region and name.
@@ -257,23 +984,12 @@ class Ec2InstanceWrapper(object):
         :return: A :class:`Ec2InstanceWrapper` contaning the requested instance.
         """
         region, name = parse_instancename(instancename_with_optional_region)
-        connection = connect_to_region(region_name=region, **awsfab_settings.AUTH)
-        if not connection:
-            raise Ec2RegionConnectionError(region)
-        reservations = connection.get_all_instances(filters={'tag:Name': name})
-        if len(reservations) == 0:
-            raise NoInstanceWithNameFound('No ec2 instances with tag:Name={0}'.format(name))
-        if len(reservations) > 1:
-            raise MultipleInstancesWithSameNameError('More than one ec2 reservations with tag:Name={0}'.format(name))
-        reservation = reservations[0]
-        if len(reservation.instances) != 1:
-            raise NotExactlyOneInstanceError('Did not get exactly one instance with tag:Name={0}'.format(name))
-        return cls(reservation.instances[0])
+        return cls(ec2_inventory.get_index(region).get_by_name(name))
 
     @classmethod
     def get_by_tagvalue(cls, tags={}, region=None):
         """
-        Connect to AWS and get the EC2 instance with the given tag:value pairs.
+        Get the EC2 instances with the given tag:value pairs from :obj:`ec2_inventory`.
 
         :param tags
             A string like 'role=testing,fake=yes' to AND a set of ec2
@@ -286,19 +1002,8 @@ class Ec2InstanceWrapper(object):
         """
 
         region = region is None and awsfab_settings.DEFAULT_REGION or region
-        connection = connect_to_region(region_name=region, **awsfab_settings.AUTH)
-        if not connection:
-            raise Ec2RegionConnectionError(region)
-        tags = dict((('tag:%s' % oldk, v) for (oldk, v) in tags.iteritems()))
-        reservations = connection.get_all_instances(filters=tags)
-        if len(reservations) == 0:
-            return []
-
-        insts = []
-        for r in reservations:
-            for instance in r.instances:
-                insts.append(cls(instance))
-        return insts
+        instances = ec2_inventory.get_index(region).filter_by_tags(tags)
+        return [cls(instance) for instance in instances]
 
 
     @classmethod
@@ -314,27 +1019,24 @@ class Ec2InstanceWrapper(object):
 
 
     @classmethod
-    def get_by_instanceid(cls, instanceid):
+    def get_by_instanceid(cls, instanceid, cached=True):
         """
-        Connect to AWS and get the EC2 instance with the given instance ID.
+        Get the EC2 instance with the given instance ID from
+        :obj:`ec2_inventory`.
 
         :param instanceid_with_optional_region:
             Parsed with :func:`parse_instanceid` to find the region and name.
+        :param cached:
+            Set this to ``False`` to bypass :obj:`ec2_inventory`, and get
+            the current state of the instance from AWS.
         :raise Ec2RegionConnectionError: If connecting to the region fails.
         :raise LookupError: If the requested instance was not found in the region.
         :return: A :class:`Ec2InstanceWrapper` contaning the requested instance.
         """
         region, instanceid = parse_instanceid(instanceid)
-        connection = connect_to_region(region_name=region, **awsfab_settings.AUTH)
-        if not connection:
-            raise Ec2RegionConnectionError(region)
-        reservations = connection.get_all_instances([instanceid])
-        if len(reservations) == 0:
-            raise LookupError('No ec2 instances with instanceid={0}'.format(instanceid))
-        reservation = reservations[0]
-        if len(reservation.instances) != 1:
-            raise LookupError('Did not get exactly one instance with instanceid={0}'.format(instanceid))
-        return cls(reservation.instances[0])
+        if not cached:
+            return cls(_get_instance_uncached(region, instanceid))
+        return cls(ec2_inventory.get_index(region).get_by_id(instanceid))
 
     @classmethod
     def get_from_host_string(cls):
@@ -345,15 +1047,487 @@ class Ec2InstanceWrapper(object):
         """
         return env.ec2instances[env.host_string]
 
+    @classmethod
+    def get_selected(cls):
+        """
+        Get all the instances registered in ``fabric.api.env`` using
+        :meth:`add_instance_to_env`, sorted by instance id. Unlike
+        ``fabric.api.env.ec2instances``, this includes all the instances
+        without a public DNS name (they all have the same SSH URI).
+        """
+        instancewrappers = env.get('ec2instances_by_id', {}).values()
+        return sorted(instancewrappers, key=lambda instancewrapper: instancewrapper['id'])
+
+
+
+def _get_instance_uncached(region, instanceid):
+    connection = get_ec2_connection(region)
+    reservations = connection.get_all_instances([instanceid])
+    if len(reservations) == 0:
+        raise LookupError('No ec2 instances with instanceid={0}'.format(instanceid))
+    reservation = reservations[0]
+    if len(reservation.instances) != 1:
+        raise LookupError('Did not get exactly one instance with instanceid={0}'.format(instanceid))
+    return reservation.instances[0]
+
+
+class Ec2InstanceResolver(object):
+    """
+    Resolves many instance IDs, names and tag:value sets with at most one
+    DescribeInstances request per region, and with the regions queried
+    concurrently.
+
+    For each region, we use the :obj:`ec2_inventory` if the region is
+    already cached. Otherwise, if a single filtered request can answer all
+    the lookups in the region (only IDs, only names, or a single tag:value
+    set), we send one request with a multi-value filter (E.g.: ``tag:Name``
+    with all the names), split into one request per
+    :obj:`filter_chunksize` values. Otherwise, we load all the instances in the region
+    into :obj:`ec2_inventory` with one request.
+
+    Lookups fail with the same exceptions as the corresponding
+    ``Ec2InstanceWrapper.get_by_*`` methods.
+
+    Example::
+
+        resolver = Ec2InstanceResolver()
+        web = resolver.add_tags({'role': 'web'})
+        db = resolver.add_name('eu-west-1:db1')
+        results = resolver.resolve()
+        webservers = results[web]
+        dbserver = results[db][0]
+    """
+    #: Max number of values in a multi-value filter in a single
+    #: DescribeInstances request (EC2 rejects more than 200).
+    filter_chunksize = 200
+
+    def __init__(self):
+        self._lookups = []
+
+    def _add(self, kind, region, value):
+        self._lookups.append((kind, region, value))
+        return len(self._lookups) - 1
+
+    def add_instanceid(self, instanceid_with_optional_region):
+        """
+        Add an instance ID lookup. Parsed with :func:`parse_instanceid`.
+
+        :return: The index of the lookup in the list returned by :meth:`.resolve`.
+        """
+        region, instanceid = parse_instanceid(instanceid_with_optional_region)
+        return self._add('id', region, instanceid)
+
+    def add_name(self, instancename_with_optional_region):
+        """
+        Add a Name-tag lookup. Parsed with :func:`parse_instancename`.
+
+        :return: The index of the lookup in the list returned by :meth:`.resolve`.
+        """
+        region, name = parse_instancename(instancename_with_optional_region)
+        return self._add('name', region, name)
+
+    def add_tags(self, tags, region=None):
+        """
+        Add a lookup for all instances matching the ``tags`` dict (like
+        :meth:`Ec2InstanceWrapper.get_by_tagvalue`).
+
+        :return: The index of the lookup in the list returned by :meth:`.resolve`.
+        """
+        return self._add('tags', region or awsfab_settings.DEFAULT_REGION, dict(tags))
+
+    def _get_filters(self, lookups):
+        kinds = set(kind for kind, value in lookups)
+        tagsets = set(tuple(sorted(value.items())) for kind, value in lookups if kind == 'tags')
+        if len(kinds) != 1 or len(tagsets) > 1:
+            return None
+        kind = kinds.pop()
+        if kind == 'id':
+            return {'instance-id': sorted(set(value for kind, value in lookups))}
+        elif kind == 'name':
+            return {'tag:Name': sorted(set(value for kind, value in lookups))}
+        else:
+            return dict(('tag:' + tagname, value) for tagname, value in tagsets.pop())
+
+    def _describe(self, region, filters):
+        return get_ec2_connection(region).get_all_instances(filters=filters)
+
+    def _split_filters(self, filters):
+        for name, values in filters.iteritems():
+            if isinstance(values, list) and len(values) > self.filter_chunksize:
+                chunks = []
+                for index in xrange(0, len(values), self.filter_chunksize):
+                    chunk = dict(filters)
+                    chunk[name] = values[index:index+self.filter_chunksize]
+                    chunks.append(chunk)
+                return chunks
+        return [filters]
+
+    def _get_index(self, region, lookups):
+        index = ec2_inventory.get_cached_index(region)
+        if index is None:
+            filters = self._get_filters(lookups)
+            if filters is None:
+                index = ec2_inventory.get_index(region)
+            else:
+                reservations = []
+                for chunk in self._split_filters(filters):
+                    reservations.extend(self._describe(region, chunk))
+                index = Ec2InstanceIndex(reservations)
+        return index
+
+    def resolve(self):
+        """
+        Perform all the lookups.
+
+        :raise InstanceLookupError, LookupError:
+            For the first lookup (in the order they were added) that fails.
+        :return:
+            A list with a list of :class:`Ec2InstanceWrapper` objects for each
+            lookup, in the order the lookups were added. ID and name lookups
+            always give exactly one instance.
+        """
+        lookups_by_region = {}
+        for kind, region, value in self._lookups:
+            lookups_by_region.setdefault(region, []).append((kind, value))
+        regions = sorted(lookups_by_region)
+        def get_index(region):
+            try:
+                return self._get_index(region, lookups_by_region[region]), None
+            except Exception, e:
+                return None, e
+        indexes = dict(zip(regions, parallel_map(get_index, regions, len(regions) or 1)))
+
+        results = []
+        for kind, region, value in self._lookups:
+            index, error = indexes[region]
+            if error:
+                raise error
+            if kind == 'id':
+                results.append([Ec2InstanceWrapper(index.get_by_id(value))])
+            elif kind == 'name':
+                results.append([Ec2InstanceWrapper(index.get_by_name(value))])
+            else:
+                results.append([Ec2InstanceWrapper(instance)
+                                for instance in index.filter_by_tags(value)])
+        return results
 
 
 class WaitForStateError(Exception):
     """
-    Raises when :func:`wait_for_state` times out.
+    Raised when :func:`wait_for_state` or :class:`Ec2StateWaiter` times out.
+    """
+
+
+class Ec2StateWaiter(object):
+    """
+    Wait for any number of instances, in any number of regions, to reach
+    their target state. Each poll makes one DescribeInstances request per
+    region with pending instances, and the regions are polled concurrently.
+
+    Example::
+
+        waiter = Ec2StateWaiter(timeout=600)
+        waiter.add('i-12345678', 'running')
+        waiter.add('us-east-1:i-87654321', 'stopped')
+        waiter.wait()
+
+    The first poll is made immediately. The interval between polls starts at
+    ``interval`` seconds, and is multiplied by ``backoff`` after each poll
+    until it reaches ``max_interval``. Each sleep is randomized by
+    ``+/- jitter`` (a fraction of the interval), so many waiters do not poll
+    in lockstep.
+    """
+
+    #: An instance in one of these states never reaches any other state.
+    final_states = ('terminated',)
+
+    #: Max number of instance IDs in each DescribeInstances request.
+    describe_chunksize = 200
+
+    def __init__(self, timeout=600, interval=2, max_interval=15, backoff=1.5,
+                 jitter=0.2, callback=None):
+        """
+        :param timeout:
+            Raise :class:`WaitForStateError` if the instances have not
+            reached their target states within this many seconds.
+        :param callback:
+            Called with ``(instance, elapsed_sec)`` as each instance reaches
+            its target state. ``instance`` is the
+            :class:`boto.ec2.instance.Instance` from the latest poll.
+        """
+        self.timeout = timeout
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.callback = callback
+
+        #: ``{region: {instanceid: state_name}}`` for the instances that
+        #: have not reached their target state.
+        self.pending = {}
+
+        #: ``{(region, instanceid): instance}`` with the latest
+        #: :class:`boto.ec2.instance.Instance` for each polled instance.
+        self.instances = {}
+
+        #: ``{(region, instanceid): seconds}`` until each instance reached
+        #: its target state.
+        self.elapsed = {}
+
+    def add(self, instanceid, state_name):
+        """
+        Wait for the instance with ``instanceid`` (see
+        :func:`parse_instanceid`) to reach ``state_name``.
+        """
+        region, instanceid = parse_instanceid(instanceid)
+        self.pending.setdefault(region, {})[instanceid] = state_name
+
+    def _describe(self, region, instanceids):
+        # Filtering on instance-id instead of using the instance_ids
+        # parameter means that instances that are not visible yet (just
+        # launched) are missing from the response instead of failing the
+        # entire request.
+        connection = get_ec2_connection(region)
+        instances = []
+        for index in xrange(0, len(instanceids), self.describe_chunksize):
+            chunk = instanceids[index:index+self.describe_chunksize]
+            for reservation in connection.get_all_instances(filters={'instance-id': chunk}):
+                instances.extend(reservation.instances)
+        return instances
+
+    def poll(self):
+        """
+        Poll all pending instances once.
+
+        :return:
+            List of ``(region, instance)`` tuples for the instances that
+            reached their target state in this poll.
+        :raise WaitForStateError:
+            If an instance is in one of the :obj:`.final_states` that is not
+            its target state.
+        """
+        regions = sorted(self.pending.keys())
+        if not regions:
+            return []
+        results = parallel_map(lambda region: self._describe(region, sorted(self.pending[region])),
+                               regions, len(regions))
+        reached = []
+        for region, instances in zip(regions, results):
+            pending = self.pending[region]
+            for instance in instances:
+                state_name = pending.get(instance.id)
+                if state_name is None:
+                    continue
+                self.instances[(region, instance.id)] = instance
+                if instance.state == state_name:
+                    del pending[instance.id]
+                    reached.append((region, instance))
+                elif instance.state in self.final_states:
+                    raise WaitForStateError('{region}:{id} is "{state}", and will never be "{state_name}".'.format(
+                        region=region, id=instance.id, state=instance.state, state_name=state_name))
+            if not pending:
+                del self.pending[region]
+        return reached
+
+    def format_pending(self):
+        """
+        Format the pending instances as a comma-separated list of
+        ``<region>:<instanceid>=<state_name>``.
+        """
+        return ', '.join('{0}:{1}={2}'.format(region, instanceid, state_name)
+                         for region in sorted(self.pending)
+                         for instanceid, state_name in sorted(self.pending[region].iteritems()))
+
+    def _sleep(self, seconds):
+        sleep(seconds)
+
+    def wait(self):
+        """
+        Poll until all instances have reached their target state.
+
+        :raise WaitForStateError: If ``timeout`` is exceeded.
+        """
+        start = time()
+        deadline = start + self.timeout
+        interval = self.interval
+        while True:
+            for region, instance in self.poll():
+                elapsed = time() - start
+                self.elapsed[(region, instance.id)] = elapsed
+                if self.callback:
+                    self.callback(instance, elapsed)
+            if not self.pending:
+                return
+            remaining = deadline - time()
+            if remaining <= 0:
+                raise WaitForStateError('Desired states not achieved in {timeout}s: {pending}'.format(
+                    timeout=self.timeout, pending=self.format_pending()))
+            jittered = interval * uniform(1 - self.jitter, 1 + self.jitter)
+            self._sleep(min(remaining, jittered))
+            interval = min(interval * self.backoff, self.max_interval)
+
+
+class SshReadinessWaiter(object):
+    """
+    Wait for the SSH servers of many instances to become usable. EC2 reports
+    an instance as running long before sshd accepts connections, so use this
+    after :class:`Ec2StateWaiter` before connecting to the instances.
+
+    Each probe opens a TCP connection to the SSH port, and (with
+    ``check_banner``) checks that the server sends an SSH banner. With
+    ``check_auth``, we also log in with the key from
+    :meth:`Ec2InstanceWrapper.get_ssh_key_filename`, which catches instances
+    where sshd is up, but the key is not installed yet.
+
+    Example::
+
+        waiter = SshReadinessWaiter()
+        for instancewrapper in instancewrappers:
+            waiter.add(instancewrapper)
+        waiter.wait()
+
+    The pending hosts are probed concurrently. The poll interval starts at
+    ``interval`` seconds, and is multiplied by ``backoff`` up to
+    ``max_interval`` for each poll where no host became ready. It is reset to
+    ``interval`` as soon as a host becomes ready, since the rest are usually
+    close behind.
+    """
+    def __init__(self, timeout=300, interval=1, max_interval=5, backoff=1.5,
+                 port=22, connect_timeout=5, check_banner=True, check_auth=False,
+                 workers=20, callback=None):
+        """
+        :param timeout:
+            Raise :class:`WaitForSshError` if the hosts are not ready within
+            this many seconds.
+        :param callback:
+            Called with ``(instancewrapper, latency_sec)`` as each host becomes
+            ready. ``latency_sec`` is measured from the ``started`` timestamp
+            given to :meth:`.add`.
+        """
+        self.timeout = timeout
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.check_banner = check_banner
+        self.check_auth = check_auth
+        self.workers = workers
+        self.callback = callback
+
+        #: List of ``(instancewrapper, started)`` for the hosts that are not
+        #: ready yet.
+        self.pending = []
+
+        #: ``{instanceid: seconds}`` from ``started`` until each host was ready.
+        self.latency = {}
+
+    def add(self, instancewrapper, started=None):
+        """
+        Wait for the SSH server of the given :class:`Ec2InstanceWrapper`.
+
+        :param started:
+            Timestamp (``time.time()``) to measure the latency from. E.g.: When
+            the instance was launched. Defaults to now.
+        """
+        if started is None:
+            started = time()
+        self.pending.append((instancewrapper, started))
+
+    def get_host(self, instancewrapper):
+        """
+        Get the hostname or IP to probe for ``instancewrapper`` (see
+        :meth:`Ec2InstanceWrapper.get_ssh_host`).
+        """
+        return instancewrapper.get_ssh_host()
+
+    def _probe_tcp(self, host):
+        sock = socket.create_connection((host, self.port), self.connect_timeout)
+        try:
+            if self.check_banner:
+                sock.settimeout(self.connect_timeout)
+                return sock.recv(256).startswith('SSH-')
+            return True
+        finally:
+            sock.close()
+
+    def _probe_auth(self, instancewrapper, host):
+        import paramiko
+        user = instancewrapper.get_ssh_uri().split('@', 1)[0]
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            client.connect(host, port=self.port, username=user,
+                           key_filename=instancewrapper.get_ssh_key_filename(),
+                           timeout=self.connect_timeout,
+                           allow_agent=False, look_for_keys=False)
+            return True
+        except (paramiko.SSHException, EOFError):
+            return False
+        finally:
+            client.close()
+
+    def probe(self, instancewrapper):
+        """
+        Probe the SSH server of ``instancewrapper`` once.
+
+        :return: ``True`` if the SSH server is usable.
+        """
+        host = self.get_host(instancewrapper)
+        if not host:
+            return False
+        try:
+            if not self._probe_tcp(host):
+                return False
+            if self.check_auth:
+                return self._probe_auth(instancewrapper, host)
+            return True
+        except socket.error:
+            return False
+
+    def _sleep(self, seconds):
+        sleep(seconds)
+
+    def wait(self):
+        """
+        Probe until all hosts are ready.
+
+        :raise WaitForSshError: If ``timeout`` is exceeded.
+        """
+        deadline = time() + self.timeout
+        interval = self.interval
+        while self.pending:
+            pending = self.pending
+            results = parallel_map(lambda item: self.probe(item[0]), pending, self.workers)
+            self.pending = []
+            for (instancewrapper, started), ready in zip(pending, results):
+                if ready:
+                    latency = time() - started
+                    self.latency[instancewrapper['id']] = latency
+                    if self.callback:
+                        self.callback(instancewrapper, latency)
+                else:
+                    self.pending.append((instancewrapper, started))
+            if not self.pending:
+                return
+            remaining = deadline - time()
+            if remaining <= 0:
+                raise WaitForSshError('SSH not ready in {timeout}s: {hosts}'.format(
+                    timeout=self.timeout,
+                    hosts=', '.join(instancewrapper.prettyname() for instancewrapper, started in self.pending)))
+            if len(self.pending) < len(pending):
+                interval = self.interval
+            self._sleep(min(remaining, interval))
+            interval = min(interval * self.backoff, self.max_interval)
+
+
+class WaitForSshError(Exception):
+    """
+    Raised when :class:`SshReadinessWaiter` times out.
     """
 
 
-def wait_for_state(instanceid, state_name, sleep_intervals=[15, 5], last_sleep_repeat=40):
+def wait_for_state(instanceid, state_name, sleep_intervals=None, last_sleep_repeat=40):
     """
     Poll the instance with ``instanceid`` until its ``state_name`` matches the
     desired ``state_name``.
@@ -367,19 +1541,21 @@ def wait_for_state(instanceid, state_name, sleep_intervals=[15, 5], last_sleep_r
         is made immediately, then we wait for sleep_intervals[0] seconds before the next poll,
         and repeat for each item in sleep_intervals. Then we repeat for ``last_sleep_repeat``
         using the last item in ``sleep_intervals`` as the timout for each wait.
+        Defaults to ``[15, 5]``.
     :param last_sleep_repeat:
         Number of times to repeat the last item in ``sleep_intervals``. If this
         is 20, we will wait for a maximum of ``sum(sleep_intervals) + sleep_intervals[-1]*20``.
     """
-    from time import sleep
     region, instanceid = parse_instanceid(instanceid)
-    sleep_intervals.extend([sleep_intervals[-1] for x in xrange(last_sleep_repeat)])
+    if sleep_intervals is None:
+        sleep_intervals = [15, 5]
+    sleep_intervals = list(sleep_intervals) + [sleep_intervals[-1]] * last_sleep_repeat
     max_wait_sec = sum(sleep_intervals)
     print 'Waiting for {instanceid} to change state to: "{state_name}". Will try for {max_wait_sec}s.'.format(**vars())
 
     sleep_intervals_len = len(sleep_intervals)
     for index, sleep_sec in enumerate(sleep_intervals):
-        instancewrapper = Ec2InstanceWrapper.get_by_instanceid(instanceid)
+        instancewrapper = Ec2InstanceWrapper.get_by_instanceid(instanceid, cached=False)
         current_state_name = instancewrapper['state']
         if current_state_name == state_name:
             print '.. OK'
@@ -390,6 +1566,58 @@ def wait_for_state(instanceid, state_name, sleep_intervals=[15, 5], last_sleep_r
     raise WaitForStateError('Desired state, "{state_name}", not achieved in {max_wait_sec}s.'.format(**vars()))
 
 
+def wait_for_state_many(instanceids, state_name, started=None):
+    """
+    Wait for all the instances to reach ``state_name`` using a single
+    :class:`Ec2StateWaiter`, and print the latency for each instance.
+
+    :param instanceids: List of instance IDs (see :func:`parse_instanceid`).
+    :param started:
+        Timestamp (``time.time()``) to measure the latency from. Defaults to now.
+    :return: The :class:`Ec2StateWaiter`.
+    """
+    if started is None:
+        started = time()
+    def reached(instance, elapsed):
+        print '.. {id} is {state} ({sec:.0f}s)'.format(id=instance.id, state=state_name,
+                                                       sec=time() - started)
+    waiter = Ec2StateWaiter(callback=reached)
+    for instanceid in instanceids:
+        waiter.add(instanceid, state_name)
+    print 'Waiting for {0} instance(s) to change state to: "{1}".'.format(len(instanceids), state_name)
+    waiter.wait()
+    return waiter
+
+
+def wait_until_usable(instanceids, started=None, waitssh=True, check_auth=False):
+    """
+    Wait for the instances to reach the running state using
+    :class:`Ec2StateWaiter`, and then (if ``waitssh``) for their SSH servers
+    to become usable using :class:`SshReadinessWaiter`. Prints the latency
+    for each instance as it becomes running and usable.
+
+    :param instanceids: List of instance IDs (see :func:`parse_instanceid`).
+    :param started:
+        Timestamp (``time.time()``) to measure the latency from. E.g.: Right
+        before the instances were launched. Defaults to now.
+    :param check_auth: Forwarded to :class:`SshReadinessWaiter`.
+    :return: List of :class:`Ec2InstanceWrapper` with the running instances.
+    """
+    if started is None:
+        started = time()
+    def usable(instancewrapper, latency):
+        print '.. {id} accepts SSH connections ({sec:.0f}s)'.format(id=instancewrapper['id'], sec=latency)
+    statewaiter = wait_for_state_many(instanceids, 'running', started=started)
+    instancewrappers = [Ec2InstanceWrapper(statewaiter.instances[parse_instanceid(instanceid)])
+                        for instanceid in instanceids]
+    if waitssh:
+        sshwaiter = SshReadinessWaiter(check_auth=check_auth, callback=usable)
+        for instancewrapper in instancewrappers:
+            sshwaiter.add(instancewrapper, started=started)
+        print 'Waiting for SSH on {0} instance(s).'.format(len(instancewrappers))
+        sshwaiter.wait()
+    return instancewrappers
+
 def wait_for_stopped_state(instanceid, **kwargs):
     """
     Shortcut for ``wait_for_state(instanceid, 'stopped', **kwargs)``.
@@ -403,6 +1631,113 @@ def wait_for_running_state(instanceid, **kwargs):
     wait_for_state(instanceid, 'running', **kwargs)
 
 
+#: Max number of resource IDs in each request made by the ``bulk_*`` functions.
+BULK_CHUNKSIZE = 1000
+
+
+def group_by_region(instancewrappers):
+    """
+    Group :class:`Ec2InstanceWrapper` objects by region.
+
+    :return: Dict mapping region names to lists of :class:`Ec2InstanceWrapper`.
+    """
+    by_region = {}
+    for instancewrapper in instancewrappers:
+        by_region.setdefault(instancewrapper['region'].name, []).append(instancewrapper)
+    return by_region
+
+
+def _bulk_request(instancewrappers, request):
+    """
+    Run ``request(connection, instanceids)`` for each region of the given
+    instances, with at most :obj:`BULK_CHUNKSIZE` instance IDs for each
+    call. The regions are handled concurrently, and the first error (if any)
+    is raised when all regions are done.
+    """
+    by_region = group_by_region(instancewrappers)
+    def run(region):
+        connection = get_ec2_connection(region)
+        instanceids = [instancewrapper['id'] for instancewrapper in by_region[region]]
+        for index in xrange(0, len(instanceids), BULK_CHUNKSIZE):
+            request(connection, instanceids[index:index+BULK_CHUNKSIZE])
+    for region, result, error in map_regions(run, by_region.keys()):
+        if error:
+            raise error
+
+
+def bulk_create_tags(instancewrappers, tags):
+    """
+    Add/overwrite ``tags`` on all the given :class:`Ec2InstanceWrapper`
+    objects with one CreateTags request per region.
+    """
+    try:
+        _bulk_request(instancewrappers,
+                      lambda connection, instanceids: connection.create_tags(instanceids, tags))
+    finally:
+        ec2_inventory.invalidate()
+    for instancewrapper in instancewrappers:
+        instancewrapper.instance.tags.update(tags)
+
+
+def bulk_delete_tags(instancewrappers, tagnames):
+    """
+    Remove the tags named ``tagnames`` from all the given
+    :class:`Ec2InstanceWrapper` objects with one DeleteTags request per
+    region.
+    """
+    try:
+        _bulk_request(instancewrappers,
+                      lambda connection, instanceids: connection.delete_tags(instanceids, list(tagnames)))
+    finally:
+        ec2_inventory.invalidate()
+    for instancewrapper in instancewrappers:
+        for tagname in tagnames:
+            instancewrapper.instance.tags.pop(tagname, None)
+
+
+def bulk_start_instances(instancewrappers):
+    """
+    Start all the given :class:`Ec2InstanceWrapper` objects with one
+    StartInstances request per region. Does not wait for the instances to
+    start (see :func:`wait_until_usable`).
+    """
+    try:
+        _bulk_request(instancewrappers,
+                      lambda connection, instanceids: connection.start_instances(instanceids))
+    finally:
+        ec2_inventory.invalidate()
+
+
+def bulk_stop_instances(instancewrappers):
+    """
+    Stop all the given :class:`Ec2InstanceWrapper` objects with one
+    StopInstances request per region. Does not wait for the instances to
+    stop (see :func:`wait_for_state_many`).
+    """
+    try:
+        _bulk_request(instancewrappers,
+                      lambda connection, instanceids: connection.stop_instances(instanceids))
+    finally:
+        ec2_inventory.invalidate()
+
+
+def instance_as_dict(instance, regionname):
+    """
+    Get the most useful attributes of an ec2 instance as a dict that can be
+    serialized as JSON.
+
+    :param instance: A :class:`boto.ec2.instance.Instance` object.
+    :param regionname: The region of the instance.
+    """
+    attrnames = ['id', 'state', 'instance_type', 'launch_time', 'ip_address',
+                 'public_dns_name', 'private_ip_address', 'private_dns_name',
+                 'vpc_id', 'key_name', 'placement']
+    info = dict((attrname, getattr(instance, attrname, None)) for attrname in attrnames)
+    info['region'] = regionname
+    info['tags'] = dict(instance.tags)
+    return info
+
+
 def print_ec2_instance(instance, full=False, indentspaces=3):
     """
     Print attributes of an ec2 instance.
@@ -436,6 +1771,34 @@ def print_ec2_instance(instance, full=False, indentspaces=3):
 
 
 
+def group_tags(tags_by_resourceid):
+    """
+    Group the tags for many resources into as few CreateTags requests as
+    possible. CreateTags sets the same tags on all the given resources, so
+    each tag:value pair is grouped with the other pairs that should be set on
+    exactly the same resources.
+
+    Example::
+
+        >>> group_tags({'i-1': {'Name': 'a', 'role': 'web'},
+        ...             'i-2': {'Name': 'b', 'role': 'web'}})
+        [(['i-1'], {'Name': 'a'}), (['i-1', 'i-2'], {'role': 'web'}), (['i-2'], {'Name': 'b'})]
+
+    :param tags_by_resourceid: Dict mapping resource IDs to tag dicts.
+    :return:
+        Sorted list of ``(resourceids, tags)`` tuples, where ``resourceids``
+        is a sorted list.
+    """
+    resourceids_by_pair = {}
+    for resourceid, tags in tags_by_resourceid.iteritems():
+        for pair in tags.iteritems():
+            resourceids_by_pair.setdefault(pair, set()).add(resourceid)
+    groups = {}
+    for (tagname, value), resourceids in resourceids_by_pair.iteritems():
+        groups.setdefault(frozenset(resourceids), {})[tagname] = value
+    return sorted((sorted(resourceids), tags) for resourceids, tags in groups.iteritems())
+
+
 class Ec2LaunchInstance(object):
     """
     Launch instances configured in ``awsfab_settings.EC2_LAUNCH_CONFIGS``.
@@ -456,8 +1819,9 @@ class Ec2LaunchInstance(object):
 
     Example of launching many instances::
 
-        a = Ec2LaunchInstance(extra_tags={'Name': 'a'})
-        b = Ec2LaunchInstance(extra_tags={'Name': 'b'})
+        a = Ec2LaunchInstance(extra_tags={'Name': 'a'}, duplicate_name_protection=False)
+        b = Ec2LaunchInstance(extra_tags={'Name': 'b'}, duplicate_name_protection=False)
+        Ec2LaunchInstance.check_if_name_exists_many([a, b])
         Ec2LaunchInstance.confirm_many([a, b])
         Ec2LaunchInstance.run_many_instances([a, b])
         # Note: that we can start doing stuff with ``a`` and ``b`` that does not
@@ -465,38 +1829,234 @@ class Ec2LaunchInstance(object):
         Ec2LaunchInstance.wait_for_running_state_many([a, b])
     """
 
-    #: Number of seconds to sleep before retrying when adding tags gets EC2ResponseError.
-    tag_retry_sleep = 2
+    #: Number of seconds to sleep before the first retry when adding tags
+    #: gets EC2ResponseError, and before the first poll for the visibility
+    #: of launched instances. Doubled for each retry/poll up to
+    #: :obj:`.tag_retry_sleep`.
+    tag_retry_interval = 0.5
+
+    #: Max number of seconds to sleep between retries and between polls.
+    tag_retry_sleep = 5
 
     #: Number of times to retry when adding tags gets EC2ResponseError.
-    tag_retry_count = 4
+    tag_retry_count = 8
+
+    #: Max number of seconds to spend retrying when adding tags.
+    tag_retry_timeout = 60
+
+    @classmethod
+    def _get_waiter_kwargs(cls, kwargs):
+        """
+        Translate the ``sleep_intervals`` and ``last_sleep_repeat`` arguments
+        of :func:`wait_for_state` (used by :meth:`wait_for_running_state_many`
+        before 1.3.0) in ``kwargs`` to :class:`Ec2StateWaiter` arguments.
+        """
+        kwargs = dict(kwargs)
+        if 'sleep_intervals' in kwargs or 'last_sleep_repeat' in kwargs:
+            warn('The sleep_intervals and last_sleep_repeat arguments are deprecated since 1.3.0. '
+                 'Use the Ec2StateWaiter arguments instead.', DeprecationWarning)
+            sleep_intervals = kwargs.pop('sleep_intervals', None) or [15, 5]
+            last_sleep_repeat = kwargs.pop('last_sleep_repeat', 40)
+            kwargs.setdefault('timeout', sum(sleep_intervals) + sleep_intervals[-1] * last_sleep_repeat)
+            kwargs.setdefault('interval', sleep_intervals[0])
+            kwargs.setdefault('max_interval', sleep_intervals[-1])
+        return kwargs
 
     @classmethod
     def wait_for_running_state_many(cls, launchers, **kwargs):
         """
-        Loop through ``launchers`` and run :func:`wait_for_running_state`.
+        Wait for the instances of all ``launchers`` to reach the running
+        state using a single :class:`Ec2StateWaiter`.
 
         :param launchers:
             List of Ec2LaunchInstance objects that have been lauched with
             :meth:`Ec2LaunchInstance.run_instance`.
         :param kwargs:
-            Forwarded to :func:`wait_for_running_state`.
+            Forwarded to :class:`Ec2StateWaiter`. The ``sleep_intervals`` and
+            ``last_sleep_repeat`` arguments of :func:`wait_for_state` are
+            deprecated, but still accepted: They are translated to the
+            ``timeout``, ``interval`` and ``max_interval`` arguments.
+        :return: The :class:`Ec2StateWaiter`.
         """
+        def callback(instance, elapsed):
+            print '.. {id} is running ({elapsed:.0f}s)'.format(id=instance.id, elapsed=elapsed)
+        kwargs = cls._get_waiter_kwargs(kwargs)
+        kwargs.setdefault('callback', callback)
+        waiter = Ec2StateWaiter(**kwargs)
         for launcher in launchers:
-            wait_for_running_state(launcher.instance.id, **kwargs)
+            waiter.add('{0}:{1}'.format(launcher.conf['region'], launcher.instance.id), 'running')
+        print 'Waiting for {0} instance(s) to change state to: "running".'.format(len(launchers))
+        waiter.wait()
+        return waiter
 
     @classmethod
     def run_many_instances(cls, launchers):
         """
-        Loop through ``launchers`` and run :func:`run_instance`.
+        Run/launch the instances for all ``launchers``, and add their tags.
+
+        Launchers with the same region, AMI and ``run_instances()`` arguments
+        (E.g.: launchers using the same config) are launched with a single
+        ``run_instances(min_count=N, max_count=N)`` request. The tags of all
+        the launched instances in a region are added with as few CreateTags
+        requests as possible (see :func:`group_tags`).
+
+        If a ``run_instances()`` request fails, the instances launched by the
+        earlier requests are still tagged. If any request fails, all the
+        launched instances, and the instances that could not be tagged, are
+        printed before the first error is re-raised, so no instance is left
+        running unnoticed.
 
         :param launchers:
             List of Ec2LaunchInstance objects.
-        :param kwargs:
-            Forwarded to :func:`wait_for_running_state`.
+        :return: List of the launched instances (in the same order as ``launchers``).
         """
+        import sys
+        groups = {}
         for launcher in launchers:
-            launcher.run_instance()
+            key = (launcher.conf['region'], launcher.conf['ami'], pformat(launcher.kw))
+            groups.setdefault(key, []).append(launcher)
+        launched = []
+        first_error = None
+        for (region, ami, kw), group in sorted(groups.iteritems()):
+            connection = get_ec2_connection(region)
+            count = len(group)
+            try:
+                reservation = connection.run_instances(ami, min_count=count, max_count=count,
+                                                       **group[0].kw)
+            except Exception:
+                first_error = sys.exc_info()
+                break
+            for launcher, instance in zip(group, reservation.instances):
+                launcher.instance = instance
+                launched.append(launcher)
+            ec2_inventory.invalidate(region)
+
+        tags_by_region = {}
+        for launcher in launched:
+            tags_by_instanceid = tags_by_region.setdefault(launcher.conf['region'], {})
+            tags_by_instanceid[launcher.instance.id] = launcher.get_all_tags()
+        tag_errors = {}
+        for region, tags_by_instanceid in sorted(tags_by_region.iteritems()):
+            connection = get_ec2_connection(region)
+            for instanceids, tags in group_tags(tags_by_instanceid):
+                try:
+                    cls._create_tags(connection, instanceids, tags)
+                except Exception, e:
+                    if first_error is None:
+                        first_error = sys.exc_info()
+                    for instanceid in instanceids:
+                        tag_errors.setdefault(instanceid, e)
+        for launcher in launched:
+            if launcher.instance.id not in tag_errors:
+                launcher.instance.tags.update(launcher.get_all_tags())
+        if first_error:
+            cls._print_launched(launched, tag_errors)
+            raise first_error[0], first_error[1], first_error[2]
+        return [launcher.instance for launcher in launchers]
+
+    @classmethod
+    def _print_launched(cls, launched, tag_errors):
+        """
+        Print the instances launched by :meth:`run_many_instances` when it
+        fails, with the error for the instances that could not be tagged.
+        """
+        print 'Launched {0} instance(s) before the failure:'.format(len(launched))
+        for launcher in launched:
+            logname = '{0}:{1} (name={2})'.format(launcher.conf['region'], launcher.instance.id,
+                                                  launcher.get_all_tags().get('Name'))
+            if launcher.instance.id in tag_errors:
+                print '  {0}: NOT TAGGED: {1}'.format(logname,
+                                                      str(tag_errors[launcher.instance.id]).strip())
+            else:
+                print '  {0}: tagged'.format(logname)
+
+    @classmethod
+    def _wait_until_visible(cls, connection, instanceids, deadline):
+        interval = cls.tag_retry_interval
+        while time() < deadline:
+            visible = set()
+            for reservation in connection.get_all_instances(filters={'instance-id': instanceids}):
+                visible.update(instance.id for instance in reservation.instances)
+            if visible.issuperset(instanceids):
+                return
+            cls._sleep(max(0, min(interval, deadline - time())))
+            interval = min(interval * 2, cls.tag_retry_sleep)
+
+    @classmethod
+    def _sleep(cls, seconds):
+        sleep(seconds)
+
+    @classmethod
+    def _create_tags(cls, connection, instanceids, tags):
+        """
+        Add ``tags`` to all ``instanceids`` with a single CreateTags request.
+
+        Newly launched instances are not always visible to CreateTags right
+        away. If CreateTags fails, we retry with exponential backoff (see
+        :obj:`.tag_retry_interval`) until :obj:`.tag_retry_count` or
+        :obj:`.tag_retry_timeout` is exceeded. If the error is that an
+        instance is not found, we also poll (DescribeInstances) until all the
+        instances are visible before retrying (DescribeInstances may see the
+        instances before CreateTags does, so we still sleep).
+        """
+        from boto.exception import EC2ResponseError
+        deadline = time() + cls.tag_retry_timeout
+        delay = cls.tag_retry_interval
+        retries = 0
+        while True:
+            try:
+                connection.create_tags(instanceids, tags)
+                return
+            except EC2ResponseError, e:
+                if retries >= cls.tag_retry_count or time() >= deadline:
+                    raise
+                retries += 1
+                print ('Got EC2ResponseError ({code}) while adding tags to {ids}. '
+                       'Retrying...').format(code=e.error_code, ids=', '.join(instanceids))
+                if e.error_code == 'InvalidInstanceID.NotFound':
+                    cls._wait_until_visible(connection, instanceids, deadline)
+                cls._sleep(max(0, min(delay, deadline - time())))
+                delay = min(delay * 2, cls.tag_retry_sleep)
+
+    @classmethod
+    def check_if_name_exists_many(cls, launchers):
+        """
+        Abort if more than one of the ``launchers`` in a region has the same
+        Name-tag, or if an instance with one of the names already exists in
+        the region of the launcher. Makes a single DescribeInstances request
+        per region, and queries the regions concurrently.
+        """
+        import sys
+        names_by_region = {}
+        for launcher in launchers:
+            name = launcher.get_all_tags().get('Name')
+            if name:
+                names = names_by_region.setdefault(launcher.conf['region'], [])
+                if name in names:
+                    abort('More than one of the instances to launch is named {name}.'.format(name=name))
+                names.append(name)
+        if not names_by_region:
+            return
+        allnames = sorted(name for names in names_by_region.itervalues() for name in names)
+        print
+        sys.stdout.write('Making sure no EC2 instance with Name={0} exists...'.format(', '.join(allnames)))
+        sys.stdout.flush()
+        def get_existing_names(region):
+            connection = get_ec2_connection(region)
+            names = names_by_region[region]
+            existing = set()
+            for index in xrange(0, len(names), 200):
+                filters = {'tag:Name': names[index:index+200]}
+                for reservation in connection.get_all_instances(filters=filters):
+                    existing.update(instance.tags.get('Name') for instance in reservation.instances)
+            return existing
+        for region, existing, error in map_regions(get_existing_names, names_by_region.keys()):
+            if error:
+                raise error
+            if existing:
+                abort('An instance named {names} already exists.'.format(names=', '.join(sorted(existing))))
+        print 'OK'
+        print
 
     @classmethod
     def confirm_many(cls, launchers):
@@ -534,6 +2094,9 @@ class Ec2LaunchInstance(object):
         :param configname_help:
             The help to show above the prompt for configname input (only used
             if ``configname`` is ``None``.
+        :param duplicate_name_protection:
+            Run :meth:`.check_if_name_exists`? Set this to ``False``, and use
+            :meth:`.check_if_name_exists_many` when creating many launchers.
         """
         if not awsfab_settings.EC2_LAUNCH_CONFIGS:
             abort('You have no awsfab_settings.EC2_LAUNCH_CONFIGS.')
@@ -594,20 +2157,11 @@ class Ec2LaunchInstance(object):
         self.kw = kw
 
     def check_if_name_exists(self):
-        import sys
-        name = self.get_all_tags().get('Name')
-        if name:
-            print
-            sys.stdout.write('Making sure no EC2 instance with Name={0} exists...'.format(name))
-            sys.stdout.flush()
-            try:
-                wrapper = Ec2InstanceWrapper.get_by_nametag(name)
-            except NoInstanceWithNameFound:
-                pass
-            else:
-                abort('An instance named {name} already exists.'.format(name=name))
-            print 'OK'
-            print
+        """
+        Abort if an instance with the Name-tag of this launcher already exists.
+        Use :meth:`.check_if_name_exists_many` to check many launchers.
+        """
+        self.check_if_name_exists_many([self])
 
     def create_config_ask_if_none(self):
         """
@@ -669,30 +2223,17 @@ class Ec2LaunchInstance(object):
     def run_instance(self):
         """
         Run/launch the configured instance, and add the tags to the instance
-        (:meth:`.get_all_tags`).
+        (:meth:`.get_all_tags`) with a single CreateTags request.
 
         :return: The launched instance.
         """
-        connection = connect_to_region(region_name=self.conf['region'], **awsfab_settings.AUTH)
+        connection = get_ec2_connection(self.conf['region'])
         reservation = connection.run_instances(self.conf['ami'], **self.kw)
         instance = reservation.instances[0]
-        self._add_tags(instance)
+        ec2_inventory.invalidate(self.conf['region'])
+        tags = self.get_all_tags()
+        if tags:
+            self._create_tags(connection, [instance.id], tags)
+            instance.tags.update(tags)
         self.instance = instance
         return instance
-
-    def _add_tag(self, instance, tagname, value, retries=0):
-        import time
-        from boto.exception import EC2ResponseError
-        try:
-            instance.add_tag(tagname, value)
-        except EC2ResponseError:
-            if retries > self.tag_retry_count:
-                raise
-            print ('Got EC2ResponseError while adding tag to {id}. Retrying in '
-                   '{sec} seconds...').format(id=instance.id, sec=self.tag_retry_sleep)
-            time.sleep(self.tag_retry_sleep)
-            self._add_tag(instance, tagname, value, retries=retries+1)
-
-    def _add_tags(self, instance):
-        for tagname, value in self.get_all_tags().iteritems():
-            self._add_tag(instance, tagname, value)
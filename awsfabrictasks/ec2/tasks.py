@@ -2,31 +2,74 @@
 General tasks for AWS management.
 """
 from pprint import pformat, pprint
-from boto.ec2 import connect_to_region
-from fabric.api import task, abort, local, env
+from os.path import join, abspath, expanduser, basename
+from tempfile import NamedTemporaryFile, mkdtemp
+from shutil import rmtree
+from time import time
+import json
+from fabric.api import task, abort, local, env, runs_once
 from fabric.contrib.console import confirm
 from textwrap import fill
 
 from awsfabrictasks.conf import awsfab_settings
 from awsfabrictasks.utils import force_slashend
 from awsfabrictasks.utils import parse_bool
+from awsfabrictasks.utils import run_local_commands
+from awsfabrictasks.utils import format_local_command_results
+from awsfabrictasks.utils import parse_rsync_stats
+from awsfabrictasks.utils import merge_rsync_stats
+from awsfabrictasks.utils import configureStreamLoggerForTask
+from awsfabrictasks.utils import getLoglevelFromString
+from awsfabrictasks.hostslist import create_hostsfile_from_ec2instancewrappers
+from awsfabrictasks.hostslist import distribute_hostsfile
+from awsfabrictasks.hostslist import hostsfile_was_updated
+from awsfabrictasks.s3.api import S3ConnectionWrapper
+from awsfabrictasks.s3.api import s3_syncupload
+from awsfabrictasks.s3.api import get_presigned_manifest
+from awsfabrictasks.s3.api import get_presigned_download_files
+from awsfabrictasks.s3.api import get_presigned_upload_files
 from api import Ec2InstanceWrapper
+from api import get_ec2_connection
 from api import wait_for_stopped_state
-from api import wait_for_running_state
+from api import wait_until_usable
 from api import print_ec2_instance
 from api import Ec2LaunchInstance
 from api import ec2_rsync_upload
 from api import ec2_rsync_upload_command
 from api import ec2_rsync_download
 from api import ec2_rsync_download_command
+from api import ec2_inventory
+from api import parse_regionnames
+from api import map_regions
+from api import bulk_create_tags
+from api import bulk_delete_tags
+from api import bulk_start_instances
+from api import bulk_stop_instances
+from api import wait_for_state_many
+from api import get_instance_filters
+from api import iter_reservations
+from api import instance_as_dict
+from api import ec2_ssh_command
+from api import close_ssh_masters
+from api import s3_download_script
+from api import ec2_rsync_upload_sharded_commands
+from api import ec2_transfer_command
+from api import run_s3_agent
 
 
 
 __all__ = [
         'ec2_add_tag', 'ec2_set_tag', 'ec2_remove_tag',
+        'ec2_bulk_add_tag', 'ec2_bulk_set_tag', 'ec2_bulk_remove_tag',
         'ec2_launch_instance', 'ec2_start_instance', 'ec2_stop_instance',
+        'ec2_bulk_start_instances', 'ec2_bulk_stop_instances',
         'ec2_list_instances', 'ec2_print_instance', 'ec2_login',
-        'ec2_rsync_download_dir', 'ec2_rsync_upload_dir'
+        'ec2_clear_inventory_cache', 'ec2_close_ssh_masters',
+        'ec2_distribute_hostsfile',
+        'ec2_rsync_download_dir', 'ec2_rsync_upload_dir',
+        'ec2_rsync_download_dir_many', 'ec2_rsync_upload_dir_many',
+        'ec2_rsync_upload_dir_sharded', 'ec2_transfer_dir',
+        'ec2_s3_distribute_dir', 'ec2_s3_pull_dir', 'ec2_s3_push_dir'
         ]
 
 
@@ -82,6 +125,288 @@ def ec2_rsync_upload_dir(local_dir, remote_dir, rsync_args='-av', noconfirm=Fals
             abort('Aborted')
     ec2_rsync_upload(**kwargs)
 
+@task
+def ec2_transfer_dir(destination, source_dir, destination_dir, method='rsync',
+                     rsync_args='-av', noconfirm=False):
+    """
+    Copy ``source_dir`` on the EC2 instance into ``destination_dir`` on the
+    ``destination`` EC2 instance, directly between the instances (see
+    :func:`awsfabrictasks.ec2.api.ec2_transfer_command`). E.g.: if
+    ``source_dir`` is ``/var/data``, and ``destination_dir`` is ``/srv``,
+    ``/srv/data`` will be created on ``destination``.
+
+    :param destination: Name of the destination instance, with optional region (see
+        :meth:`awsfabrictasks.ec2.api.Ec2InstanceWrapper.get_by_nametag`).
+    :param source_dir: The directory to copy from the EC2 instance.
+    :param destination_dir: The directory on ``destination`` to copy source_dir into.
+    :param method: ``rsync`` or ``tar``. Defaults to ``rsync``.
+    :param rsync_args: Arguments for ``rsync``. Defaults to ``-av``.
+    :param noconfirm:
+        If this is ``True``, we will not ask for confirmation before
+        proceeding with the operation. Defaults to ``False``.
+    """
+    source = Ec2InstanceWrapper.get_from_host_string()
+    destination = Ec2InstanceWrapper.get_by_nametag(destination)
+    try:
+        command = ec2_transfer_command(source, destination, source_dir, destination_dir,
+                                       method=method, rsync_args=rsync_args)
+    except ValueError, e:
+        abort(str(e))
+    if not parse_bool(noconfirm):
+        print 'Are you sure you want to run:'
+        print '   ', command
+        if not confirm('Proceed?'):
+            abort('Aborted')
+    local(command)
+
+def _run_local_commands_many(commands, concurrency, failmessage, capture=False):
+    results = run_local_commands(commands, concurrency, capture=capture)
+    print
+    print format_local_command_results(results)
+    if [result for result in results if not result.is_ok()]:
+        abort(failmessage)
+    return results
+
+def _run_rsync_many(commands, noconfirm, concurrency):
+    if not parse_bool(noconfirm):
+        print 'Are you sure you want to run:'
+        for label, command in commands:
+            print '   ', command
+        if not confirm('Proceed?'):
+            abort('Aborted')
+    concurrency = int(concurrency or awsfab_settings.RSYNC_CONCURRENCY)
+    _run_local_commands_many(commands, concurrency, 'rsync failed on one or more hosts.')
+
+@task
+def ec2_rsync_upload_dir_sharded(local_dir, remote_dir, rsync_args='-av', shards=4,
+                                 noconfirm=False):
+    """
+    Like :func:`ec2_rsync_upload_dir`, but splits ``local_dir`` into
+    ``shards`` balanced parts (see
+    :func:`awsfabrictasks.ec2.api.get_rsync_shard_units`), and uploads the
+    parts using parallel rsync processes. This is a lot faster for very large
+    directory trees, where a single rsync spends most of its time building
+    and checking the file list. Prints the result of each rsync, and the sum
+    of their ``--stats``.
+
+    Do not use ``--delete`` in ``rsync_args``.
+
+    :param local_dir: The local directory to upload to the EC2 instance.
+    :param remote_dir: The remote directory to upload local_dir into.
+    :param rsync_args: Arguments for ``rsync``. Defaults to ``-av``.
+    :param shards: Max number of parallel rsync processes. Defaults to ``4``.
+    :param noconfirm:
+        If this is ``True``, we will not ask for confirmation before
+        proceeding with the operation. Defaults to ``False``.
+    """
+    instancewrapper = Ec2InstanceWrapper.get_from_host_string()
+    filelist_dir = mkdtemp(prefix='awsfab-shards-')
+    try:
+        shardcommands = ec2_rsync_upload_sharded_commands(instancewrapper, local_dir, remote_dir,
+                                                          filelist_dir, shards=int(shards),
+                                                          rsync_args=rsync_args)
+        commands = [('shard {0}/{1}'.format(index + 1, len(shardcommands)), command)
+                    for index, command in enumerate(shardcommands)]
+        if not parse_bool(noconfirm):
+            print 'Are you sure you want to run:'
+            for label, command in commands:
+                print '   ', command
+            if not confirm('Proceed?'):
+                abort('Aborted')
+        results = _run_local_commands_many(commands, len(commands),
+                                           'rsync failed for one or more shards.', capture=True)
+    finally:
+        rmtree(filelist_dir)
+    stats = merge_rsync_stats(parse_rsync_stats(result.output or '') for result in results)
+    print
+    print 'Total for all shards:'
+    for key in sorted(stats):
+        print '    {0}: {1}'.format(key, stats[key])
+
+@task
+@runs_once
+def ec2_s3_distribute_dir(bucketname, local_dir, remote_dir, s3prefix=None,
+                          expires=3600, concurrency=None, downloads=4,
+                          use_sudo=False, noconfirm=False, loglevel='INFO'):
+    """
+    Distribute ``local_dir`` to ``remote_dir`` on all the selected EC2
+    instances through S3. ``local_dir`` is uploaded once (synced using the
+    same method as :func:`awsfabrictasks.s3.tasks.s3_syncupload_dir`), and
+    all the instances download the files from S3 at the same time using
+    presigned URLs (the instances do not need AWS credentials), and verify
+    them using md5 checksums. Requires ``curl`` and ``md5sum`` on the
+    instances.
+
+    Unlike :func:`ec2_rsync_upload_dir`, the content of ``local_dir`` is
+    put directly into ``remote_dir``, and files are not deleted from
+    ``remote_dir``.
+
+    :param bucketname: Name of the S3 bucket to stage the files in.
+    :param local_dir: The local directory to distribute.
+    :param remote_dir: The directory on the instances to download the files into.
+        Use an absolute path, or a path starting with ``~/`` (expanded on the
+        instances).
+    :param s3prefix: The S3 prefix to stage the files in. Defaults to
+        ``awsfab-staging/<name of local_dir>``.
+    :param expires: Number of seconds the download URLs are valid.
+        Defaults to ``3600``.
+    :param concurrency: Number of instances downloading at the same time.
+        Defaults to ``awsfab_settings.RSYNC_CONCURRENCY``.
+    :param downloads: Number of concurrent downloads on each instance.
+        Defaults to ``4``.
+    :param use_sudo: Download the files as root? Defaults to ``False``.
+    :param noconfirm:
+        If this is ``True``, we will not ask for confirmation before
+        proceeding with the operation. Defaults to ``False``.
+    :param loglevel: Log level for the upload to S3. Defaults to "INFO".
+    """
+    log = configureStreamLoggerForTask(__name__, 'ec2_s3_distribute_dir',
+                                       getLoglevelFromString(loglevel))
+    local_dir = abspath(expanduser(local_dir))
+    s3prefix = s3prefix or 'awsfab-staging/' + basename(local_dir)
+    instancewrappers = _get_selected_instancewrappers(reachable=True)
+    bucket = S3ConnectionWrapper.get_bucket_using_pattern(bucketname)
+    if not parse_bool(noconfirm):
+        print 'Are you sure you want to upload {0} to {1}:{2}, and download it into {3} on:'.format(
+            local_dir, bucket.name, s3prefix, remote_dir)
+        for instancewrapper in instancewrappers:
+            print '   ', instancewrapper.prettyname()
+        if not confirm('Proceed?'):
+            abort('Aborted')
+
+    stats = s3_syncupload(bucket, local_dir, s3prefix, log)
+    log.info('Upload summary:\n%s', stats.format_summary())
+    manifest = get_presigned_manifest(bucket, local_dir, s3prefix, int(expires))
+    scriptfile = NamedTemporaryFile(suffix='.sh')
+    scriptfile.write(s3_download_script(remote_dir, manifest, int(downloads)))
+    scriptfile.flush()
+    shell = parse_bool(use_sudo) and 'sudo sh -s' or 'sh -s'
+    commands = [(instancewrapper.prettyname(),
+                 '{0} < {1}'.format(ec2_ssh_command(instancewrapper, shell), scriptfile.name))
+                for instancewrapper in instancewrappers]
+    concurrency = int(concurrency or awsfab_settings.RSYNC_CONCURRENCY)
+    try:
+        _run_local_commands_many(commands, concurrency,
+                                 'Download or checksum verification failed on one or more hosts.')
+    finally:
+        scriptfile.close()
+
+@task
+def ec2_s3_pull_dir(bucketname, s3prefix, remote_dir, workers=8, expires=3600,
+                    use_sudo=False):
+    """
+    Download all the files in ``s3prefix`` into ``remote_dir`` on the EC2
+    instance. The files are transferred by :mod:`awsfabrictasks.s3.agent`,
+    running on the instance, so they go directly from S3 to the instance
+    instead of through the local host. The instance does not need AWS
+    credentials (the agent gets presigned URLs), but it needs python.
+
+    Files that exist in ``remote_dir`` with the same md5 checksum as on S3 are
+    not downloaded, and files are not deleted from ``remote_dir``.
+
+    :param bucketname: Name of the S3 bucket.
+    :param s3prefix: The S3 prefix to download.
+    :param remote_dir: The directory on the instance to download the files into.
+    :param workers: Number of concurrent downloads. Defaults to ``8``.
+    :param expires: Number of seconds the download URLs are valid.
+        Defaults to ``3600``.
+    :param use_sudo: Download the files as root? Defaults to ``False``.
+    """
+    bucket = S3ConnectionWrapper.get_bucket(bucketname)
+    files = get_presigned_download_files(bucket, s3prefix, expires_in=int(expires))
+    run_s3_agent(dict(action='download', directory=remote_dir, workers=int(workers),
+                      files=files),
+                 use_sudo=parse_bool(use_sudo))
+
+@task
+def ec2_s3_push_dir(bucketname, remote_dir, s3prefix, workers=8, expires=3600,
+                    use_sudo=False):
+    """
+    Upload all the files in ``remote_dir`` on the EC2 instance into
+    ``s3prefix``. Like :func:`ec2_s3_pull_dir`, the files are transferred
+    directly from the instance by :mod:`awsfabrictasks.s3.agent`.
+
+    The agent computes the md5 checksums of the files in ``remote_dir``
+    first, and only the files that are missing or have a different etag in
+    ``s3prefix`` are uploaded. Files are not deleted from ``s3prefix``. Each
+    file is uploaded with a single PUT request, so we abort before uploading
+    anything if a file to upload is larger than 5 GB.
+
+    :param bucketname: Name of the S3 bucket.
+    :param remote_dir: The directory on the instance to upload.
+    :param s3prefix: The S3 prefix to upload to.
+    :param workers: Number of concurrent uploads. Defaults to ``8``.
+    :param expires: Number of seconds the upload URLs are valid.
+        Defaults to ``3600``.
+    :param use_sudo: Read the files as root? Defaults to ``False``.
+    """
+    bucket = S3ConnectionWrapper.get_bucket(bucketname)
+    use_sudo = parse_bool(use_sudo)
+    output = run_s3_agent(dict(action='scan', directory=remote_dir, workers=int(workers)),
+                          use_sudo=use_sudo, quiet=True)
+    scanned = json.loads(output.splitlines()[-1])
+    try:
+        files = get_presigned_upload_files(bucket, s3prefix, scanned, expires_in=int(expires))
+    except ValueError, e:
+        abort(str(e))
+    print '{0} of {1} files are missing or changed in {2}.'.format(len(files), len(scanned),
+                                                                  s3prefix)
+    if files:
+        run_s3_agent(dict(action='upload', directory=remote_dir, workers=int(workers),
+                          files=files),
+                     use_sudo=use_sudo)
+
+@task
+@runs_once
+def ec2_rsync_download_dir_many(remote_dir, local_dir, rsync_args='-av',
+                                noconfirm=False, concurrency=None):
+    """
+    Like :func:`ec2_rsync_download_dir`, but downloads from all the selected
+    EC2 instances at the same time, into ``<local_dir>/<instance id>/``.
+    Asks for confirmation once, prints the output of each rsync prefixed by
+    the instance as it arrives, and ends with a table of the results.
+
+    :param remote_dir: The remote directory to download.
+    :param local_dir: The local directory.
+    :param rsync_args: Arguments for ``rsync``. Defaults to ``-av``.
+    :param noconfirm:
+        If this is ``True``, we will not ask for confirmation before
+        proceeding with the operation. Defaults to ``False``.
+    :param concurrency: Max number of rsync commands to run at the same
+        time. Defaults to ``awsfab_settings.RSYNC_CONCURRENCY``.
+    """
+    commands = [(instancewrapper.prettyname(),
+                 ec2_rsync_download_command(instancewrapper, remote_dir=remote_dir,
+                                            local_dir=join(local_dir, instancewrapper['id']),
+                                            rsync_args=rsync_args))
+                for instancewrapper in _get_selected_instancewrappers(reachable=True)]
+    _run_rsync_many(commands, noconfirm, concurrency)
+
+@task
+@runs_once
+def ec2_rsync_upload_dir_many(local_dir, remote_dir, rsync_args='-av',
+                              noconfirm=False, concurrency=None):
+    """
+    Like :func:`ec2_rsync_upload_dir`, but uploads to all the selected EC2
+    instances at the same time. Asks for confirmation once, prints the output
+    of each rsync prefixed by the instance as it arrives, and ends with a
+    table of the results.
+
+    :param local_dir: The local directory to upload to the EC2 instances.
+    :param remote_dir: The remote directory to upload local_dir into.
+    :param rsync_args: Arguments for ``rsync``. Defaults to ``-av``.
+    :param noconfirm:
+        If this is ``True``, we will not ask for confirmation before
+        proceeding with the operation. Defaults to ``False``.
+    :param concurrency: Max number of rsync commands to run at the same
+        time. Defaults to ``awsfab_settings.RSYNC_CONCURRENCY``.
+    """
+    commands = [(instancewrapper.prettyname(),
+                 ec2_rsync_upload_command(instancewrapper, local_dir=local_dir,
+                                          remote_dir=remote_dir, rsync_args=rsync_args))
+                for instancewrapper in _get_selected_instancewrappers(reachable=True)]
+    _run_rsync_many(commands, noconfirm, concurrency)
+
 @task
 def ec2_add_tag(tagname, value=''):
     """
@@ -95,6 +420,7 @@ def ec2_add_tag(tagname, value=''):
         prettyname = instancewrapper.prettyname()
         abort('{prettyname}: duplicate tag: {tagname}'.format(**vars()))
     instancewrapper.instance.add_tag(tagname, value)
+    ec2_inventory.invalidate()
 
 @task
 def ec2_set_tag(tagname, value=''):
@@ -106,6 +432,7 @@ def ec2_set_tag(tagname, value=''):
     """
     instancewrapper = Ec2InstanceWrapper.get_from_host_string()
     instancewrapper.instance.add_tag(tagname, value)
+    ec2_inventory.invalidate()
 
 @task
 def ec2_remove_tag(tagname):
@@ -119,11 +446,84 @@ def ec2_remove_tag(tagname):
         prettyname = instancewrapper.prettyname()
         abort('{prettyname} has no "{tagname}"-tag'.format(**vars()))
     instancewrapper.instance.remove_tag(tagname)
+    ec2_inventory.invalidate()
+
+
+
+def _get_selected_instancewrappers(reachable=False):
+    """
+    Get the :class:`Ec2InstanceWrapper` for all the instances selected with
+    ``--ec2names``, ``--ec2ids`` or ``--ec2tags``.
+
+    :param reachable: Abort if any of the instances has no address to SSH to
+        (see :meth:`Ec2InstanceWrapper.get_ssh_host`).
+    """
+    instancewrappers = Ec2InstanceWrapper.get_selected()
+    if not instancewrappers:
+        abort('No EC2 instances selected. Use --ec2names, --ec2ids or --ec2tags.')
+    if reachable:
+        _abort_if_any([instancewrapper for instancewrapper in instancewrappers
+                       if not instancewrapper.get_ssh_host()],
+                      'No address to SSH to (stopped instances?)')
+    return instancewrappers
+
+def _abort_if_any(instancewrappers, message):
+    if instancewrappers:
+        prettynames = ', '.join(instancewrapper.prettyname() for instancewrapper in instancewrappers)
+        abort('{message}: {prettynames}'.format(**vars()))
+
+@task
+@runs_once
+def ec2_bulk_add_tag(tagname, value=''):
+    """
+    Add tag to all the selected EC2 instances with one request per region.
+    Fails without changing any instance if any of them has the tag.
+
+    :param tagname: Name of the tag to set (required).
+    :param value: Value to set the tag to. Default to empty string.
+    """
+    instancewrappers = _get_selected_instancewrappers()
+    _abort_if_any([instancewrapper for instancewrapper in instancewrappers
+                   if tagname in instancewrapper['tags']],
+                  'Duplicate tag: {0}'.format(tagname))
+    bulk_create_tags(instancewrappers, {tagname: value})
+    print 'Added tag {0} to {1} instance(s).'.format(tagname, len(instancewrappers))
+
+@task
+@runs_once
+def ec2_bulk_set_tag(tagname, value=''):
+    """
+    Set tag on all the selected EC2 instances with one request per region.
+    Overwrites value if tag exists.
+
+    :param tagname: Name of the tag to set (required).
+    :param value: Value to set the tag to. Default to empty string.
+    """
+    instancewrappers = _get_selected_instancewrappers()
+    bulk_create_tags(instancewrappers, {tagname: value})
+    print 'Set tag {0} on {1} instance(s).'.format(tagname, len(instancewrappers))
+
+@task
+@runs_once
+def ec2_bulk_remove_tag(tagname):
+    """
+    Remove tag from all the selected EC2 instances with one request per
+    region. Fails without changing any instance if any of them does not have
+    the tag.
+
+    :param tagname: Name of the tag to remove (required).
+    """
+    instancewrappers = _get_selected_instancewrappers()
+    _abort_if_any([instancewrapper for instancewrapper in instancewrappers
+                   if not tagname in instancewrapper['tags']],
+                  'No "{0}"-tag'.format(tagname))
+    bulk_delete_tags(instancewrappers, [tagname])
+    print 'Removed tag {0} from {1} instance(s).'.format(tagname, len(instancewrappers))
 
 
 
 @task
-def ec2_launch_instance(name, configname=None):
+def ec2_launch_instance(name, configname=None, waitssh=True):
     """
     Launch new EC2 instance.
 
@@ -131,29 +531,38 @@ def ec2_launch_instance(name, configname=None):
     :param configname: Name of the configuration in
         ``awsfab_settings.EC2_LAUNCH_CONFIGS``. Prompts for input if not
         provided as an argument.
+    :param waitssh: Wait until the instance accepts SSH connections, not
+        just until it is running? Defaults to ``True``.
     """
     launcher = Ec2LaunchInstance(extra_tags={'Name': name}, configname=configname)
     launcher.confirm()
+    started = time()
     instance = launcher.run_instance()
-    wait_for_running_state(instance.id)
+    wait_until_usable(['{0}:{1}'.format(launcher.conf['region'], instance.id)],
+                      started=started, waitssh=parse_bool(waitssh))
 
 
 @task
-def ec2_start_instance(nowait=False):
+def ec2_start_instance(nowait=False, waitssh=True):
     """
     Start EC2 instance.
 
     :param nowait: Set to ``True`` to let the EC2 instance start in the
         background instead of waiting for it to start. Defaults to ``False``.
+    :param waitssh: Wait until the instance accepts SSH connections, not
+        just until it is running? Defaults to ``True``.
     """
     instancewrapper = Ec2InstanceWrapper.get_from_host_string()
+    started = time()
     instancewrapper.instance.start()
+    ec2_inventory.invalidate()
     if nowait:
         print ('Starting: {id}. This is an asynchronous operation. Use '
                 '``ec2_list_instances`` or the aws dashboard to check the status of '
                 'the operation.').format(id=instancewrapper['id'])
     else:
-        wait_for_running_state(instancewrapper['id'])
+        wait_until_usable([_get_instanceid_with_region(instancewrapper)],
+                          started=started, waitssh=parse_bool(waitssh))
 
 @task
 def ec2_stop_instance(nowait=False):
@@ -165,6 +574,7 @@ def ec2_stop_instance(nowait=False):
     """
     instancewrapper = Ec2InstanceWrapper.get_from_host_string()
     instancewrapper.instance.stop()
+    ec2_inventory.invalidate()
     if nowait:
         print ('Stopping: {id}. This is an asynchronous operation. Use '
                 '``ec2_list_instances`` or the aws dashboard to check the status of '
@@ -172,6 +582,55 @@ def ec2_stop_instance(nowait=False):
     else:
         wait_for_stopped_state(instancewrapper['id'])
 
+def _get_instanceid_with_region(instancewrapper):
+    return '{0}:{1}'.format(instancewrapper['region'].name, instancewrapper['id'])
+
+@task
+@runs_once
+def ec2_bulk_start_instances(nowait=False, waitssh=True):
+    """
+    Start all the selected EC2 instances with one request per region, and
+    wait for all of them together.
+
+    :param nowait: Set to ``True`` to let the EC2 instances start in the
+        background instead of waiting for them to start. Defaults to ``False``.
+    :param waitssh: Wait until the instances accept SSH connections, not
+        just until they are running? Defaults to ``True``.
+    """
+    instancewrappers = _get_selected_instancewrappers()
+    started = time()
+    bulk_start_instances(instancewrappers)
+    if parse_bool(nowait):
+        print ('Starting {count} instance(s). This is an asynchronous operation. Use '
+                '``ec2_list_instances`` or the aws dashboard to check the status of '
+                'the operation.').format(count=len(instancewrappers))
+    else:
+        wait_until_usable([_get_instanceid_with_region(instancewrapper)
+                           for instancewrapper in instancewrappers],
+                          started=started, waitssh=parse_bool(waitssh))
+
+@task
+@runs_once
+def ec2_bulk_stop_instances(nowait=False):
+    """
+    Stop all the selected EC2 instances with one request per region, and
+    wait for all of them together.
+
+    :param nowait: Set to ``True`` to let the EC2 instances stop in the
+        background instead of waiting for them to stop. Defaults to ``False``.
+    """
+    instancewrappers = _get_selected_instancewrappers()
+    started = time()
+    bulk_stop_instances(instancewrappers)
+    if parse_bool(nowait):
+        print ('Stopping {count} instance(s). This is an asynchronous operation. Use '
+                '``ec2_list_instances`` or the aws dashboard to check the status of '
+                'the operation.').format(count=len(instancewrappers))
+    else:
+        wait_for_state_many([_get_instanceid_with_region(instancewrapper)
+                             for instancewrapper in instancewrappers],
+                            'stopped', started=started)
+
 def _get_instanceident(instance):
     return 'id: {id}   (Name: {name})'.format(id=instance.id,
                                           name=instance.tags.get('Name', ''))
@@ -189,29 +648,104 @@ def ec2_print_instance(full=False):
     print_ec2_instance(instancewrapper.instance, full=full)
 
 @task
-def ec2_list_instances(region=awsfab_settings.DEFAULT_REGION, full=False):
+def ec2_list_instances(region=awsfab_settings.DEFAULT_REGION, full=False,
+                       state=None, tags=None, instance_type=None, vpc=None,
+                       output='default'):
     """
     List EC2 instances in a region (defaults to awsfab_settings.DEFAULT_REGION).
 
+    The filters are sent to AWS, and the instances are requested one page at
+    a time. With a single region, each page is printed as it arrives.
+
     :param region: The region to list instances in. Defaults to
-        ``awsfab_settings.DEFAULT_REGION.
+        ``awsfab_settings.DEFAULT_REGION``. Use ``all`` to list instances in
+        all regions, or separate region names with ``;`` to list instances in
+        some regions (E.g.: ``region="eu-west-1;us-east-1"``). Multiple
+        regions are queried concurrently, and failing regions are reported at
+        the end.
     :param full: Print all attributes, or just the most useful ones? Defaults
-        to ``False``.
+        to ``False``. Only used with ``output=default``.
+    :param state: Only list instances in this state (E.g.: ``running``).
+        Separate multiple states with ``;``.
+    :param tags: Only list instances with these tags. Separate multiple
+        ``tagname=value`` pairs with ``;`` (E.g.: ``tags="role=web;env=prod"``).
+    :param instance_type: Only list instances of this type. Separate multiple
+        types with ``;``.
+    :param vpc: Only list instances in this VPC. Separate multiple VPC IDs
+        with ``;``.
+    :param output: ``default``, ``compact`` (one line per instance) or
+        ``json`` (one JSON object per instance and line).
     """
-    conn = connect_to_region(region_name=region, **awsfab_settings.AUTH)
-
-    for reservation in conn.get_all_instances():
-        print
-        print 'id:', reservation.id
-        print '   owner_id:', reservation.owner_id
-        print '   groups:'
-        for group in reservation.groups:
-            print '      - {name} (id:{id})'.format(**group.__dict__)
-        print '   instances:'
+    if not output in ('default', 'compact', 'json'):
+        abort('Invalid output: {0}. Use default, compact or json.'.format(output))
+    full = parse_bool(full)
+    regionnames = parse_regionnames(region)
+    filters = get_instance_filters(state=state, tags=tags,
+                                   instance_type=instance_type, vpc=vpc)
+    if output == 'compact':
+        print _COMPACT_FORMAT.format(region='REGION', id='ID', state='STATE', type='TYPE',
+                                     ip='IP', private_ip='PRIVATE IP', name='NAME')
+    if len(regionnames) == 1:
+        regionname = regionnames[0]
+        for reservation in iter_reservations(get_ec2_connection(regionname), filters):
+            _print_reservation(reservation, full, output, regionname)
+        return
+
+    def get_reservations(regionname):
+        return list(iter_reservations(get_ec2_connection(regionname), filters))
+    results = map_regions(get_reservations, regionnames)
+    for regionname, reservations, error in results:
+        if output == 'default' and not error:
+            print
+            print '=' * 80
+            print 'Region:', regionname
+            print '=' * 80
+        for reservation in reservations or []:
+            _print_reservation(reservation, full, output, regionname)
+    _print_region_errors(results)
+
+_COMPACT_FORMAT = '{region:<15} {id:<20} {state:<14} {type:<12} {ip:<16} {private_ip:<16} {name}'
+
+def _print_reservation(reservation, full, output='default', regionname=None):
+    if output == 'compact':
+        for instance in reservation.instances:
+            print _COMPACT_FORMAT.format(region=regionname, id=instance.id,
+                                         state=instance.state, type=instance.instance_type,
+                                         ip=instance.ip_address or '-',
+                                         private_ip=instance.private_ip_address or '-',
+                                         name=instance.tags.get('Name', ''))
+        return
+    if output == 'json':
         for instance in reservation.instances:
-            attrnames = None
-            print '      -', _get_instanceident(instance)
-            print_ec2_instance(instance, full=full, indentspaces=11)
+            print json.dumps(instance_as_dict(instance, regionname), sort_keys=True)
+        return
+    print
+    print 'id:', reservation.id
+    print '   owner_id:', reservation.owner_id
+    print '   groups:'
+    for group in reservation.groups:
+        print '      - {name} (id:{id})'.format(**group.__dict__)
+    print '   instances:'
+    for instance in reservation.instances:
+        print '      -', _get_instanceident(instance)
+        print_ec2_instance(instance, full=full, indentspaces=11)
+
+def _print_region_errors(results):
+    failed = [(regionname, error) for regionname, result, error in results if error]
+    if failed:
+        print
+        print 'Failed regions:'
+        for regionname, error in failed:
+            print '   - {0}: {1}'.format(regionname, error)
+
+
+@task
+def ec2_clear_inventory_cache():
+    """
+    Remove all cached EC2 instance information for the current credentials
+    (see ``awsfab_settings.EC2_INVENTORY_CACHE_DIR``).
+    """
+    ec2_inventory.invalidate()
 
 
 @task
@@ -224,8 +758,60 @@ def ec2_login():
     if len(env.all_hosts) != 1:
         abort('ec2_login only works with exactly one host. Given hosts: {0}'.format(repr(env.all_hosts)))
     instancewrapper = Ec2InstanceWrapper.get_from_host_string()
-    host = instancewrapper.get_ssh_uri()
-    key_filename = instancewrapper.get_ssh_key_filename()
-    extra_ssh_args = awsfab_settings.EXTRA_SSH_ARGS
-    cmd = 'ssh -i {key_filename} {extra_ssh_args} {host}'.format(**vars())
-    local(cmd)
+    local(ec2_ssh_command(instancewrapper))
+
+
+@task
+@runs_once
+def ec2_distribute_hostsfile(concurrency=None, noconfirm=False):
+    """
+    Create a hosts-file for all the selected EC2 instances (see
+    :func:`awsfabrictasks.hostslist.create_hostsfile_from_ec2instancewrappers`),
+    and upload it to ``/etc/hosts`` on all of them, with many instances at
+    the same time. The file is only replaced on the instances where it is
+    not already up to date (see
+    :func:`awsfabrictasks.hostslist.distribute_hostsfile`).
+
+    The instances must allow passwordless ``sudo`` without a tty (no
+    ``requiretty`` in ``/etc/sudoers``). Use
+    :func:`awsfabrictasks.hostslist.upload_hostsfile` (with Fabric) for
+    instances that do not.
+
+    :param concurrency: Number of instances to update at the same time.
+        Defaults to ``awsfab_settings.RSYNC_CONCURRENCY``.
+    :param noconfirm:
+        If this is ``True``, we will not ask for confirmation before
+        proceeding with the operation. Defaults to ``False``.
+    """
+    instancewrappers = _get_selected_instancewrappers(reachable=True)
+    try:
+        hostsfile_string = create_hostsfile_from_ec2instancewrappers(instancewrappers)
+    except (ValueError, KeyError), e:
+        abort('Could not create the hosts-file: {0}'.format(e))
+    if not parse_bool(noconfirm):
+        print hostsfile_string
+        print 'Are you sure you want to upload the hosts-file above to {0} instance(s)?'.format(
+                len(instancewrappers))
+        if not confirm('Proceed?'):
+            abort('Aborted')
+    concurrency = int(concurrency or awsfab_settings.RSYNC_CONCURRENCY)
+    results = distribute_hostsfile(instancewrappers, hostsfile_string, concurrency)
+    print
+    print format_local_command_results(results)
+    updated = [result.label for result in results if hostsfile_was_updated(result)]
+    print 'Updated {0} of {1} hosts-files.'.format(len(updated), len(results))
+    if [result for result in results if not result.is_ok()]:
+        abort('Failed to update the hosts-file on one or more hosts.')
+
+@task
+@runs_once
+def ec2_close_ssh_masters():
+    """
+    Close all the SSH ControlMaster connections kept open when
+    ``awsfab_settings.SSH_CONTROLMASTER`` is enabled. Idle connections
+    close by themselves after ``awsfab_settings.SSH_CONTROLPERSIST``, so this
+    is only needed to close them right away (E.g.: before changing the
+    keys or network of an instance).
+    """
+    count = close_ssh_masters()
+    print 'Closed {0} SSH master connection(s).'.format(count)
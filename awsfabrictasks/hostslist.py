@@ -1,4 +1,10 @@
+from hashlib import md5
+from pipes import quote
+from tempfile import NamedTemporaryFile
+
 from awsfabrictasks.utils import sudo_upload_string_to_file
+from awsfabrictasks.utils import run_local_commands
+from awsfabrictasks.ec2.api import ec2_ssh_command
 
 hostsfile_template = """
 127.0.0.1 localhost
@@ -43,3 +49,61 @@ def create_hostsfile_from_ec2instancewrappers(instancewrappers):
 
 def upload_hostsfile(hostsfile_string):
     sudo_upload_string_to_file(hostsfile_string, '/etc/hosts')
+
+def get_hostsfile_update_command(hostsfile_string, remote_path='/etc/hosts', use_sudo=True):
+    """
+    Get a shell command that replaces ``remote_path`` with the data on stdin
+    (``hostsfile_string``) unless ``remote_path`` already has the same md5
+    checksum as ``hostsfile_string``. The command prints ``updated`` or
+    ``unchanged`` (see :func:`hostsfile_was_updated`).
+    """
+    checksum = md5(hostsfile_string).hexdigest()
+    tmppath = remote_path + '.awsfab-tmp'
+    replace = 'cat > {tmppath} && chmod 644 {tmppath} && mv {tmppath} {remote_path}'.format(
+            tmppath=quote(tmppath), remote_path=quote(remote_path))
+    if use_sudo:
+        replace = 'sudo sh -c {0}'.format(quote(replace))
+    return ('if echo {check} | md5sum -c --status 2>/dev/null; '
+            'then cat > /dev/null; echo unchanged; '
+            'else {replace} && echo updated; fi').format(
+                    check=quote('{0}  {1}'.format(checksum, remote_path)),
+                    replace=replace)
+
+def hostsfile_was_updated(result):
+    """
+    Returns ``True`` if the :class:`awsfabrictasks.utils.LocalCommandResult`
+    from :func:`distribute_hostsfile` says that the hosts file was updated.
+    """
+    return result.is_ok() and (result.output or '').split()[-1:] == ['updated']
+
+def distribute_hostsfile(instancewrappers, hostsfile_string, concurrency,
+                         remote_path='/etc/hosts'):
+    """
+    Upload ``hostsfile_string`` to ``remote_path`` on all the given
+    :class:`awsfabrictasks.ec2.api.Ec2InstanceWrapper` objects, with at
+    most ``concurrency`` hosts at the same time. Each host is handled with a
+    single ``ssh`` command (see :func:`get_hostsfile_update_command`), and
+    the file is only replaced on hosts where it differs.
+
+    The ``ssh`` commands do not allocate a tty (the file is piped to them
+    on stdin), so ``sudo`` must work without a password and without a tty
+    (no ``requiretty`` in ``/etc/sudoers``) on all the hosts. Use
+    :func:`upload_hostsfile` with Fabric for hosts where it does not.
+
+    :return:
+        List of :class:`awsfabrictasks.utils.LocalCommandResult` objects,
+        labeled with the prettyname of each instance. Use
+        :func:`hostsfile_was_updated` to check if the file was replaced.
+    """
+    remote_command = get_hostsfile_update_command(hostsfile_string, remote_path)
+    tmpfile = NamedTemporaryFile()
+    try:
+        tmpfile.write(hostsfile_string)
+        tmpfile.flush()
+        commands = [(instancewrapper.prettyname(),
+                     '{0} < {1}'.format(ec2_ssh_command(instancewrapper, quote(remote_command)),
+                                        tmpfile.name))
+                    for instancewrapper in instancewrappers]
+        return run_local_commands(commands, concurrency, capture=True)
+    finally:
+        tmpfile.close()
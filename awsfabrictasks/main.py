@@ -1,7 +1,7 @@
 from os.path import join
 from fabric import tasks
 
-from .ec2.api import Ec2InstanceWrapper
+from .ec2.api import Ec2InstanceResolver
 
 
 def _splitnames(names):
@@ -13,24 +13,19 @@ def _splitnames(names):
 def get_hosts_supporting_aws(self, arg_hosts, arg_roles, arg_exclude_hosts, env=None):
     hosts = tasks.Task.get_hosts(self, arg_hosts, arg_roles, arg_exclude_hosts, env)
 
-    ids = _splitnames(env.ec2ids)
-    for instanceid in ids:
-        instance = Ec2InstanceWrapper.get_by_instanceid(instanceid)
-        instance.add_instance_to_env()
-        hosts.append(instance.get_ssh_uri())
-
-    names = _splitnames(env.ec2names)
-    for name in names:
-        instance = Ec2InstanceWrapper.get_by_nametag(name)
-        instance.add_instance_to_env()
-        hosts.append(instance.get_ssh_uri())
-
+    resolver = Ec2InstanceResolver()
+    for instanceid in _splitnames(env.ec2ids):
+        resolver.add_instanceid(instanceid)
+    for name in _splitnames(env.ec2names):
+        resolver.add_name(name)
     tvps = env.ec2tags
     tvps = tvps and tvps.split(',') or []
     if tvps:
         tvps = dict((tvp.split('=') for tvp in tvps))
-        instances = Ec2InstanceWrapper.get_by_tagvalue(tvps)
-        for instance in instances:
+        resolver.add_tags(tvps)
+
+    for instancewrappers in resolver.resolve():
+        for instance in instancewrappers:
             instance.add_instance_to_env()
             hosts.append(instance.get_ssh_uri())
 
@@ -2,6 +2,7 @@ from pprint import pformat
 from boto.rds import connect_to_region
 
 from awsfabrictasks.conf import awsfab_settings
+from awsfabrictasks.connections import connection_registry
 
 
 class RdsRegionConnectionError(Exception):
@@ -38,13 +39,15 @@ class RdsInstanceWrapper(object):
     @classmethod
     def get_connection(cls, region=None):
         """
-        Connect to the given region, and return the connection.
+        Connect to the given region, and return the connection. The
+        connection is shared by the entire process (see
+        :class:`awsfabrictasks.connections.ConnectionRegistry`).
 
         :param region:
             Defaults to ``awsfab_settings.DEFAULT_REGION`` if ``None``.
         """
         region = region is None and awsfab_settings.DEFAULT_REGION or region
-        connection = connect_to_region(region_name=region, **awsfab_settings.AUTH)
+        connection = connection_registry.get('rds', region, connect_to_region)
         if not connection:
             raise RdsRegionConnectionError(region)
         return connection
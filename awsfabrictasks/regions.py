@@ -1,7 +1,10 @@
 from fabric.api import task
-from boto.ec2 import regions, connect_to_region
+from boto.ec2 import regions
 
 from conf import awsfab_settings
+from awsfabrictasks.ec2.api import parse_regionnames
+from awsfabrictasks.ec2.api import map_regions
+from awsfabrictasks.ec2.api import get_ec2_connection
 
 
 
@@ -19,9 +22,21 @@ def list_zones(region=awsfab_settings.DEFAULT_REGION):
     """
     List zones in the given region.
 
-    :param region: Defaults to ``awsfab_settings.DEFAULT_REGION``.
+    :param region: Defaults to ``awsfab_settings.DEFAULT_REGION``. Use
+        ``all`` to list zones in all regions, or separate region names with
+        ``;`` (E.g.: ``region="eu-west-1;us-east-1"``). Multiple regions are
+        queried concurrently, and failing regions are reported at the end.
     """
-    connection = connect_to_region(region_name=region, **awsfab_settings.AUTH)
-    print 'Zones in {region}:'.format(region=region)
-    for zone in connection.get_all_zones():
-        print '- {name} (state:{state})'.format(**zone.__dict__)
+    regionnames = parse_regionnames(region)
+    def get_zones(regionname):
+        return get_ec2_connection(regionname).get_all_zones()
+    results = map_regions(get_zones, regionnames)
+    for regionname, zones, error in results:
+        if error:
+            continue
+        print 'Zones in {region}:'.format(region=regionname)
+        for zone in zones:
+            print '- {name} (state:{state})'.format(**zone.__dict__)
+    failed = [(regionname, error) for regionname, zones, error in results if error]
+    for regionname, error in failed:
+        print 'Failed to list zones in {0}: {1}'.format(regionname, error)
@@ -0,0 +1,274 @@
+"""
+Transfer agent for moving files between S3 and an EC2 instance on the
+instance itself (used by :func:`awsfabrictasks.ec2.api.run_s3_agent`).
+
+This module is copied to the instance and run with whatever python is
+available there, so it must only use the standard library, and work with
+both python 2 (2.6+) and python 3. It does not need AWS credentials: all the
+transfers use presigned URLs.
+
+Usage::
+
+    python agent.py <jobfile>
+
+The jobfile is a JSON object with the following attributes:
+
+    action
+        ``download``, ``upload`` or ``scan``.
+    directory
+        The directory on the instance.
+    workers
+        Number of concurrent transfers (or checksum computations).
+    files
+        List of ``{"path": ..., "url": ..., "md5": ...}`` objects for
+        ``download`` and ``upload``. ``path`` is relative to ``directory``.
+        ``md5`` is optional for ``download``, and is not used for ``upload``.
+
+``download`` and ``upload`` print one progress line per file, and a summary,
+and exit with status ``1`` if any file failed. ``download`` skips files that
+exist with the expected ``md5``, and verifies the ``md5`` of downloaded
+files. ``upload`` verifies the ETag returned by S3, and fails files larger
+than :obj:`MAX_UPLOAD_SIZE` without sending them. ``scan`` prints a JSON
+object mapping the path of each file in ``directory`` to a
+``{"md5": ..., "size": ...}`` object.
+"""
+import sys
+import os
+import json
+import threading
+from hashlib import md5
+from time import time
+try:
+    from http.client import HTTPConnection, HTTPSConnection
+    from urllib.parse import urlsplit
+    from queue import Queue, Empty
+except ImportError:
+    from httplib import HTTPConnection, HTTPSConnection
+    from urlparse import urlsplit
+    from Queue import Queue, Empty
+
+
+CHUNKSIZE = 64 * 1024
+
+#: Content-Type of uploaded files. Must match the header used when signing
+#: the upload URLs.
+UPLOAD_CONTENT_TYPE = 'application/octet-stream'
+
+#: The largest object S3 accepts in a single PUT request (5 GB).
+MAX_UPLOAD_SIZE = 5 * 1024 * 1024 * 1024
+
+
+class TransferError(Exception):
+    pass
+
+
+def compute_md5(filename):
+    checksum = md5()
+    fp = open(filename, 'rb')
+    try:
+        while True:
+            data = fp.read(CHUNKSIZE)
+            if not data:
+                break
+            checksum.update(data)
+    finally:
+        fp.close()
+    return checksum.hexdigest()
+
+
+def open_url(method, url, body=None, headers=None):
+    parts = urlsplit(url)
+    if parts.scheme == 'https':
+        connection = HTTPSConnection(parts.netloc)
+    else:
+        connection = HTTPConnection(parts.netloc)
+    path = parts.path
+    if parts.query:
+        path += '?' + parts.query
+    connection.request(method, path, body, headers or {})
+    response = connection.getresponse()
+    if response.status >= 300:
+        raise TransferError('{0} failed with HTTP status {1} {2}'.format(
+            method, response.status, response.reason))
+    return response
+
+
+def download(directory, fileinfo):
+    """
+    Download a file unless it exists with the expected md5.
+
+    :return: ``(status, bytes)``.
+    """
+    filename = os.path.join(directory, fileinfo['path'])
+    expected_md5 = fileinfo.get('md5')
+    if expected_md5 and os.path.exists(filename) and compute_md5(filename) == expected_md5:
+        return 'skipped', 0
+    dirpath = os.path.dirname(filename)
+    if not os.path.exists(dirpath):
+        try:
+            os.makedirs(dirpath)
+        except OSError:
+            # Created by another worker
+            if not os.path.isdir(dirpath):
+                raise
+    partfile = filename + '.awsfab-part'
+    response = open_url('GET', fileinfo['url'])
+    checksum = md5()
+    size = 0
+    fp = open(partfile, 'wb')
+    try:
+        while True:
+            data = response.read(CHUNKSIZE)
+            if not data:
+                break
+            checksum.update(data)
+            fp.write(data)
+            size += len(data)
+    finally:
+        fp.close()
+    if expected_md5 and checksum.hexdigest() != expected_md5:
+        os.remove(partfile)
+        raise TransferError('md5 mismatch: expected {0}, got {1}'.format(
+            expected_md5, checksum.hexdigest()))
+    os.rename(partfile, filename)
+    return 'downloaded', size
+
+
+def upload(directory, fileinfo):
+    """
+    Upload a file with a presigned PUT URL, and verify the returned ETag.
+
+    :return: ``(status, bytes)``.
+    """
+    filename = os.path.join(directory, fileinfo['path'])
+    size = os.path.getsize(filename)
+    if size > MAX_UPLOAD_SIZE:
+        raise TransferError('{0} bytes is more than S3 accepts in a single PUT ({1} bytes)'.format(
+            size, MAX_UPLOAD_SIZE))
+    fp = open(filename, 'rb')
+    try:
+        response = open_url('PUT', fileinfo['url'], fp,
+                            {'Content-Length': str(size),
+                             'Content-Type': UPLOAD_CONTENT_TYPE})
+    finally:
+        fp.close()
+    etag = (response.getheader('ETag') or '').strip('"')
+    local_md5 = compute_md5(filename)
+    if etag and etag != local_md5:
+        raise TransferError('ETag mismatch: expected {0}, got {1}'.format(local_md5, etag))
+    return 'uploaded', size
+
+
+def scan(directory):
+    """
+    Get the paths of all the files in ``directory``, relative to
+    ``directory``, and ``/``-separated.
+    """
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(dirpath, filename), directory)
+            paths.append(path.replace(os.sep, '/'))
+    return sorted(paths)
+
+
+def scan_files(directory, workers):
+    """
+    Get the md5 checksum and size of all the files in ``directory`` (see
+    :func:`scan`), computing the checksums with ``workers`` threads.
+
+    :return: Dict mapping paths to ``{"md5": ..., "size": ...}`` dicts.
+    """
+    def get_fileinfo(path):
+        filename = os.path.join(directory, path)
+        return {'md5': compute_md5(filename), 'size': os.path.getsize(filename)}
+    result = {}
+    for path, fileinfo, error in run_workers(get_fileinfo, scan(directory), workers):
+        if error is not None:
+            raise error
+        result[path] = fileinfo
+    return result
+
+
+def run_workers(func, items, workers):
+    """
+    Call ``func(item)`` for all ``items`` using ``workers`` threads, and yield
+    ``(item, result, error)`` as they complete. ``error`` is ``None`` unless
+    ``func`` raised an exception.
+    """
+    tasks = Queue()
+    results = Queue()
+    for item in items:
+        tasks.put(item)
+    def work():
+        while True:
+            try:
+                item = tasks.get_nowait()
+            except Empty:
+                return
+            try:
+                results.put((item, func(item), None))
+            except Exception:
+                results.put((item, None, sys.exc_info()[1]))
+    threads = [threading.Thread(target=work) for index in range(max(1, min(workers, len(items))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for index in range(len(items)):
+        yield results.get()
+    for thread in threads:
+        thread.join()
+
+
+def transfer(job, out):
+    """
+    Run a ``download`` or ``upload`` job, and write progress to ``out``.
+
+    :return: The number of failed files.
+    """
+    directory = job['directory']
+    files = job['files']
+    func = {'download': download, 'upload': upload}[job['action']]
+    started = time()
+    totalbytes = 0
+    counts = {}
+    results = run_workers(lambda fileinfo: func(directory, fileinfo), files, job['workers'])
+    for index, (fileinfo, result, error) in enumerate(results):
+        if error is None:
+            status, nbytes = result
+            totalbytes += nbytes
+            message = '{0} ({1} bytes)'.format(status, nbytes)
+        else:
+            status = 'failed'
+            message = 'FAILED: {0}'.format(error)
+        counts[status] = counts.get(status, 0) + 1
+        out.write('[{0}/{1}] {2}: {3}\n'.format(index + 1, len(files), fileinfo['path'], message))
+        out.flush()
+    elapsed = time() - started
+    out.write('{0}: {1} files, {2} bytes in {3:.1f}s ({4:.0f} bytes/s).\n'.format(
+        ', '.join('{0} {1}'.format(status, count) for status, count in sorted(counts.items())) or 'nothing to do',
+        len(files), totalbytes, elapsed, totalbytes / max(elapsed, 0.001)))
+    out.flush()
+    return counts.get('failed', 0)
+
+
+def main(args):
+    if len(args) != 1:
+        sys.stderr.write('Usage: agent.py <jobfile>\n')
+        return 2
+    fp = open(args[0])
+    try:
+        job = json.load(fp)
+    finally:
+        fp.close()
+    if job['action'] == 'scan':
+        sys.stdout.write(json.dumps(scan_files(job['directory'], job['workers'])) + '\n')
+        return 0
+    failed = transfer(job, sys.stdout)
+    if failed:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,7 +1,15 @@
 #from pprint import pformat
+import sys
 from fnmatch import fnmatchcase
 from os import walk, makedirs
-from os.path import join, abspath, exists, dirname
+from os.path import join, abspath, exists, dirname, getsize
+from itertools import chain
+from StringIO import StringIO
+from threading import Lock
+from time import time, sleep
+from contextlib import contextmanager
+from bisect import bisect_right
+import json
 from boto.s3.connection import S3Connection
 from boto.s3.prefix import Prefix
 from boto.s3.key import Key
@@ -11,6 +19,13 @@ from awsfabrictasks.utils import localpath_to_slashpath
 from awsfabrictasks.utils import slashpath_to_localpath
 from awsfabrictasks.conf import awsfab_settings
 from awsfabrictasks.utils import compute_localfile_md5sum
+from awsfabrictasks.utils import WorkerPool
+from awsfabrictasks.utils import parallel_map
+
+
+#: The smallest part size S3 accepts for all but the last part of a multipart
+#: upload.
+S3_MIN_PARTSIZE = 5 * 1024 * 1024
 
 
 class S3ConnectionError(Exception):
@@ -21,6 +36,277 @@ class S3ConnectionError(Exception):
         super(S3ConnectionError, self).__init__(msg)
 
 
+class TokenBucket(object):
+    """
+    A thread-safe token bucket that limits consumption to ``rate`` tokens per
+    second, with bursts of up to ``capacity`` tokens.
+
+    Consumers that take more tokens than available put the bucket in debt,
+    and sleep (outside the lock) until the debt is paid back. Concurrent
+    consumers therefore queue up behind each other, and the bucket is kept
+    busy right up to the rate.
+    """
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: Tokens added to the bucket per second.
+        :param capacity: Max number of tokens in the bucket. Defaults to ``rate``.
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.timestamp = time()
+        self.lock = Lock()
+
+    def consume(self, amount):
+        """
+        Take ``amount`` tokens from the bucket, sleeping as long as required
+        to stay within the rate.
+        """
+        with self.lock:
+            now = time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            sleep(wait)
+
+
+class TransferGovernor(object):
+    """
+    Limits the bandwidth and the request rate of all S3 transfers in the
+    process, and counts bytes and requests. All the transfer methods of
+    :class:`S3File` report to the governor returned by
+    :func:`get_transfer_governor`, so the limits are shared between all
+    worker threads.
+
+    :ivar bytes_transferred: Number of bytes sent or received so far.
+    :ivar request_count: Number of requests made so far.
+    """
+    def __init__(self, max_bandwidth=None, max_requests_per_sec=None):
+        """
+        :param max_bandwidth: Max bytes per second. ``None`` means no limit.
+        :param max_requests_per_sec: Max requests per second. ``None`` means no limit.
+        """
+        self.max_bandwidth = max_bandwidth
+        self.max_requests_per_sec = max_requests_per_sec
+        self.bandwidth_bucket = max_bandwidth and TokenBucket(max_bandwidth)
+        self.request_bucket = max_requests_per_sec and TokenBucket(max_requests_per_sec)
+        self.bytes_transferred = 0
+        self.request_count = 0
+        self.started = time()
+        self._lock = Lock()
+
+    def request(self):
+        """
+        Register a request. Blocks if we are above the request rate.
+        """
+        with self._lock:
+            self.request_count += 1
+        if self.request_bucket:
+            self.request_bucket.consume(1)
+
+    def transfer(self, nbytes):
+        """
+        Register ``nbytes`` sent or received. Blocks if we are above the
+        bandwidth limit.
+        """
+        with self._lock:
+            self.bytes_transferred += nbytes
+        if self.bandwidth_bucket:
+            self.bandwidth_bucket.consume(nbytes)
+
+    def get_progress_callback(self):
+        """
+        Get a callback suitable as the ``cb`` argument for the boto transfer
+        methods (use it with ``num_cb=-1`` to get a callback for each
+        buffer). Each transfer needs its own callback.
+        """
+        state = {'transmitted': 0}
+        def callback(transmitted, total):
+            delta = transmitted - state['transmitted']
+            state['transmitted'] = transmitted
+            if delta > 0:
+                self.transfer(delta)
+        return callback
+
+    def get_bytes_per_sec(self):
+        """
+        Get the average number of bytes per second since the governor was created.
+        """
+        elapsed = max(time() - self.started, 0.001)
+        return self.bytes_transferred / elapsed
+
+    def __str__(self):
+        return ('{bytes_transferred} bytes in {request_count} requests '
+                '({rate:.0f} bytes/sec)').format(rate=self.get_bytes_per_sec(),
+                                                 **self.__dict__)
+
+_transfer_governor = None
+
+def get_transfer_governor():
+    """
+    Get the process-wide :class:`TransferGovernor`. Created on the first call,
+    using ``awsfab_settings.S3_MAX_BANDWIDTH`` and
+    ``awsfab_settings.S3_MAX_REQUESTS_PER_SEC`` as limits, unless
+    :func:`configure_transfer_governor` has been called.
+    """
+    global _transfer_governor
+    if _transfer_governor is None:
+        configure_transfer_governor(awsfab_settings.S3_MAX_BANDWIDTH,
+                                    awsfab_settings.S3_MAX_REQUESTS_PER_SEC)
+    return _transfer_governor
+
+def configure_transfer_governor(max_bandwidth=None, max_requests_per_sec=None):
+    """
+    Replace the process-wide :class:`TransferGovernor` with a new one using
+    the given limits (see :class:`TransferGovernor`). Should be called before
+    any transfers are started.
+
+    :return: The new governor.
+    """
+    global _transfer_governor
+    _transfer_governor = TransferGovernor(max_bandwidth, max_requests_per_sec)
+    return _transfer_governor
+
+
+class TransferStats(object):
+    """
+    Collects performance numbers for a transfer task: time spent in each
+    phase, request and byte counts, and latency histograms for each operation
+    type. Thread-safe.
+
+    Example::
+
+        stats = TransferStats()
+        with stats.phase('transfer'):
+            with stats.timed('upload', nbytes=getsize(localfile)):
+                s3file.set_contents_from_filename(localfile)
+        print stats.format_summary()
+    """
+
+    #: Upper bounds (in seconds) of the latency histogram buckets. Latencies
+    #: above the last bound are counted in an extra bucket.
+    latency_buckets = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    #: The operation types that transfer data. Only the bytes of these are
+    #: included in ``total_bytes`` and ``bytes_per_sec`` in
+    #: :meth:`.as_dict` (E.g.: the bytes of ``hash`` operations are read
+    #: from the local disk, not transferred).
+    transfer_optypes = ('upload', 'download', 'copy')
+
+    def __init__(self):
+        self.started = time()
+        self.phases = {}
+        self.operations = {}
+        self._lock = Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Context manager that adds the time spent in the block to the phase
+        named ``name``. A phase may be entered any number of times.
+        """
+        start = time()
+        try:
+            yield
+        finally:
+            elapsed = time() - start
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    @contextmanager
+    def timed(self, optype, nbytes=0):
+        """
+        Context manager that records the block as one operation of type
+        ``optype`` (E.g.: ``upload``) transferring ``nbytes`` bytes.
+        Operations that raise an exception are counted as errors.
+        """
+        start = time()
+        try:
+            yield
+        except Exception:
+            self.record(optype, time() - start, error=True)
+            raise
+        else:
+            self.record(optype, time() - start, nbytes)
+
+    def record(self, optype, seconds, nbytes=0, error=False):
+        """
+        Record one operation of type ``optype`` that took ``seconds`` and
+        transferred ``nbytes``.
+        """
+        with self._lock:
+            if optype not in self.operations:
+                self.operations[optype] = {
+                    'count': 0, 'errors': 0, 'bytes': 0, 'seconds': 0,
+                    'histogram': [0] * (len(self.latency_buckets) + 1)}
+            op = self.operations[optype]
+            op['count'] += 1
+            op['seconds'] += seconds
+            op['bytes'] += nbytes
+            if error:
+                op['errors'] += 1
+            op['histogram'][bisect_right(self.latency_buckets, seconds)] += 1
+
+    def get_peak_memory(self):
+        """
+        Get the peak resident memory usage of the process (``ru_maxrss``,
+        which is kilobytes on Linux and bytes on Mac OS X), or ``None`` if
+        not available on this platform.
+        """
+        try:
+            from resource import getrusage, RUSAGE_SELF
+        except ImportError:
+            return None
+        return getrusage(RUSAGE_SELF).ru_maxrss
+
+    def as_dict(self):
+        """
+        Get the stats as a JSON serializable dict.
+        """
+        with self._lock:
+            elapsed = time() - self.started
+            totalbytes = sum(op['bytes'] for optype, op in self.operations.iteritems()
+                             if optype in self.transfer_optypes)
+            return {'elapsed_seconds': elapsed,
+                    'phases': dict(self.phases),
+                    'operations': dict((optype, dict(op)) for optype, op in self.operations.iteritems()),
+                    'latency_buckets': self.latency_buckets,
+                    'total_bytes': totalbytes,
+                    'bytes_per_sec': totalbytes / max(elapsed, 0.001),
+                    'requests': get_transfer_governor().request_count,
+                    'peak_memory': self.get_peak_memory()}
+
+    def format_summary(self):
+        """
+        Format the stats as a human readable multi-line string.
+        """
+        stats = self.as_dict()
+        lines = ['Elapsed: {elapsed_seconds:.2f}s, {total_bytes} bytes transferred '
+                 '({bytes_per_sec:.0f} bytes/sec), {requests} requests, '
+                 'peak memory: {peak_memory}'.format(**stats)]
+        for name, seconds in sorted(stats['phases'].iteritems()):
+            lines.append('   phase {0:<16} {1:>10.2f}s'.format(name, seconds))
+        labels = ['<{0}s'.format(bound) for bound in self.latency_buckets]
+        labels.append('>={0}s'.format(self.latency_buckets[-1]))
+        for optype, op in sorted(stats['operations'].iteritems()):
+            average = op['seconds'] / max(op['count'], 1)
+            lines.append('   {optype:<22} {count:>6} ops {errors:>4} errors {bytes:>14} bytes '
+                         'avg {average:.3f}s'.format(optype=optype, average=average, **op))
+            histogram = ', '.join('{0}: {1}'.format(label, count)
+                                  for label, count in zip(labels, op['histogram']) if count)
+            lines.append('      latency: {0}'.format(histogram))
+        return '\n'.join(lines)
+
+    def write_json(self, filename):
+        """
+        Write :meth:`.as_dict` to ``filename`` as JSON.
+        """
+        with open(filename, 'w') as fp:
+            json.dump(self.as_dict(), fp, indent=2, sort_keys=True)
+
+
 def settingsformat_bucketname(bucketname):
     """
     Returns ``awsfab_settings.S3_BUCKET_PATTERN.format(bucketname=bucketname)``.
@@ -116,6 +402,46 @@ def iter_bucketcontents(bucket, prefix, match, delimiter, formatter=lambda key:
             yield formatter(key)
 
 
+def iter_stream_chunks(fp, chunksize):
+    """
+    Read ``fp`` in chunks of ``chunksize`` bytes until EOF, yielding each
+    chunk. Every chunk except the last is exactly ``chunksize`` bytes long
+    (``fp.read()`` blocks until it has enough data on pipes).
+
+    :param fp: A file-like object, such as ``sys.stdin``.
+    """
+    while True:
+        data = fp.read(chunksize)
+        if not data:
+            break
+        yield data
+
+
+def s3_delete_many(bucket, names):
+    """
+    Delete the keys named ``names`` from ``bucket`` using S3 multi-object
+    delete requests (up to 1000 keys per request).
+
+    :return: ``(deleted, errors)`` tuple. ``deleted`` is the list of the
+        names that were deleted, and ``errors`` is a list of
+        ``(keyname, errormessage)`` tuples for the keys that could not be
+        deleted.
+    """
+    names = list(names)
+    governor = get_transfer_governor()
+    for index in xrange(0, len(names), 1000):
+        governor.request()
+    if not names:
+        return [], []
+    result = bucket.delete_keys(names, quiet=True)
+    errors = [(error.key, '{0}: {1}'.format(error.code, error.message))
+              for error in result.errors]
+    # Quiet mode only reports the errors.
+    failed = set(keyname for keyname, errormessage in errors)
+    deleted = [name for name in names if name not in failed]
+    return deleted, errors
+
+
 def dirlist_absfilenames(dirpath):
     """
     Get all the files within the given ``dirpath`` as a set of absolute
@@ -132,11 +458,107 @@ def s3list_s3filedict(bucket, prefix):
     Get all the keys with the given ``prefix`` as a dict with key-name as key
     and the key-object wrappen in a :class:`S3File` as value.
     """
+    governor = get_transfer_governor()
     result = {}
-    for key in bucket.list(prefix=prefix):
+    for index, key in enumerate(bucket.list(prefix=prefix)):
+        if index % 1000 == 0:
+            # S3 lists at most 1000 keys per request
+            governor.request()
         result[key.name] = S3File(bucket, key)
     return result
 
+def covering_prefixes(keynames):
+    """
+    Get the smallest set of "directory" prefixes that, when listed, include
+    all the given ``keynames``. Keys in the root of the bucket gives the
+    empty prefix, which covers the entire bucket.
+
+    Example::
+    >>> covering_prefixes(['a/b/c.txt', 'a/d.txt', 'x/y.txt'])
+    ['a/', 'x/']
+    """
+    prefixes = sorted(set(keyname[:keyname.rfind('/') + 1] for keyname in keynames))
+    result = []
+    for prefix in prefixes:
+        if result and prefix.startswith(result[-1]):
+            continue
+        result.append(prefix)
+    return result
+
+def s3list_s3filedict_many(bucket, prefixes, workers):
+    """
+    Like :func:`s3list_s3filedict`, but list all the given ``prefixes``,
+    using ``workers`` concurrent listings, and merge the results into a
+    single dict.
+    """
+    result = {}
+    for s3filedict in parallel_map(lambda prefix: s3list_s3filedict(bucket, prefix),
+                                   prefixes, workers):
+        result.update(s3filedict)
+    return result
+
+def compare_localfiles_to_s3(bucket, pairs, workers):
+    """
+    Check if many local files are the same as their corresponding files on S3,
+    using the same method as :meth:`S3File.etag_matches_localfile`. All the
+    etags are retrieved with one listing of each of the
+    :func:`covering_prefixes` of the keys (instead of one HEAD request per
+    key), and the local files are hashed in parallel. Files whose sizes
+    differ are not hashed.
+
+    :param bucket: A :class:`boto.s3.bucket.Bucket` object.
+    :param pairs: Iterable of ``(keyname, localfile)`` tuples.
+    :param workers: Number of concurrent listings and hashing threads.
+    :return:
+        List of ``(status, keyname, localfile)`` tuples in the same order as
+        ``pairs``, where status is one of:
+
+            SAME --- The files match.
+            DIFFERENT --- The files do not match.
+            MISSING_S3 --- The key does not exist.
+            MISSING_LOCAL --- The local file does not exist.
+    """
+    pairs = list(pairs)
+    s3filedict = s3list_s3filedict_many(bucket,
+                                        covering_prefixes(keyname for keyname, localfile in pairs),
+                                        workers)
+    def compare(pair):
+        keyname, localfile = pair
+        s3file = s3filedict.get(keyname)
+        if s3file is None:
+            return 'MISSING_S3'
+        elif not exists(localfile):
+            return 'MISSING_LOCAL'
+        elif s3file.get_size() != getsize(localfile):
+            return 'DIFFERENT'
+        elif s3file.etag_matches_localfile(localfile):
+            return 'SAME'
+        else:
+            return 'DIFFERENT'
+    statuses = parallel_map(compare, pairs, workers)
+    return [(status, keyname, localfile)
+            for status, (keyname, localfile) in zip(statuses, pairs)]
+
+def parse_manifest(fp):
+    """
+    Parse a manifest of key/localfile pairs. Each line contains a keyname
+    and a local filename separated by whitespace. Blank lines and lines
+    starting with ``#`` are ignored.
+
+    :param fp: A file-like object.
+    :return: List of ``(keyname, localfile)`` tuples.
+    """
+    pairs = []
+    for lineno, line in enumerate(fp, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split(None, 1)
+        if len(parts) != 2:
+            raise ValueError('Invalid manifest line {0}: {1!r}'.format(lineno, line))
+        pairs.append((parts[0], parts[1]))
+    return pairs
+
 def localpath_to_s3path(localdir, localpath, s3prefix):
     """
     Convert a local filepath into a S3 path within the given ``s3prefix``.
@@ -224,6 +646,7 @@ class S3File(object):
 
     @classmethod
     def from_head(cls, bucket, name):
+        get_transfer_governor().request()
         return cls(bucket, bucket.get_key(name))
 
     def __init__(self, bucket, key):
@@ -231,9 +654,18 @@ class S3File(object):
         self.key = key
 
     def _overwrite_check(self, overwrite):
-        if not overwrite and self.key.exists():
+        if not overwrite and self.exists():
             raise S3FileExistsError(self)
 
+    def _transfer_kwargs(self):
+        """
+        Register a request with the :class:`TransferGovernor`, and get the
+        ``cb`` and ``num_cb`` arguments for a boto transfer method.
+        """
+        governor = get_transfer_governor()
+        governor.request()
+        return dict(cb=governor.get_progress_callback(), num_cb=-1)
+
     def _has_info_check(self):
         if self.key.etag == None or self.key.is_latest == None:
             raise S3FileNoInfo(self)
@@ -249,6 +681,7 @@ class S3File(object):
         """
         Return ``True`` if the key/file exists in the S3 bucket.
         """
+        get_transfer_governor().request()
         return self.key.exists()
 
     def get_etag(self):
@@ -274,6 +707,7 @@ class S3File(object):
         """
         if not self.exists():
             raise S3FileDoesNotExist(self)
+        get_transfer_governor().request()
         self.key.delete()
 
     def set_contents_from_string(self, data, overwrite=False):
@@ -286,7 +720,7 @@ class S3File(object):
             If ``overwrite==True`` and the key exists in the bucket.
         """
         self._overwrite_check(overwrite)
-        self.key.set_contents_from_string(data)
+        self.key.set_contents_from_string(data, **self._transfer_kwargs())
 
     def set_contents_from_filename(self, localfile, overwrite=False):
         """
@@ -298,19 +732,154 @@ class S3File(object):
             If ``overwrite==True`` and the key exists in the bucket.
         """
         self._overwrite_check(overwrite)
-        self.key.set_contents_from_filename(localfile)
+        self.key.set_contents_from_filename(localfile, **self._transfer_kwargs())
+
+    def set_contents_from_stream(self, fp, overwrite=False, partsize=None,
+                                 concurrency=None):
+        """
+        Upload everything read from the file-like object ``fp`` (E.g.:
+        ``sys.stdin``) until EOF. The size of the stream does not have to be
+        known in advance.
+
+        The stream is read in chunks of ``partsize`` bytes, and the chunks are
+        uploaded as parts of a S3 multipart upload by ``concurrency`` worker
+        threads while we continue reading. At most ``concurrency + 2`` chunks
+        are kept in memory. Streams smaller than ``partsize`` are uploaded
+        with a single PUT request. The multipart upload is cancelled if
+        reading or uploading any part fails.
+
+        :param overwrite:
+            If ``True``, overwrite if the key/file exists.
+        :param partsize:
+            Size of each part in bytes. Defaults to
+            ``awsfab_settings.S3_MULTIPART_PARTSIZE``.
+        :param concurrency:
+            Number of parts to upload concurrently. Defaults to
+            ``awsfab_settings.S3_MULTIPART_CONCURRENCY``.
+        :raise S3FileExistsError:
+            If ``overwrite==True`` and the key exists in the bucket.
+        :raise ValueError: If ``partsize`` is less than :obj:`S3_MIN_PARTSIZE`.
+        """
+        partsize = partsize or awsfab_settings.S3_MULTIPART_PARTSIZE
+        concurrency = concurrency or awsfab_settings.S3_MULTIPART_CONCURRENCY
+        if partsize < S3_MIN_PARTSIZE:
+            raise ValueError('partsize must be at least {0} bytes.'.format(S3_MIN_PARTSIZE))
+        self._overwrite_check(overwrite)
+        chunks = iter_stream_chunks(fp, partsize)
+        first = next(chunks, '')
+        if len(first) < partsize:
+            self.key.set_contents_from_string(first, **self._transfer_kwargs())
+            return
+        get_transfer_governor().request()
+        multipart = self.bucket.initiate_multipart_upload(self.key.name)
+        pool = WorkerPool(concurrency, queuesize=1)
+        try:
+            for part_num, data in enumerate(chain([first], chunks), 1):
+                if not pool.submit(self._upload_part, multipart, part_num, data):
+                    break
+            pool.join()
+        except Exception:
+            exc_info = sys.exc_info()
+            pool.join(reraise=False)
+            multipart.cancel_upload()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        get_transfer_governor().request()
+        multipart.complete_upload()
+
+    def _upload_part(self, multipart, part_num, data):
+        multipart.upload_part_from_file(StringIO(data), part_num,
+                                        **self._transfer_kwargs())
+
+    def get_size(self):
+        """
+        Return the size of the file in bytes.
+        """
+        self._has_info_check()
+        return self.key.size
+
+    def copy_to(self, bucket, name, partsize=None, concurrency=None):
+        """
+        Copy this file to ``name`` in ``bucket`` using server-side copy. No
+        data passes through the local machine.
+
+        Files larger than ``partsize`` are copied with a multipart copy,
+        where ``concurrency`` parts are copied in parallel (required for files
+        larger than 5GB). The multipart copy is cancelled if any part fails.
+
+        :param bucket: The destination :class:`boto.s3.bucket.Bucket`.
+        :param name: The destination key name.
+        :param partsize:
+            Defaults to ``awsfab_settings.S3_MULTIPART_COPY_PARTSIZE``.
+        :param concurrency:
+            Defaults to ``awsfab_settings.S3_MULTIPART_CONCURRENCY``.
+        :return: The destination :class:`S3File` (not HEAD-requested).
+        """
+        partsize = partsize or awsfab_settings.S3_MULTIPART_COPY_PARTSIZE
+        concurrency = concurrency or awsfab_settings.S3_MULTIPART_CONCURRENCY
+        governor = get_transfer_governor()
+        size = self.get_size()
+        if size <= partsize:
+            governor.request()
+            bucket.copy_key(name, self.bucket.name, self.key.name)
+            return S3File.raw(bucket, name)
+
+        governor.request()
+        srckey = self.bucket.get_key(self.key.name)
+        headers = {}
+        if srckey.content_type:
+            headers['Content-Type'] = srckey.content_type
+        governor.request()
+        multipart = bucket.initiate_multipart_upload(name, headers=headers,
+                                                     metadata=srckey.metadata)
+        pool = WorkerPool(concurrency)
+        try:
+            for part_num, start in enumerate(xrange(0, size, partsize), 1):
+                end = min(start + partsize, size) - 1
+                if not pool.submit(self._copy_part, multipart, part_num, start, end):
+                    break
+            pool.join()
+        except Exception:
+            exc_info = sys.exc_info()
+            pool.join(reraise=False)
+            multipart.cancel_upload()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        governor.request()
+        multipart.complete_upload()
+        return S3File.raw(bucket, name)
+
+    def _copy_part(self, multipart, part_num, start, end):
+        get_transfer_governor().request()
+        multipart.copy_part_from_key(self.bucket.name, self.key.name, part_num,
+                                     start=start, end=end)
+
+    def matches(self, other):
+        """
+        Return ``True`` if this file and the ``other`` :class:`S3File` have
+        the same size and etag. Files created by multipart uploads/copies have
+        etags that are not md5 checksums (they contain a ``-``). If ``other``
+        has such an etag, we consider the files the same if they have the same
+        size and ``other`` was last modified after this file.
+        """
+        if self.get_size() != other.get_size():
+            return False
+        other_etag = other.get_etag()
+        if self.get_etag() == other_etag:
+            return True
+        if '-' in other_etag:
+            return other.key.last_modified >= self.key.last_modified
+        return False
 
     def get_contents_as_string(self):
         """
         Download the file and return it as a string.
         """
-        return self.key.get_contents_as_string()
+        return self.key.get_contents_as_string(**self._transfer_kwargs())
 
     def get_contents_to_filename(self, localfile):
         """
         Download the file to the given ``localfile``.
         """
-        self.key.get_contents_to_filename(localfile)
+        self.key.get_contents_to_filename(localfile, **self._transfer_kwargs())
 
     def __str__(self):
         return '{classname}({bucket}, {name})'.format(classname=self.__class__.__name__,
@@ -386,21 +955,28 @@ class S3Sync(object):
 
     A good example is the sourcecode for :func:`awsfabrictasks.s3.tasks.s3_syncupload_dir`.
     """
-    def __init__(self, bucket, local_dir, s3prefix):
+    def __init__(self, bucket, local_dir, s3prefix, stats=None):
         """
         :param bucket: A :class:`boto.rds.bucket.DBInstance` object.
         :param local_dir: The local directory.
         :param local_dir: The S3 key prefix that corresponds to ``local_dir``.
+        :param stats:
+            A :class:`TransferStats` object. The time used to list the local
+            and S3 files is recorded as the ``local_scan`` and
+            ``remote_listing`` phases. Defaults to a new TransferStats object.
         """
         self.bucket = bucket
         self.local_dir = local_dir
         self.s3prefix = force_slashend(s3prefix)
+        self.stats = stats or TransferStats()
 
     def _get_localfiles_set(self):
-        return dirlist_absfilenames(self.local_dir)
+        with self.stats.phase('local_scan'):
+            return dirlist_absfilenames(self.local_dir)
 
     def _get_s3filedict(self):
-        return s3list_s3filedict(self.bucket, self.s3prefix)
+        with self.stats.phase('remote_listing'):
+            return s3list_s3filedict(self.bucket, self.s3prefix)
 
     def iterfiles(self):
         """
@@ -442,3 +1018,252 @@ class S3Sync(object):
             syncfile.localexists = False
             syncfile.localpath = s3path_to_localpath(self.s3prefix, s3path, self.local_dir)
             yield syncfile
+
+
+def s3_syncupload(bucket, local_dir, s3prefix, log, delete=False, pretend=False, stats=None):
+    """
+    Sync a local directory into a S3 bucket using :class:`S3Sync`. This is
+    the implementation of :func:`awsfabrictasks.s3.tasks.s3_syncupload_dir`.
+
+    :param bucket: A :class:`boto.s3.bucket.Bucket` object.
+    :param local_dir: The local directory to sync to S3.
+    :param s3prefix: The S3 prefix to use for the uploaded files.
+    :param log: A logger. Changes are logged at INFO level, and unchanged files at DEBUG level.
+    :param delete: Delete remote files that are not present in ``local_dir``.
+    :param pretend: Do not change anything.
+    :param stats: A :class:`TransferStats` object. Defaults to a new TransferStats object.
+    :return: The :class:`TransferStats` object.
+    """
+    stats = stats or TransferStats()
+    for syncfile in S3Sync(bucket, local_dir, s3prefix, stats=stats).iterfiles():
+        logname = '{0}:{1}'.format(bucket.name, syncfile.s3path)
+        if syncfile.both_exists():
+            with stats.phase('compare'):
+                with stats.timed('hash', nbytes=getsize(syncfile.localpath)):
+                    unchanged = syncfile.etag_matches_localfile()
+            if unchanged:
+                log.debug('UNCHANGED %s', logname)
+            else:
+                if not pretend:
+                    log.debug('Uploading %s', logname)
+                    with stats.phase('transfer'):
+                        with stats.timed('upload', nbytes=getsize(syncfile.localpath)):
+                            syncfile.s3file.set_contents_from_filename(syncfile.localpath,
+                                                                       overwrite=True)
+                log.info('UPDATED %s', logname)
+        elif syncfile.localexists:
+            if not pretend:
+                log.debug('Uploading %s', logname)
+                with stats.phase('transfer'):
+                    with stats.timed('upload', nbytes=getsize(syncfile.localpath)):
+                        syncfile.s3file.set_contents_from_filename(syncfile.localpath)
+            log.info('CREATED %s', logname)
+        else:
+            if delete:
+                if not pretend:
+                    with stats.phase('transfer'):
+                        with stats.timed('delete'):
+                            syncfile.s3file.delete()
+                log.info('DELETED %s', logname)
+            else:
+                log.debug('NOT DELETED %s (it does not exist locally)', logname)
+    return stats
+
+
+
+def get_presigned_manifest(bucket, local_dir, s3prefix, expires_in=3600):
+    """
+    Get a manifest for the files in ``local_dir`` synced to ``s3prefix``
+    (E.g.: with :func:`s3_syncupload`) that hosts without AWS credentials can
+    use to download and verify the files.
+
+    The URLs are signed locally, so this does not make any requests to S3.
+
+    :param bucket: A :class:`boto.s3.bucket.Bucket` object.
+    :param local_dir: The local directory.
+    :param s3prefix: The S3 prefix that corresponds to ``local_dir``.
+    :param expires_in: Number of seconds until the URLs expire.
+    :return:
+        Sorted list of ``(path, md5sum, url)`` tuples, where ``path`` is the
+        ``/``-separated path relative to ``local_dir``, ``md5sum`` is the
+        hex-digested md5 checksum of the local file, and ``url`` is a
+        presigned GET URL for the file on S3.
+    """
+    s3prefix = force_slashend(s3prefix)
+    manifest = []
+    for localpath in dirlist_absfilenames(local_dir):
+        s3path = localpath_to_s3path(local_dir, localpath, s3prefix)
+        url = Key(bucket, s3path).generate_url(expires_in)
+        manifest.append((s3path[len(s3prefix):], compute_localfile_md5sum(localpath), url))
+    return sorted(manifest)
+
+def get_presigned_download_files(bucket, s3prefix, expires_in=3600):
+    """
+    Get the ``files`` for a :mod:`awsfabrictasks.s3.agent` ``download`` job
+    that downloads all the files in ``s3prefix``.
+
+    :param bucket: A :class:`boto.s3.bucket.Bucket` object.
+    :param s3prefix: The S3 prefix to download.
+    :param expires_in: Number of seconds until the URLs expire.
+    :return:
+        Sorted list of ``{"path": ..., "md5": ..., "url": ...}`` dicts, where
+        ``path`` is relative to ``s3prefix``, and ``md5`` is the etag of the
+        key, or ``None`` for multipart uploads (their etag is not an md5 of
+        the file).
+    """
+    s3prefix = force_slashend(s3prefix)
+    files = []
+    for name, s3file in sorted(s3list_s3filedict(bucket, s3prefix).iteritems()):
+        if name.endswith('/'):
+            continue # "Directory" placeholder
+        etag = s3file.get_etag()
+        files.append({'path': name[len(s3prefix):],
+                      'md5': None if '-' in etag else etag,
+                      'url': s3file.key.generate_url(expires_in)})
+    return files
+
+def get_presigned_upload_files(bucket, s3prefix, scanned, expires_in=3600):
+    """
+    Get the ``files`` for a :mod:`awsfabrictasks.s3.agent` ``upload`` job
+    that uploads the files in ``scanned`` that are missing or different in
+    ``s3prefix``. The etags are retrieved with one listing of ``s3prefix``.
+
+    :param bucket: A :class:`boto.s3.bucket.Bucket` object.
+    :param s3prefix: The S3 prefix to upload to.
+    :param scanned:
+        Dict mapping ``/``-separated paths relative to ``s3prefix`` to
+        ``{"md5": ..., "size": ...}`` dicts (the output of an agent ``scan``
+        job).
+    :param expires_in: Number of seconds until the URLs expire.
+    :raise ValueError:
+        If any of the files to upload is larger than S3 accepts in a single
+        PUT request (:obj:`awsfabrictasks.s3.agent.MAX_UPLOAD_SIZE`).
+    :return: Sorted list of ``{"path": ..., "url": ...}`` dicts.
+    """
+    from awsfabrictasks.s3.agent import UPLOAD_CONTENT_TYPE, MAX_UPLOAD_SIZE
+    s3prefix = force_slashend(s3prefix)
+    s3filedict = s3list_s3filedict(bucket, s3prefix)
+    changed = []
+    for path, fileinfo in sorted(scanned.iteritems()):
+        s3file = s3filedict.get(s3prefix + path)
+        if s3file is None or s3file.get_etag() != fileinfo['md5']:
+            changed.append((path, fileinfo))
+    toolarge = ['{0} ({1} bytes)'.format(path, fileinfo['size'])
+                for path, fileinfo in changed if fileinfo['size'] > MAX_UPLOAD_SIZE]
+    if toolarge:
+        raise ValueError('Files larger than S3 accepts in a single PUT ({0} bytes): {1}'.format(
+            MAX_UPLOAD_SIZE, ', '.join(toolarge)))
+    files = []
+    for path, fileinfo in changed:
+        url = Key(bucket, s3prefix + path).generate_url(
+                expires_in, method='PUT', headers={'Content-Type': UPLOAD_CONTENT_TYPE})
+        files.append({'path': path, 'url': url})
+    return files
+
+def get_s3_agent_source():
+    """
+    Get the source code of :mod:`awsfabrictasks.s3.agent`.
+    """
+    fp = open(join(dirname(abspath(__file__)), 'agent.py'))
+    try:
+        return fp.read()
+    finally:
+        fp.close()
+
+class S3PrefixSyncIterFile(object):
+    """
+    Objects of this class is yielded by :meth:`S3PrefixSync.iterfiles`.
+    Contains info about where the file exists in the source and the
+    destination prefix.
+    """
+    def __init__(self):
+        #: The S3 path in the source bucket. Always set.
+        self.srcpath = None
+
+        #: A :class:`S3File` in the source bucket, or ``None`` if
+        #: :obj:`.srcexists` is ``False``.
+        self.srcfile = None
+
+        #: Source file exists?
+        self.srcexists = False
+
+        #: The S3 path in the destination bucket. Always set.
+        self.dstpath = None
+
+        #: A :class:`S3File` in the destination bucket, or ``None`` if
+        #: :obj:`.dstexists` is ``False``.
+        self.dstfile = None
+
+        #: Destination file exists?
+        self.dstexists = False
+
+    def __str__(self):
+        return ('S3PrefixSyncIterFile(srcpath={srcpath}, srcexists={srcexists}, '
+                'dstpath={dstpath}, dstexists={dstexists})').format(**self.__dict__)
+
+    def both_exists(self):
+        """
+        Returns ``True`` if :obj:`.srcexists` and :obj:`.dstexists`.
+        """
+        return self.srcexists and self.dstexists
+
+    def is_same(self):
+        """
+        Shortcut for ``self.srcfile.matches(self.dstfile)``.
+        """
+        return self.srcfile.matches(self.dstfile)
+
+
+class S3PrefixSync(object):
+    """
+    Makes it easy to sync files between two S3 prefixes, possibly in
+    different buckets. Like :class:`S3Sync`, this class does not change
+    anything.
+
+    A good example is the sourcecode for :func:`awsfabrictasks.s3.tasks.s3_sync_prefix`.
+    """
+    def __init__(self, srcbucket, srcprefix, dstbucket, dstprefix, stats=None):
+        """
+        :param srcbucket: The source :class:`boto.s3.bucket.Bucket`.
+        :param srcprefix: The S3 key prefix to sync from.
+        :param dstbucket: The destination :class:`boto.s3.bucket.Bucket`.
+        :param dstprefix: The S3 key prefix that corresponds to ``srcprefix``.
+        :param stats:
+            A :class:`TransferStats` object. Listing the prefixes is recorded
+            as the ``remote_listing`` phase. Defaults to a new TransferStats
+            object.
+        """
+        self.srcbucket = srcbucket
+        self.srcprefix = force_slashend(srcprefix)
+        self.dstbucket = dstbucket
+        self.dstprefix = force_slashend(dstprefix)
+        self.stats = stats or TransferStats()
+
+    def iterfiles(self):
+        """
+        Iterate over all files in both prefixes. Uses one listing of each
+        prefix, so the etag and size of every file is available without any
+        HEAD requests. Yields :class:`S3PrefixSyncIterFile` objects.
+        """
+        with self.stats.phase('remote_listing'):
+            srcfiledict = s3list_s3filedict(self.srcbucket, self.srcprefix)
+            dstfiledict = s3list_s3filedict(self.dstbucket, self.dstprefix)
+        synced_dstpaths = set()
+        for srcpath in sorted(srcfiledict):
+            syncfile = S3PrefixSyncIterFile()
+            syncfile.srcpath = srcpath
+            syncfile.srcfile = srcfiledict[srcpath]
+            syncfile.srcexists = True
+            syncfile.dstpath = self.dstprefix + srcpath[len(self.srcprefix):]
+            syncfile.dstfile = dstfiledict.get(syncfile.dstpath)
+            syncfile.dstexists = syncfile.dstfile is not None
+            synced_dstpaths.add(syncfile.dstpath)
+            yield syncfile
+
+        for dstpath in sorted(set(dstfiledict).difference(synced_dstpaths)):
+            syncfile = S3PrefixSyncIterFile()
+            syncfile.srcpath = self.srcprefix + dstpath[len(self.dstprefix):]
+            syncfile.dstpath = dstpath
+            syncfile.dstfile = dstfiledict[dstpath]
+            syncfile.dstexists = True
+            yield syncfile
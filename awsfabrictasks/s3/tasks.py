@@ -1,21 +1,47 @@
+import sys
 from fabric.api import task, abort
 from fabric.contrib.console import confirm
 from os import linesep, remove
-from os.path import exists, expanduser, abspath
+from os.path import exists, expanduser, abspath, getsize
 
 from awsfabrictasks.utils import parse_bool
 from awsfabrictasks.utils import configureStreamLoggerForTask
 from awsfabrictasks.utils import getLoglevelFromString
+from awsfabrictasks.utils import parse_size
+from awsfabrictasks.utils import WorkerPool
+from awsfabrictasks.conf import awsfab_settings
 from .api import S3ConnectionWrapper
 from .api import iter_bucketcontents
 from .api import S3File
 from .api import S3FileExistsError
 from .api import S3Sync
+from .api import s3_syncupload
+from .api import S3PrefixSync
+from .api import s3_delete_many
+from .api import configure_transfer_governor
+from .api import TransferStats
+from .api import compare_localfiles_to_s3
+from .api import parse_manifest
+from .api import dirlist_absfilenames
+from .api import localpath_to_s3path
+
+
+def _report_stats(log, stats, report):
+    log.info('Summary:\n%s', stats.format_summary())
+    if report:
+        stats.write_json(expanduser(report))
+        log.info('Wrote JSON report to %s', report)
+
+def _configure_max_bandwidth(max_bandwidth):
+    if max_bandwidth:
+        configure_transfer_governor(parse_size(max_bandwidth),
+                                    awsfab_settings.S3_MAX_REQUESTS_PER_SEC)
 
 
 __all__ = ['s3_ls', 's3_listbuckets', 's3_createfile', 's3_uploadfile',
-           's3_printfile', 's3_downloadfile', 's3_delete', 's3_is_same_file',
-           's3_syncupload_dir', 's3_syncdownload_dir']
+           's3_uploadstream', 's3_printfile', 's3_downloadfile', 's3_delete', 's3_is_same_file',
+           's3_is_same_files',
+           's3_syncupload_dir', 's3_syncdownload_dir', 's3_sync_prefix']
 
 @task
 def s3_ls(bucketname, prefix='', search=None, match=None, style='compact',
@@ -113,7 +139,7 @@ def s3_createfile(bucketname, keyname, contents, overwrite=False):
 
 
 @task
-def s3_uploadfile(bucketname, keyname, localfile, overwrite=False):
+def s3_uploadfile(bucketname, keyname, localfile, overwrite=False, max_bandwidth=None):
     """
     Upload a local file.
 
@@ -121,7 +147,11 @@ def s3_uploadfile(bucketname, keyname, localfile, overwrite=False):
     :param keyname: The key to create/overwrite (In filesystem terms: absolute file path).
     :param localfile: The local file to upload.
     :param overwrite: Overwrite if exists? Defaults to ``False``.
+    :param max_bandwidth:
+        Max bytes per second. Supports ``K``, ``M`` and ``G`` suffixes
+        (E.g.: ``2M``). Defaults to ``awsfab_settings.S3_MAX_BANDWIDTH``.
     """
+    _configure_max_bandwidth(max_bandwidth)
     localfile = expanduser(localfile)
     bucket = S3ConnectionWrapper.get_bucket_using_pattern(bucketname)
     s3file = S3File.raw(bucket, keyname)
@@ -130,6 +160,40 @@ def s3_uploadfile(bucketname, keyname, localfile, overwrite=False):
     except S3FileExistsError, e:
         abort(str(e))
 
+@task
+def s3_uploadstream(bucketname, keyname, overwrite=False, partsize=None,
+                    concurrency=None, max_bandwidth=None):
+    """
+    Upload everything written to stdin. Useful for uploading the output of
+    other commands without storing it on the local disk first. Example::
+
+        pg_dump mydb | gzip | awsfab s3_uploadstream:mybucket,backups/mydb.sql.gz
+
+    :param bucketname: Name of an S3 bucket.
+    :param keyname: The key to create/overwrite (In filesystem terms: absolute file path).
+    :param overwrite: Overwrite if exists? Defaults to ``False``.
+    :param partsize:
+        Size of each uploaded part. Supports ``K``, ``M`` and ``G`` suffixes
+        (E.g.: ``16M``). Defaults to ``awsfab_settings.S3_MULTIPART_PARTSIZE``.
+    :param concurrency:
+        Number of parts to upload concurrently. Defaults to
+        ``awsfab_settings.S3_MULTIPART_CONCURRENCY``.
+    :param max_bandwidth:
+        Max bytes per second. Supports ``K``, ``M`` and ``G`` suffixes
+        (E.g.: ``2M``). Defaults to ``awsfab_settings.S3_MAX_BANDWIDTH``.
+
+    .. seealso:: :meth:`awsfabrictasks.s3.api.S3File.set_contents_from_stream`.
+    """
+    _configure_max_bandwidth(max_bandwidth)
+    bucket = S3ConnectionWrapper.get_bucket_using_pattern(bucketname)
+    s3file = S3File.raw(bucket, keyname)
+    try:
+        s3file.set_contents_from_stream(sys.stdin, parse_bool(overwrite),
+                                        partsize=parse_size(partsize),
+                                        concurrency=concurrency and int(concurrency))
+    except (S3FileExistsError, ValueError), e:
+        abort(str(e))
+
 @task
 def s3_printfile(bucketname, keyname):
     """
@@ -143,21 +207,25 @@ def s3_printfile(bucketname, keyname):
     print s3file.get_contents_as_string()
 
 @task
-def s3_downloadfile(bucketname, keyname, localfile, overwrite=False):
+def s3_downloadfile(bucketname, keyname, localfile, overwrite=False, max_bandwidth=None):
     """
-    Print the contents of the given key/file to stdout.
+    Download the given key/file to a local file.
 
     :param bucketname: Name of an S3 bucket.
     :param keyname: The key to download (In filesystem terms: absolute file path).
     :param localfile: The local file to write the data to.
     :param overwrite: Overwrite local file if exists? Defaults to ``False``.
+    :param max_bandwidth:
+        Max bytes per second. Supports ``K``, ``M`` and ``G`` suffixes
+        (E.g.: ``2M``). Defaults to ``awsfab_settings.S3_MAX_BANDWIDTH``.
     """
+    _configure_max_bandwidth(max_bandwidth)
     localfile = expanduser(localfile)
-    if exists(localfile) and not overwrite:
+    if exists(localfile) and not parse_bool(overwrite):
         abort('Local file exists: {0}'.format(localfile))
     bucket = S3ConnectionWrapper.get_bucket_using_pattern(bucketname)
     s3file = S3File.raw(bucket, keyname)
-    print s3file.get_contents_to_filename()
+    s3file.get_contents_to_filename(localfile)
 
 @task
 def s3_delete(bucketname, keyname, noconfirm=False):
@@ -194,9 +262,64 @@ def s3_is_same_file(bucketname, keyname, localfile):
     print s3file.etag_matches_localfile(localfile)
 
 
+@task
+def s3_is_same_files(bucketname, manifest=None, local_dir=None, s3prefix=None,
+                     resultfile=None, workers=None):
+    """
+    Batch version of :func:`s3_is_same_file`. Checks many files using a few
+    S3 listings instead of one HEAD request per file, and hashes the local
+    files in parallel (see
+    :func:`awsfabrictasks.s3.api.compare_localfiles_to_s3`).
+
+    The files to check are given either as a ``manifest``, or as a
+    ``local_dir`` and the ``s3prefix`` it corresponds to.
+
+    Writes one line per file to ``resultfile`` (or stdout), with the
+    status, keyname and local file separated by tabs. The status is one of
+    ``SAME``, ``DIFFERENT``, ``MISSING_S3`` and ``MISSING_LOCAL``.
+
+    :param bucketname: Name of an S3 bucket.
+    :param manifest:
+        Path to a file with one ``<keyname> <localfile>`` pair per line.
+    :param local_dir: Check all the files in this local directory.
+    :param s3prefix: The S3 prefix that corresponds to ``local_dir``.
+    :param resultfile: Write the results to this file instead of stdout.
+    :param workers:
+        Number of concurrent listings and hashing threads. Defaults to
+        ``awsfab_settings.S3_CONCURRENCY``.
+    """
+    if manifest:
+        try:
+            with open(expanduser(manifest)) as fp:
+                pairs = parse_manifest(fp)
+        except (IOError, ValueError), e:
+            abort('Could not read manifest {0}: {1}'.format(manifest, e))
+    elif local_dir and s3prefix is not None:
+        local_dir = abspath(expanduser(local_dir))
+        pairs = [(localpath_to_s3path(local_dir, localpath, s3prefix), localpath)
+                 for localpath in sorted(dirlist_absfilenames(local_dir))]
+    else:
+        abort('Specify manifest, or local_dir and s3prefix.')
+    workers = int(workers or awsfab_settings.S3_CONCURRENCY)
+    bucket = S3ConnectionWrapper.get_bucket_using_pattern(bucketname)
+    results = compare_localfiles_to_s3(bucket, pairs, workers)
+    lines = ['\t'.join(result) for result in results]
+    if resultfile:
+        with open(expanduser(resultfile), 'w') as fp:
+            fp.write(linesep.join(lines) + linesep)
+        counts = {}
+        for status, keyname, localfile in results:
+            counts[status] = counts.get(status, 0) + 1
+        print ', '.join('{0}: {1}'.format(status, count)
+                        for status, count in sorted(counts.iteritems()))
+    else:
+        for line in lines:
+            print line
+
+
 @task
 def s3_syncupload_dir(bucketname, local_dir, s3prefix, loglevel='INFO', delete=False,
-                      pretend=False):
+                      pretend=False, max_bandwidth=None, report=None):
     """
     Sync a local directory into a S3 bucket. Uses the same method as the
     :func:`s3_is_same_file` task to determine if a local file differs from a
@@ -218,7 +341,16 @@ def s3_syncupload_dir(bucketname, local_dir, s3prefix, loglevel='INFO', delete=F
     :param pretend:
         Do not change anything. With ``verbosity=2``, this gives a good
         overview of the changes applied by running the task.
+    :param max_bandwidth:
+        Max bytes per second. Supports ``K``, ``M`` and ``G`` suffixes
+        (E.g.: ``2M``). Defaults to ``awsfab_settings.S3_MAX_BANDWIDTH``.
+    :param report:
+        Path to a file where a JSON report with the performance numbers
+        collected during the sync (see
+        :class:`awsfabrictasks.s3.api.TransferStats`) is written. A human
+        readable summary is always logged at the end of the sync.
     """
+    _configure_max_bandwidth(max_bandwidth)
     log = configureStreamLoggerForTask(__name__, 's3_syncupload_dir',
                                        getLoglevelFromString(loglevel))
     local_dir = abspath(expanduser(local_dir))
@@ -227,33 +359,13 @@ def s3_syncupload_dir(bucketname, local_dir, s3prefix, loglevel='INFO', delete=F
     bucket = S3ConnectionWrapper.get_bucket_using_pattern(bucketname)
     if pretend:
         log.info('Running in pretend mode. No changes are made.')
-    for syncfile in S3Sync(bucket, local_dir, s3prefix).iterfiles():
-        logname = '{0}:{1}'.format(bucket.name, syncfile.s3path)
-        if syncfile.both_exists():
-            if syncfile.etag_matches_localfile():
-                log.debug('UNCHANGED %s', logname)
-            else:
-                if not pretend:
-                    log.debug('Uploading %s', logname)
-                    syncfile.s3file.set_contents_from_filename(syncfile.localpath, overwrite=True)
-                log.info('UPDATED %s', logname)
-        elif syncfile.localexists:
-            if not pretend:
-                log.debug('Uploading %s', logname)
-                syncfile.s3file.set_contents_from_filename(syncfile.localpath)
-            log.info('CREATED %s', logname)
-        else:
-            if delete:
-                if not pretend:
-                    syncfile.s3file.delete()
-                log.info('DELETED %s', logname)
-            else:
-                log.debug('NOT DELETED %s (it does not exist locally)', logname)
+    stats = s3_syncupload(bucket, local_dir, s3prefix, log, delete=delete, pretend=pretend)
+    _report_stats(log, stats, report)
 
 
 @task
 def s3_syncdownload_dir(bucketname, s3prefix, local_dir, loglevel='INFO', delete=False,
-                        pretend=False):
+                        pretend=False, max_bandwidth=None, report=None):
     """
     Sync a S3 prefix from a S3 bucket into a local directory. Uses the same
     method as the :func:`s3_is_same_file` task to determine if a local file
@@ -275,7 +387,16 @@ def s3_syncdownload_dir(bucketname, s3prefix, local_dir, loglevel='INFO', delete
     :param pretend:
         Do not change anything. With ``verbosity=2``, this gives a good
         overview of the changes applied by running the task.
+    :param max_bandwidth:
+        Max bytes per second. Supports ``K``, ``M`` and ``G`` suffixes
+        (E.g.: ``2M``). Defaults to ``awsfab_settings.S3_MAX_BANDWIDTH``.
+    :param report:
+        Path to a file where a JSON report with the performance numbers
+        collected during the sync (see
+        :class:`awsfabrictasks.s3.api.TransferStats`) is written. A human
+        readable summary is always logged at the end of the sync.
     """
+    _configure_max_bandwidth(max_bandwidth)
     log = configureStreamLoggerForTask(__name__, 's3_syncupload_dir',
                                        getLoglevelFromString(loglevel))
     local_dir = abspath(expanduser(local_dir))
@@ -284,25 +405,124 @@ def s3_syncdownload_dir(bucketname, s3prefix, local_dir, loglevel='INFO', delete
     bucket = S3ConnectionWrapper.get_bucket_using_pattern(bucketname)
     if pretend:
         log.info('Running in pretend mode. No changes are made.')
-    for syncfile in S3Sync(bucket, local_dir, s3prefix).iterfiles():
+    stats = TransferStats()
+    for syncfile in S3Sync(bucket, local_dir, s3prefix, stats=stats).iterfiles():
         logname = 'LocalFS:{0}'.format(syncfile.localpath)
         if syncfile.both_exists():
-            if syncfile.etag_matches_localfile():
+            with stats.phase('compare'):
+                with stats.timed('hash', nbytes=getsize(syncfile.localpath)):
+                    unchanged = syncfile.etag_matches_localfile()
+            if unchanged:
                 log.debug('UNCHANGED %s', logname)
             else:
                 if not pretend:
                     log.debug('Downloading %s', logname)
-                    syncfile.download_s3file_to_localfile()
+                    with stats.phase('transfer'):
+                        with stats.timed('download', nbytes=syncfile.s3file.key.size or 0):
+                            syncfile.download_s3file_to_localfile()
                 log.info('UPDATED %s', logname)
         elif syncfile.s3exists:
             if not pretend:
                 log.debug('Downloading %s', logname)
-                syncfile.download_s3file_to_localfile()
+                with stats.phase('transfer'):
+                    with stats.timed('download', nbytes=syncfile.s3file.key.size or 0):
+                        syncfile.download_s3file_to_localfile()
             log.info('CREATED %s', logname)
         else:
             if delete:
                 if not pretend:
-                    remove(syncfile.localpath)
+                    with stats.phase('transfer'):
+                        with stats.timed('local_delete'):
+                            remove(syncfile.localpath)
                 log.info('DELETED %s', logname)
             else:
                 log.debug('NOT DELETED %s (it does not exist on S3)', syncfile.localpath)
+    _report_stats(log, stats, report)
+
+
+@task
+def s3_sync_prefix(srcbucketname, srcprefix, dstbucketname, dstprefix, loglevel='INFO',
+                   delete=False, pretend=False, concurrency=None, report=None):
+    """
+    Sync a S3 prefix into another S3 prefix, possibly in another bucket (E.g.:
+    from a staging bucket to a production bucket). Files are copied using
+    server-side copy requests, so no data is transferred through the local
+    machine. Files with the same size and etag are not copied (see
+    :meth:`awsfabrictasks.s3.api.S3File.matches`).
+
+    :param srcbucketname: Name of the source S3 bucket.
+    :param srcprefix: The S3 prefix to sync from.
+    :param dstbucketname: Name of the destination S3 bucket.
+    :param dstprefix: The S3 prefix to sync into.
+    :param loglevel:
+        Controls the amount of output:
+
+            QUIET --- No output.
+            INFO --- Only produce output for changes.
+            DEBUG --- One line of output for each file.
+
+        Defaults to "INFO".
+    :param delete:
+        Delete files in ``dstprefix`` that are not present in ``srcprefix``.
+        Uses multi-object delete requests.
+    :param pretend:
+        Do not change anything. With ``verbosity=2``, this gives a good
+        overview of the changes applied by running the task.
+    :param concurrency:
+        Number of files to copy concurrently. Defaults to
+        ``awsfab_settings.S3_CONCURRENCY``.
+    :param report:
+        Path to a file where a JSON report with the performance numbers
+        collected during the sync (see
+        :class:`awsfabrictasks.s3.api.TransferStats`) is written. A human
+        readable summary is always logged at the end of the sync.
+    """
+    log = configureStreamLoggerForTask(__name__, 's3_sync_prefix',
+                                       getLoglevelFromString(loglevel))
+    delete = parse_bool(delete)
+    pretend = parse_bool(pretend)
+    concurrency = int(concurrency or awsfab_settings.S3_CONCURRENCY)
+    srcbucket = S3ConnectionWrapper.get_bucket_using_pattern(srcbucketname)
+    dstbucket = S3ConnectionWrapper.get_bucket_using_pattern(dstbucketname)
+    if pretend:
+        log.info('Running in pretend mode. No changes are made.')
+
+    stats = TransferStats()
+    def copy(syncfile, logname, action):
+        if not pretend:
+            log.debug('Copying %s', logname)
+            with stats.timed('copy', nbytes=syncfile.srcfile.get_size()):
+                syncfile.srcfile.copy_to(dstbucket, syncfile.dstpath)
+        log.info('%s %s', action, logname)
+
+    prefixsync = S3PrefixSync(srcbucket, srcprefix, dstbucket, dstprefix, stats=stats)
+    syncfiles = list(prefixsync.iterfiles())
+    pool = WorkerPool(concurrency)
+    deletepaths = []
+    with stats.phase('transfer'):
+        for syncfile in syncfiles:
+            logname = '{0}:{1}'.format(dstbucket.name, syncfile.dstpath)
+            if syncfile.both_exists():
+                if syncfile.is_same():
+                    log.debug('UNCHANGED %s', logname)
+                elif not pool.submit(copy, syncfile, logname, 'UPDATED'):
+                    break
+            elif syncfile.srcexists:
+                if not pool.submit(copy, syncfile, logname, 'CREATED'):
+                    break
+            else:
+                if delete:
+                    deletepaths.append(syncfile.dstpath)
+                    if pretend:
+                        log.info('DELETED %s', logname)
+                else:
+                    log.debug('NOT DELETED %s (it does not exist in the source prefix)', logname)
+        pool.join()
+        if deletepaths and not pretend:
+            with stats.timed('batch_delete'):
+                deleted, errors = s3_delete_many(dstbucket, deletepaths)
+            for dstpath in deleted:
+                log.info('DELETED %s:%s', dstbucket.name, dstpath)
+            for dstpath, error in errors:
+                log.error('Failed to delete %s:%s: %s', dstbucket.name, dstpath, error)
+    _report_stats(log, stats, report)
@@ -1,10 +1,50 @@
 from unittest import TestCase
+import warnings
+from tempfile import mkdtemp
+from shutil import rmtree
+from os import listdir, stat, chmod
+from stat import S_IMODE
+from os.path import join, exists, dirname
 
 from awsfabrictasks.ec2.api import ec2_rsync_download_command
 from awsfabrictasks.ec2.api import ec2_rsync_upload_command
 from awsfabrictasks.ec2.api import Ec2LaunchInstance
 from awsfabrictasks.ec2.api import zipit
+from awsfabrictasks.ec2.api import get_ssh_control_path
+from awsfabrictasks.ec2.api import ec2_ssh_command
+from awsfabrictasks.ec2.api import s3_download_script
+from awsfabrictasks.ec2.api import balance_shards
+from awsfabrictasks.ec2.api import get_rsync_shard_units
+from awsfabrictasks.ec2.api import ec2_rsync_upload_sharded_commands
+from awsfabrictasks.ec2.api import get_transfer_host
+from awsfabrictasks.ec2.api import ec2_transfer_command
+from awsfabrictasks.ec2.api import Ec2InstanceIndex
+from awsfabrictasks.ec2.api import Ec2Inventory
+from awsfabrictasks.ec2.api import NoInstanceWithNameFound
+from awsfabrictasks.ec2.api import MultipleInstancesWithSameNameError
+from awsfabrictasks.ec2.api import NotExactlyOneInstanceError
+from awsfabrictasks.ec2.api import Ec2InstanceResolver
+from awsfabrictasks.ec2.api import ec2_inventory
+from awsfabrictasks.ec2.api import parse_regionnames
+from awsfabrictasks.ec2.api import map_regions
+from awsfabrictasks.ec2.api import Ec2StateWaiter
+from awsfabrictasks.ec2.api import WaitForStateError
+from awsfabrictasks.ec2.api import SshReadinessWaiter
+from awsfabrictasks.ec2.api import WaitForSshError
+from awsfabrictasks.ec2.api import group_tags
+from awsfabrictasks.ec2.api import Ec2InstanceWrapper
+from awsfabrictasks.ec2.api import bulk_create_tags
+from awsfabrictasks.ec2.api import bulk_delete_tags
+from awsfabrictasks.ec2.api import bulk_start_instances
+from awsfabrictasks.ec2.api import bulk_stop_instances
+from awsfabrictasks.ec2.api import parse_tagvalues
+from awsfabrictasks.ec2.api import get_instance_filters
+from awsfabrictasks.ec2.api import iter_reservations
+from awsfabrictasks.ec2.api import instance_as_dict
+from awsfabrictasks.connections import connection_registry
+from awsfabrictasks.ec2 import api as ec2_api
 from awsfabrictasks.conf import awsfab_settings
+from fabric.api import env
 
 
 class TestRsync(TestCase):
@@ -17,6 +57,7 @@ class TestRsync(TestCase):
     def setUp(self):
         self.instancewrapper = TestRsync.MockEc2InstanceWrapper()
         awsfab_settings.EXTRA_SSH_ARGS = ''
+        awsfab_settings.SSH_CONTROLMASTER = False
 
     def test_ec2_rsync_download_command(self):
         self.assertEquals(ec2_rsync_download_command(self.instancewrapper, '/etc', '/tmp/etc'),
@@ -52,6 +93,209 @@ class TestRsync(TestCase):
 
 
 
+class TestSshCommand(TestCase):
+    def setUp(self):
+        self.control_dir = mkdtemp()
+        awsfab_settings.reset_settings(EXTRA_SSH_ARGS='-o StrictHostKeyChecking=no',
+                                       SSH_CONTROLMASTER=True,
+                                       SSH_CONTROL_DIR=join(self.control_dir, 'sockets'),
+                                       SSH_CONTROLPERSIST='10m')
+        self.instancewrapper = TestRsync.MockEc2InstanceWrapper()
+
+    def tearDown(self):
+        rmtree(self.control_dir)
+
+    def test_get_ssh_control_path(self):
+        path = get_ssh_control_path('test@example.com')
+        self.assertEquals(path, get_ssh_control_path('test@example.com'))
+        self.assertNotEquals(path, get_ssh_control_path('test@example.org'))
+        self.assertEquals(listdir(self.control_dir), ['sockets'])
+
+    def test_ec2_ssh_command(self):
+        control_path = get_ssh_control_path('test@example.com')
+        self.assertEquals(ec2_ssh_command(self.instancewrapper, 'uptime'),
+                          'ssh -i /path/to/key.pem -o StrictHostKeyChecking=no '
+                          '-o ControlMaster=auto -o ControlPath={0} -o ControlPersist=10m '
+                          'test@example.com uptime'.format(control_path))
+        awsfab_settings.SSH_CONTROLMASTER = False
+        self.assertEquals(ec2_ssh_command(self.instancewrapper),
+                          'ssh -i /path/to/key.pem -o StrictHostKeyChecking=no test@example.com')
+
+    def test_rsync_uses_controlmaster(self):
+        self.assertTrue('ControlPath=' in ec2_rsync_upload_command(self.instancewrapper, '/etc', '/tmp'))
+
+
+class TestS3DownloadScript(TestCase):
+    def setUp(self):
+        self.tempdir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def _run(self, manifest, remote_dir=None, concurrency=2):
+        from subprocess import call
+        import os
+        remote_dir = remote_dir or join(self.tempdir, 'dst dir')
+        script = s3_download_script(remote_dir, manifest, concurrency=concurrency)
+        open(join(self.tempdir, 'script.sh'), 'wb').write(script)
+        return call('sh {0} > /dev/null 2>&1'.format(join(self.tempdir, 'script.sh')), shell=True,
+                    env=dict(os.environ, HOME=self.tempdir))
+
+    def test_download_and_verify(self):
+        source = join(self.tempdir, 'source.txt')
+        open(source, 'wb').write('hello')
+        manifest = [('a.txt', '5d41402abc4b2a76b9719d911017c592', 'file://' + source),
+                    ('sub dir/b.txt', '5d41402abc4b2a76b9719d911017c592', 'file://' + source),
+                    ('sub dir/c.txt', '5d41402abc4b2a76b9719d911017c592', 'file://' + source)]
+        self.assertEquals(self._run(manifest), 0)
+        self.assertEquals(open(join(self.tempdir, 'dst dir', 'sub dir', 'c.txt')).read(), 'hello')
+
+    def test_checksum_mismatch(self):
+        source = join(self.tempdir, 'source.txt')
+        open(source, 'wb').write('changed')
+        manifest = [('a.txt', '5d41402abc4b2a76b9719d911017c592', 'file://' + source)]
+        self.assertNotEquals(self._run(manifest), 0)
+
+    def test_missing_file(self):
+        manifest = [('a.txt', '5d41402abc4b2a76b9719d911017c592', 'file:///does/not/exist')]
+        self.assertNotEquals(self._run(manifest), 0)
+
+    def test_stop_after_failure(self):
+        source = join(self.tempdir, 'source.txt')
+        open(source, 'wb').write('hello')
+        manifest = [('a.txt', '5d41402abc4b2a76b9719d911017c592', 'file:///does/not/exist'),
+                    ('b.txt', '5d41402abc4b2a76b9719d911017c592', 'file://' + source)]
+        self.assertNotEquals(self._run(manifest, concurrency=1), 0)
+        self.assertFalse(exists(join(self.tempdir, 'dst dir', 'b.txt')))
+
+    def test_home_and_special_names(self):
+        source = join(self.tempdir, 'source.txt')
+        open(source, 'wb').write('hello')
+        manifest = [("it's\ta \\file.txt", '5d41402abc4b2a76b9719d911017c592', 'file://' + source)]
+        self.assertEquals(self._run(manifest, remote_dir='~/home dir'), 0)
+        self.assertEquals(open(join(self.tempdir, 'home dir', "it's\ta \\file.txt")).read(), 'hello')
+        self.assertEquals(self._run([], remote_dir='~/empty'), 0)
+        self.assertRaises(ValueError, s3_download_script, '/tmp', [('a\nb', 'x', 'file:///x')])
+
+
+class TestShardedRsync(TestCase):
+    def setUp(self):
+        from os import makedirs
+        self.tempdir = mkdtemp()
+        self.local_dir = join(self.tempdir, 'tree')
+        for path, size in (('big/a/1', 4000), ('big/a/2', 4000), ('big/b/1', 4000),
+                           ('big/b/2', 4000), ('small/1', 1000), ('top', 10)):
+            path = join(self.local_dir, path)
+            if not exists(dirname(path)):
+                makedirs(dirname(path))
+            open(path, 'wb').write('x' * size)
+        awsfab_settings.reset_settings(EXTRA_SSH_ARGS='', SSH_CONTROLMASTER=False)
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_balance_shards(self):
+        self.assertEquals(balance_shards([('a', 5), ('b', 4), ('c', 3), ('d', 3), ('e', 1)], 2),
+                          [['a', 'd'], ['b', 'c', 'e']])
+        self.assertEquals(balance_shards([('a', 1)], 3), [['a']])
+        self.assertEquals(balance_shards([], 3), [])
+
+    def test_get_rsync_shard_units(self):
+        self.assertEquals(get_rsync_shard_units(self.local_dir, 1, file_cost=0),
+                          [('big', 16000), ('small', 1000), ('top', 10)])
+        self.assertEquals(get_rsync_shard_units(self.local_dir, 4, file_cost=0),
+                          [('big/a/1', 4000), ('big/a/2', 4000), ('big/b/1', 4000),
+                           ('big/b/2', 4000), ('small', 1000), ('top', 10)])
+
+    def test_get_rsync_shard_units_max_units(self):
+        from os import makedirs
+        makedirs(join(self.local_dir, 'flat'))
+        for index in xrange(30):
+            open(join(self.local_dir, 'flat', str(index)), 'wb').write('x' * 4000)
+        units = get_rsync_shard_units(self.local_dir, 2, file_cost=0, max_units_per_shard=5)
+        # flat has more children than the max number of units, so it is not split
+        self.assertTrue(('flat', 120000) in units)
+        self.assertTrue(len(units) <= 10)
+
+    def test_ec2_rsync_upload_sharded_commands(self):
+        filelist_dir = join(self.tempdir, 'lists')
+        from os import makedirs
+        makedirs(filelist_dir)
+        commands = ec2_rsync_upload_sharded_commands(TestRsync.MockEc2InstanceWrapper(),
+                                                     self.local_dir, '/srv', filelist_dir, shards=2)
+        self.assertEquals(len(commands), 2)
+        self.assertEquals(sorted(listdir(filelist_dir)), ['shard-1.list', 'shard-2.list'])
+        units = []
+        for filename in sorted(listdir(filelist_dir)):
+            units.extend(open(join(filelist_dir, filename), 'rb').read().split('\0')[:-1])
+        self.assertEquals(sorted(units), ['tree/big/a', 'tree/big/b', 'tree/small', 'tree/top'])
+        self.assertEquals(commands[0],
+                          'rsync -av --recursive --relative --from0 --files-from={0}/shard-1.list '
+                          '--stats -e "ssh -i /path/to/key.pem " {1}/./ test@example.com:/srv'.format(
+                              filelist_dir, self.tempdir))
+
+
+class TestTransfer(TestCase):
+    class MockInstance(object):
+        def __init__(self, key_name, public_dns_name, private_ip_address, vpc_id):
+            self.id = 'i-' + key_name
+            self.key_name = key_name
+            self.public_dns_name = public_dns_name
+            self.private_ip_address = private_ip_address
+            self.vpc_id = vpc_id
+            self.tags = {}
+
+    def setUp(self):
+        self.tempdir = mkdtemp()
+        for key_name in ('srckey', 'dstkey'):
+            open(join(self.tempdir, key_name + '.pem'), 'w').close()
+        awsfab_settings.reset_settings(KEYPAIR_PATH=[self.tempdir],
+                                       EC2_INSTANCE_DEFAULT_SSHUSER='root',
+                                       EXTRA_SSH_ARGS='-o StrictHostKeyChecking=no',
+                                       SSH_CONTROLMASTER=True)
+        self.source = Ec2InstanceWrapper(self.MockInstance('srckey', 'src.example.com',
+                                                           '10.0.0.1', 'vpc-1'))
+        self.destination = Ec2InstanceWrapper(self.MockInstance('dstkey', 'dst.example.com',
+                                                                '10.0.0.2', 'vpc-1'))
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_get_transfer_host(self):
+        self.assertEquals(get_transfer_host(self.source, self.destination), '10.0.0.2')
+        self.destination.instance.vpc_id = 'vpc-2'
+        self.assertEquals(get_transfer_host(self.source, self.destination), 'dst.example.com')
+        self.source.instance.vpc_id = self.destination.instance.vpc_id = None
+        self.assertEquals(get_transfer_host(self.source, self.destination), 'dst.example.com')
+        self.destination.instance.public_dns_name = ''
+        self.assertRaises(ValueError, get_transfer_host, self.source, self.destination)
+
+    def test_rsync(self):
+        command = ec2_transfer_command(self.source, self.destination, '/var/data/', '/srv')
+        self.assertTrue(command.startswith('(eval "$(ssh-agent -s)" > /dev/null'))
+        self.assertTrue('ssh-add -q {0}/dstkey.pem'.format(self.tempdir) in command)
+        self.assertTrue(' && ssh -A -i {0}/srckey.pem -o StrictHostKeyChecking=no '
+                        'root@src.example.com '.format(self.tempdir) in command)
+        self.assertFalse('ControlMaster' in command)
+        self.assertTrue(command.endswith(
+            """'rsync -av -e '"'"'ssh -o StrictHostKeyChecking=no'"'"' """
+            """/var/data root@10.0.0.2:/srv')"""))
+
+    def test_tar(self):
+        command = ec2_transfer_command(self.source, self.destination, '/var/data/', '/srv',
+                                       method='tar')
+        self.assertTrue(command.endswith(
+            """'tar -czf - -C /var data | ssh -o StrictHostKeyChecking=no root@10.0.0.2 """
+            """'"'"'mkdir -p /srv && tar -xzf - -C /srv'"'"'')"""))
+        command = ec2_transfer_command(self.source, self.destination, '/var/data/', '/srv',
+                                       method='tar', sync_content=True)
+        self.assertTrue("'tar -czf - -C /var/data . | " in command)
+
+    def test_invalid_method(self):
+        self.assertRaises(ValueError, ec2_transfer_command, self.source, self.destination,
+                          '/var/data', '/srv', method='scp')
+
+
 class TestEc2LaunchInstance(TestCase):
     class Ec2LaunchInstanceMock(Ec2LaunchInstance):
         def _ask_for_configname(self):
@@ -109,3 +353,665 @@ class TestEc2LaunchInstance(TestCase):
         launcher = self._create_launcher(settings={'EC2_LAUNCH_CONFIGS': {'ASKED': self.conf}},
                                          launcher_kw={'extra_tags': {'port': '15010'}})
         self.assertEquals(launcher.get_all_tags(), {'sshuser': 'test', 'port': '15010'})
+
+
+
+DESCRIBE_INSTANCES_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2014-10-01/">
+<requestId>abc</requestId>
+<reservationSet>
+  <item><reservationId>r-1</reservationId><ownerId>123</ownerId>
+    <groupSet><item><groupId>sg-1</groupId><groupName>default</groupName></item></groupSet>
+    <instancesSet>
+      <item><instanceId>i-1</instanceId><instanceState><code>16</code><name>running</name></instanceState>
+        <dnsName>web1.example.com</dnsName><keyName>mykey</keyName>
+        <tagSet><item><key>Name</key><value>web1</value></item><item><key>role</key><value>web</value></item></tagSet>
+        <networkInterfaceSet><item><networkInterfaceId>eni-1</networkInterfaceId></item></networkInterfaceSet>
+      </item>
+      <item><instanceId>i-2</instanceId><instanceState><code>16</code><name>running</name></instanceState>
+        <tagSet><item><key>Name</key><value>twin</value></item><item><key>role</key><value>web</value></item></tagSet>
+      </item>
+      <item><instanceId>i-3</instanceId><instanceState><code>80</code><name>stopped</name></instanceState>
+        <tagSet><item><key>Name</key><value>twin</value></item><item><key>role</key><value>db</value></item></tagSet>
+      </item>
+    </instancesSet>
+  </item>
+  <item><reservationId>r-2</reservationId><ownerId>123</ownerId>
+    <instancesSet>
+      <item><instanceId>i-4</instanceId><instanceState><code>16</code><name>running</name></instanceState>
+        <tagSet><item><key>Name</key><value>web1</value></item></tagSet>
+      </item>
+      <item><instanceId>i-5</instanceId><instanceState><code>16</code><name>running</name></instanceState>
+        <tagSet><item><key>Name</key><value>db1</value></item><item><key>role</key><value>db</value></item></tagSet>
+      </item>
+    </instancesSet>
+  </item>
+</reservationSet>
+</DescribeInstancesResponse>"""
+
+def parse_reservations(connection, xmlbody=DESCRIBE_INSTANCES_XML):
+    import xml.sax
+    from boto import handler
+    from boto.resultset import ResultSet
+    from boto.ec2.instance import Reservation
+    reservations = ResultSet([('item', Reservation)])
+    xml.sax.parseString(xmlbody, handler.XmlHandler(reservations, connection))
+    return reservations
+
+
+class TestEc2InstanceIndex(TestCase):
+    def setUp(self):
+        from boto.ec2.connection import EC2Connection
+        self.index = Ec2InstanceIndex(parse_reservations(EC2Connection('a', 'b')))
+
+    def test_get_by_name(self):
+        self.assertEquals(self.index.get_by_name('db1').id, 'i-5')
+        self.assertRaises(NoInstanceWithNameFound, self.index.get_by_name, 'nope')
+        self.assertRaises(MultipleInstancesWithSameNameError, self.index.get_by_name, 'web1')
+        self.assertRaises(NotExactlyOneInstanceError, self.index.get_by_name, 'twin')
+
+    def test_get_by_id(self):
+        self.assertEquals(self.index.get_by_id('i-3').tags['role'], 'db')
+        self.assertRaises(LookupError, self.index.get_by_id, 'i-x')
+
+    def test_filter_by_tags(self):
+        self.assertEquals([i.id for i in self.index.filter_by_tags({'role': 'db'})], ['i-3', 'i-5'])
+        self.assertEquals([i.id for i in self.index.filter_by_tags({'role': 'web', 'Name': 'twin'})], ['i-2'])
+        self.assertEquals(self.index.filter_by_tags({'role': 'none'}), [])
+
+
+class TestEc2Inventory(TestCase):
+    def setUp(self):
+        from boto.ec2 import connect_to_region
+        self.cachedir = mkdtemp()
+        awsfab_settings.reset_settings(AUTH={'aws_access_key_id': 'a', 'aws_secret_access_key': 'b'},
+                                       DEFAULT_REGION='eu-west-1',
+                                       EC2_INVENTORY_CACHE_DIR=self.cachedir,
+                                       EC2_INVENTORY_CACHE_TTL=300,
+                                       CONNECTION_MAX_IDLE=300)
+        self.connection = connect_to_region('eu-west-1', **awsfab_settings.AUTH)
+
+    def tearDown(self):
+        rmtree(self.cachedir)
+
+    def test_disk_cache(self):
+        Ec2Inventory().set_reservations('eu-west-1', parse_reservations(self.connection))
+        self.assertEquals(len(listdir(self.cachedir)), 1)
+        index = Ec2Inventory().get_cached_index('eu-west-1')
+        instance = index.get_by_id('i-1')
+        self.assertEquals(instance.tags['Name'], 'web1')
+        self.assertEquals(instance.public_dns_name, 'web1.example.com')
+        self.assertEquals(instance.connection.region.name, 'eu-west-1')
+        self.assertEquals(Ec2Inventory().get_cached_index('us-east-1'), None)
+
+    def test_disk_cache_ttl(self):
+        awsfab_settings.EC2_INVENTORY_CACHE_TTL = -1
+        Ec2Inventory().set_reservations('eu-west-1', parse_reservations(self.connection))
+        self.assertEquals(Ec2Inventory().get_cached_index('eu-west-1'), None)
+
+    def test_invalidate(self):
+        inventory = Ec2Inventory()
+        inventory.set_reservations('eu-west-1', parse_reservations(self.connection))
+        self.assertNotEquals(inventory.get_cached_index('eu-west-1'), None)
+        inventory.invalidate('eu-west-1')
+        self.assertEquals(inventory.get_cached_index('eu-west-1'), None)
+        self.assertEquals(listdir(self.cachedir), [])
+
+    def test_invalidate_current_credentials(self):
+        Ec2Inventory().set_reservations('eu-west-1', parse_reservations(self.connection))
+        awsfab_settings.AUTH = {'aws_access_key_id': 'other', 'aws_secret_access_key': 'b'}
+        Ec2Inventory().set_reservations('eu-west-1', parse_reservations(self.connection))
+        Ec2Inventory().invalidate()
+        self.assertEquals(len(listdir(self.cachedir)), 1)
+        awsfab_settings.AUTH = {'aws_access_key_id': 'a', 'aws_secret_access_key': 'b'}
+        self.assertNotEquals(Ec2Inventory().get_cached_index('eu-west-1'), None)
+
+    def test_disk_cache_permissions(self):
+        cachedir = join(self.cachedir, 'sub')
+        awsfab_settings.EC2_INVENTORY_CACHE_DIR = cachedir
+        Ec2Inventory().set_reservations('eu-west-1', parse_reservations(self.connection))
+        self.assertEquals(S_IMODE(stat(cachedir).st_mode), 0700)
+        cachefile, = listdir(cachedir)
+        self.assertEquals(S_IMODE(stat(join(cachedir, cachefile)).st_mode), 0600)
+        chmod(join(cachedir, cachefile), 0666)
+        self.assertEquals(Ec2Inventory().get_cached_index('eu-west-1'), None)
+
+
+class TestEc2InstanceResolver(TestCase):
+    class MockResolver(Ec2InstanceResolver):
+        def __init__(self, connection):
+            super(TestEc2InstanceResolver.MockResolver, self).__init__()
+            self.connection = connection
+            self.describe_calls = []
+        def _describe(self, region, filters):
+            self.describe_calls.append((region, filters))
+            return parse_reservations(self.connection)
+
+    def setUp(self):
+        from boto.ec2.connection import EC2Connection
+        awsfab_settings.reset_settings(DEFAULT_REGION='eu-west-1',
+                                       EC2_INVENTORY_CACHE_DIR=None)
+        self.connection = EC2Connection('a', 'b')
+        self.resolver = self.MockResolver(self.connection)
+
+    def tearDown(self):
+        ec2_inventory.invalidate()
+
+    def _ids(self, results):
+        return [[wrapper['id'] for wrapper in wrappers] for wrappers in results]
+
+    def test_one_filtered_request_per_region(self):
+        self.resolver.add_name('db1')
+        self.resolver.add_name('us-east-1:db1')
+        self.resolver.add_name('eu-west-1:db1')
+        self.assertEquals(self._ids(self.resolver.resolve()), [['i-5'], ['i-5'], ['i-5']])
+        self.assertEquals(sorted(self.resolver.describe_calls),
+                          [('eu-west-1', {'tag:Name': ['db1']}),
+                           ('us-east-1', {'tag:Name': ['db1']})])
+
+    def test_filters(self):
+        self.resolver.add_instanceid('i-1')
+        self.resolver.add_instanceid('i-3')
+        self.resolver.resolve()
+        self.assertEquals(self.resolver._get_filters([('tags', {'role': 'db', 'a': 'b'})]),
+                          {'tag:role': 'db', 'tag:a': 'b'})
+        self.assertEquals(self.resolver.describe_calls,
+                          [('eu-west-1', {'instance-id': ['i-1', 'i-3']})])
+
+    def test_filter_chunks(self):
+        self.resolver.filter_chunksize = 2
+        for name in ('w1', 'w2', 'w3', 'w4', 'w5'):
+            self.resolver.add_name(name)
+        self.resolver._get_index('eu-west-1', [(kind, value) for kind, region, value
+                                               in self.resolver._lookups])
+        self.assertEquals(self.resolver.describe_calls,
+                          [('eu-west-1', {'tag:Name': ['w1', 'w2']}),
+                           ('eu-west-1', {'tag:Name': ['w3', 'w4']}),
+                           ('eu-west-1', {'tag:Name': ['w5']})])
+
+    def test_mixed_lookups_use_inventory(self):
+        ec2_inventory.set_reservations('eu-west-1', parse_reservations(self.connection))
+        self.resolver.add_instanceid('i-1')
+        self.resolver.add_name('db1')
+        web = self.resolver.add_tags({'role': 'web'})
+        results = self.resolver.resolve()
+        self.assertEquals(self._ids(results), [['i-1'], ['i-5'], ['i-1', 'i-2']])
+        self.assertEquals(self._ids([results[web]]), [['i-1', 'i-2']])
+        self.assertEquals(self.resolver.describe_calls, [])
+
+    def test_lookup_errors(self):
+        self.resolver.add_name('db1')
+        self.resolver.add_name('web1')
+        self.assertRaises(MultipleInstancesWithSameNameError, self.resolver.resolve)
+        resolver = self.MockResolver(self.connection)
+        resolver.add_instanceid('i-x')
+        self.assertRaises(LookupError, resolver.resolve)
+
+
+class TestRegions(TestCase):
+    def test_parse_regionnames(self):
+        self.assertEquals(parse_regionnames('eu-west-1'), ['eu-west-1'])
+        self.assertEquals(parse_regionnames('eu-west-1;us-east-1'), ['eu-west-1', 'us-east-1'])
+        self.assertEquals(parse_regionnames('eu-west-1, us-east-1,'), ['eu-west-1', 'us-east-1'])
+
+    def test_map_regions(self):
+        def func(regionname):
+            if regionname == 'broken':
+                raise IOError('Timeout')
+            return regionname.upper()
+        results = map_regions(func, ['us-east-1', 'broken', 'eu-west-1'])
+        self.assertEquals([(name, result) for name, result, error in results],
+                          [('broken', None), ('eu-west-1', 'EU-WEST-1'), ('us-east-1', 'US-EAST-1')])
+        self.assertTrue(isinstance(results[0][2], IOError))
+
+
+class TestEc2StateWaiter(TestCase):
+    class MockInstance(object):
+        def __init__(self, id, state):
+            self.id = id
+            self.state = state
+
+    class MockWaiter(Ec2StateWaiter):
+        def __init__(self, states, **kwargs):
+            super(TestEc2StateWaiter.MockWaiter, self).__init__(**kwargs)
+            # {(region, instanceid): [state for each poll]}, where a state of
+            # None means that the instance is not visible yet.
+            self.states = states
+            self.describe_calls = []
+            self.sleeps = []
+        def _describe(self, region, instanceids):
+            self.describe_calls.append((region, instanceids))
+            instances = []
+            for instanceid in instanceids:
+                state = self.states[(region, instanceid)].pop(0)
+                if state:
+                    instances.append(TestEc2StateWaiter.MockInstance(instanceid, state))
+            return instances
+        def _sleep(self, seconds):
+            self.sleeps.append(seconds)
+
+    def setUp(self):
+        awsfab_settings.reset_settings(DEFAULT_REGION='eu-west-1')
+
+    def test_wait(self):
+        reached = []
+        waiter = self.MockWaiter({('eu-west-1', 'i-1'): ['pending', 'running'],
+                                  ('eu-west-1', 'i-2'): [None, 'pending', 'pending', 'running'],
+                                  ('us-east-1', 'i-3'): ['stopped']},
+                                 interval=2, max_interval=3, backoff=2, jitter=0,
+                                 callback=lambda instance, elapsed: reached.append(instance.id))
+        waiter.add('i-1', 'running')
+        waiter.add('i-2', 'running')
+        waiter.add('us-east-1:i-3', 'stopped')
+        waiter.wait()
+        self.assertEquals(reached, ['i-3', 'i-1', 'i-2'])
+        self.assertEquals(waiter.describe_calls,
+                          [('eu-west-1', ['i-1', 'i-2']), ('us-east-1', ['i-3']),
+                           ('eu-west-1', ['i-1', 'i-2']),
+                           ('eu-west-1', ['i-2']),
+                           ('eu-west-1', ['i-2'])])
+        self.assertEquals(waiter.sleeps, [2, 3, 3])
+        self.assertEquals(waiter.pending, {})
+        self.assertEquals(sorted(waiter.elapsed.keys()),
+                          [('eu-west-1', 'i-1'), ('eu-west-1', 'i-2'), ('us-east-1', 'i-3')])
+
+    def test_final_state(self):
+        waiter = self.MockWaiter({('eu-west-1', 'i-1'): ['terminated']})
+        waiter.add('i-1', 'running')
+        self.assertRaises(WaitForStateError, waiter.wait)
+
+    def test_timeout(self):
+        waiter = self.MockWaiter({('eu-west-1', 'i-1'): ['pending']}, timeout=0)
+        waiter.add('i-1', 'running')
+        self.assertRaises(WaitForStateError, waiter.wait)
+        self.assertEquals(waiter.format_pending(), 'eu-west-1:i-1=running')
+
+    def test_legacy_launcher_kwargs(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            kwargs = Ec2LaunchInstance._get_waiter_kwargs({'sleep_intervals': [10, 4],
+                                                           'last_sleep_repeat': 5})
+            self.assertEquals(Ec2LaunchInstance._get_waiter_kwargs({'timeout': 60}),
+                              {'timeout': 60})
+        self.assertEquals(kwargs, {'timeout': 34, 'interval': 10, 'max_interval': 4})
+        self.assertEquals(len(caught), 1)
+        self.assertTrue(issubclass(caught[0].category, DeprecationWarning))
+        Ec2StateWaiter(**kwargs)
+
+
+class TestSshReadinessWaiter(TestCase):
+    class MockInstanceWrapper(dict):
+        get_ssh_host = Ec2InstanceWrapper.__dict__['get_ssh_host']
+        def prettyname(self):
+            return self['id']
+
+    class MockWaiter(SshReadinessWaiter):
+        def __init__(self, ready, **kwargs):
+            super(TestSshReadinessWaiter.MockWaiter, self).__init__(**kwargs)
+            self.ready = ready # {instanceid: [probe result for each poll]}
+            self.sleeps = []
+        def probe(self, instancewrapper):
+            return self.ready[instancewrapper['id']].pop(0)
+        def _sleep(self, seconds):
+            self.sleeps.append(seconds)
+
+    def _listen(self, banner):
+        import socket
+        from threading import Thread
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        def serve():
+            client, address = server.accept()
+            client.sendall(banner)
+            client.close()
+            server.close()
+        thread = Thread(target=serve)
+        thread.start()
+        return server.getsockname()[1], thread
+
+    def test_get_host(self):
+        waiter = SshReadinessWaiter()
+        self.assertEquals(waiter.get_host(self.MockInstanceWrapper(
+            public_dns_name='a.example.com', ip_address='1.2.3.4', private_ip_address='10.0.0.1')),
+            'a.example.com')
+        self.assertEquals(waiter.get_host(self.MockInstanceWrapper(
+            public_dns_name='', ip_address=None, private_ip_address='10.0.0.1')),
+            '10.0.0.1')
+        self.assertEquals(waiter.get_host(self.MockInstanceWrapper(
+            public_dns_name='', ip_address=None, private_ip_address=None)),
+            None)
+
+    def test_wait(self):
+        ready = []
+        waiter = self.MockWaiter({'i-1': [False, False, False, True],
+                                  'i-2': [False, True]},
+                                 interval=1, max_interval=3, backoff=2,
+                                 callback=lambda instancewrapper, latency: ready.append(instancewrapper['id']))
+        waiter.add(self.MockInstanceWrapper(id='i-1'))
+        waiter.add(self.MockInstanceWrapper(id='i-2'))
+        waiter.wait()
+        self.assertEquals(ready, ['i-2', 'i-1'])
+        self.assertEquals(waiter.sleeps, [1, 1, 2])
+        self.assertEquals(sorted(waiter.latency.keys()), ['i-1', 'i-2'])
+
+    def test_timeout(self):
+        waiter = self.MockWaiter({'i-1': [False]}, timeout=0)
+        waiter.add(self.MockInstanceWrapper(id='i-1'))
+        self.assertRaises(WaitForSshError, waiter.wait)
+
+    def test_probe(self):
+        port, thread = self._listen('SSH-2.0-OpenSSH_test\r\n')
+        waiter = SshReadinessWaiter(port=port, connect_timeout=2)
+        self.assertTrue(waiter.probe(self.MockInstanceWrapper(public_dns_name='127.0.0.1')))
+        thread.join()
+        # The server is closed, so the connection is refused
+        self.assertFalse(waiter.probe(self.MockInstanceWrapper(public_dns_name='127.0.0.1')))
+
+    def test_probe_banner(self):
+        port, thread = self._listen('HTTP/1.0 400 Bad Request\r\n')
+        waiter = SshReadinessWaiter(port=port, connect_timeout=2)
+        self.assertFalse(waiter.probe(self.MockInstanceWrapper(public_dns_name='127.0.0.1')))
+        thread.join()
+
+
+class MockEc2Connection(object):
+    """
+    Records the requests made by :class:`Ec2LaunchInstance`.
+    """
+    class MockInstance(object):
+        def __init__(self, id, tags=None):
+            self.id = id
+            self.tags = tags or {}
+
+    class MockReservation(object):
+        def __init__(self, instances):
+            self.instances = instances
+
+    def __init__(self, existing_names=(), notfound_count=0):
+        self.existing_names = existing_names
+        self.notfound_count = notfound_count # Number of create_tags calls failing with NotFound
+        self.calls = []
+        self.instancecount = 0
+
+    def run_instances(self, ami, min_count=1, max_count=1, **kw):
+        self.calls.append(('run_instances', ami, min_count, kw['instance_type']))
+        instances = []
+        for x in xrange(max_count):
+            self.instancecount += 1
+            instances.append(self.MockInstance('i-{0}'.format(self.instancecount)))
+        return self.MockReservation(instances)
+
+    def create_tags(self, instanceids, tags):
+        from boto.exception import EC2ResponseError
+        self.calls.append(('create_tags', instanceids, tags))
+        if self.notfound_count:
+            self.notfound_count -= 1
+            error = EC2ResponseError(400, 'Bad Request')
+            error.error_code = 'InvalidInstanceID.NotFound'
+            raise error
+
+    def delete_tags(self, instanceids, tagnames):
+        self.calls.append(('delete_tags', instanceids, tagnames))
+
+    def start_instances(self, instanceids):
+        self.calls.append(('start_instances', instanceids))
+
+    def stop_instances(self, instanceids):
+        self.calls.append(('stop_instances', instanceids))
+
+    def get_all_instances(self, filters):
+        self.calls.append(('get_all_instances', filters))
+        if 'instance-id' in filters:
+            return [self.MockReservation([self.MockInstance(instanceid)
+                                          for instanceid in filters['instance-id']])]
+        return [self.MockReservation([self.MockInstance('i-x', {'Name': name})
+                                      for name in filters['tag:Name']
+                                      if name in self.existing_names])]
+
+
+class TestEc2LaunchInstanceMany(TestCase):
+    def setUp(self):
+        conf = {'instance_type': 't1.micro',
+                'key_name': 'awstestkey',
+                'security_groups': ['testgroup'],
+                'region': 'eu-west-1',
+                'ami': 'ami-1',
+                'tags': {'role': 'worker'}}
+        awsfab_settings.reset_settings(EC2_LAUNCH_CONFIGS={'worker': conf,
+                                                           'big': dict(conf, instance_type='m1.large')},
+                                       EC2_INVENTORY_CACHE_DIR=None,
+                                       AUTH={}, CONNECTION_MAX_IDLE=300)
+        self.connection = MockEc2Connection(existing_names=['old'])
+        connection_registry.clear()
+        self.connect_to_region = ec2_api.connect_to_region
+        ec2_api.connect_to_region = lambda region_name, **auth: self.connection
+
+    def tearDown(self):
+        ec2_api.connect_to_region = self.connect_to_region
+        connection_registry.clear()
+
+    def _create_launchers(self, names, configname='worker'):
+        return [Ec2LaunchInstance(extra_tags={'Name': name}, configname=configname,
+                                  duplicate_name_protection=False)
+                for name in names]
+
+    def test_group_tags(self):
+        self.assertEquals(group_tags({'i-1': {'Name': 'a', 'role': 'web'},
+                                      'i-2': {'Name': 'b', 'role': 'web'},
+                                      'i-3': {'Name': 'c', 'role': 'web', 'x': 'y'}}),
+                          [(['i-1'], {'Name': 'a'}),
+                           (['i-1', 'i-2', 'i-3'], {'role': 'web'}),
+                           (['i-2'], {'Name': 'b'}),
+                           (['i-3'], {'Name': 'c', 'x': 'y'})])
+        self.assertEquals(group_tags({'i-1': {}}), [])
+
+    def test_run_many_instances(self):
+        launchers = self._create_launchers(['w1', 'w2', 'w3']) + self._create_launchers(['b1'], 'big')
+        instances = Ec2LaunchInstance.run_many_instances(launchers)
+        self.assertEquals([launcher.instance for launcher in launchers], instances)
+        self.assertEquals([call for call in self.connection.calls if call[0] == 'run_instances'],
+                          [('run_instances', 'ami-1', 1, 'm1.large'),
+                           ('run_instances', 'ami-1', 3, 't1.micro')])
+        self.assertEquals(len(self.connection.calls), 7)
+        self.assertTrue(('create_tags', ['i-1', 'i-2', 'i-3', 'i-4'], {'role': 'worker'}) in self.connection.calls)
+        self.assertTrue(('create_tags', ['i-1'], {'Name': 'b1'}) in self.connection.calls)
+
+    def test_run_many_instances_tag_failure(self):
+        from boto.exception import EC2ResponseError
+        def create_tags(instanceids, tags):
+            self.connection.calls.append(('create_tags', instanceids, tags))
+            if 'Name' in tags and tags['Name'] == 'b1':
+                raise EC2ResponseError(400, 'Bad Request')
+        self.connection.create_tags = create_tags
+        launchers = self._create_launchers(['w1', 'w2']) + self._create_launchers(['b1'], 'big')
+        self.assertRaises(EC2ResponseError, self.MockLaunchInstance.run_many_instances, launchers)
+        # All the other tag requests are still made
+        self.assertEquals(sorted(set(tuple(call[1]) for call in self.connection.calls
+                                     if call[0] == 'create_tags')),
+                          [('i-1',), ('i-1', 'i-2', 'i-3'), ('i-2',), ('i-3',)])
+        self.assertEquals([launcher.instance.tags for launcher in launchers],
+                          [{'Name': 'w1', 'role': 'worker'}, {'Name': 'w2', 'role': 'worker'}, {}])
+
+    def test_run_many_instances_launch_failure(self):
+        run_instances = self.connection.run_instances
+        def failing_run_instances(ami, min_count=1, max_count=1, **kw):
+            if kw['instance_type'] == 't1.micro':
+                raise ValueError('Launch failed')
+            return run_instances(ami, min_count, max_count, **kw)
+        self.connection.run_instances = failing_run_instances
+        launchers = self._create_launchers(['w1']) + self._create_launchers(['b1'], 'big')
+        self.assertRaises(ValueError, Ec2LaunchInstance.run_many_instances, launchers)
+        # The instance launched before the failure is tagged
+        self.assertEquals(launchers[1].instance.tags, {'Name': 'b1', 'role': 'worker'})
+        self.assertTrue(('create_tags', ['i-1'], {'Name': 'b1', 'role': 'worker'}) in self.connection.calls)
+
+    def test_check_if_name_exists_many(self):
+        Ec2LaunchInstance.check_if_name_exists_many(self._create_launchers(['w1', 'w2']))
+        self.assertEquals(self.connection.calls, [('get_all_instances', {'tag:Name': ['w1', 'w2']})])
+        self.assertRaises(SystemExit, Ec2LaunchInstance.check_if_name_exists_many,
+                          self._create_launchers(['w1', 'old']))
+        self.assertRaises(SystemExit, Ec2LaunchInstance.check_if_name_exists_many,
+                          self._create_launchers(['w1', 'w1']))
+
+    def test_run_instance_single_tag_request(self):
+        launcher = self._create_launchers(['w1'])[0]
+        instance = launcher.run_instance()
+        self.assertEquals(self.connection.calls,
+                          [('run_instances', 'ami-1', 1, 't1.micro'),
+                           ('create_tags', ['i-1'], {'Name': 'w1', 'role': 'worker'})])
+        self.assertEquals(instance.tags, {'Name': 'w1', 'role': 'worker'})
+
+    class MockLaunchInstance(Ec2LaunchInstance):
+        sleeps = []
+
+        @classmethod
+        def _sleep(cls, seconds):
+            cls.sleeps.append(seconds)
+
+    def test_create_tags_waits_until_visible(self):
+        self.connection.notfound_count = 2
+        self.MockLaunchInstance.sleeps = []
+        self.MockLaunchInstance._create_tags(self.connection, ['i-1'], {'a': 'b'})
+        self.assertEquals(self.MockLaunchInstance.sleeps, [0.5, 1])
+        self.assertEquals(self.connection.calls,
+                          [('create_tags', ['i-1'], {'a': 'b'}),
+                           ('get_all_instances', {'instance-id': ['i-1']}),
+                           ('create_tags', ['i-1'], {'a': 'b'}),
+                           ('get_all_instances', {'instance-id': ['i-1']}),
+                           ('create_tags', ['i-1'], {'a': 'b'})])
+
+    def test_create_tags_gives_up(self):
+        from boto.exception import EC2ResponseError
+        self.connection.notfound_count = 100
+        self.MockLaunchInstance.sleeps = []
+        self.assertRaises(EC2ResponseError, self.MockLaunchInstance._create_tags,
+                          self.connection, ['i-1'], {'a': 'b'})
+        self.assertEquals(len([call for call in self.connection.calls if call[0] == 'create_tags']),
+                          Ec2LaunchInstance.tag_retry_count + 1)
+        self.assertEquals(self.MockLaunchInstance.sleeps, [0.5, 1, 2, 4, 5, 5, 5, 5])
+
+
+class TestBulk(TestCase):
+    def setUp(self):
+        from boto.regioninfo import RegionInfo
+        awsfab_settings.reset_settings(AUTH={}, CONNECTION_MAX_IDLE=300,
+                                       EC2_INVENTORY_CACHE_DIR=None)
+        self.connections = {}
+        self.instancewrappers = []
+        connection_registry.clear()
+        self.connect_to_region = ec2_api.connect_to_region
+        ec2_api.connect_to_region = lambda region_name, **auth: self.connections[region_name]
+        for region, instanceids in (('eu-west-1', ['i-1', 'i-2']), ('us-east-1', ['i-3'])):
+            self.connections[region] = MockEc2Connection()
+            for instanceid in instanceids:
+                instance = MockEc2Connection.MockInstance(instanceid, {'a': 'b'})
+                instance.region = RegionInfo(name=region)
+                self.instancewrappers.append(Ec2InstanceWrapper(instance))
+
+    def tearDown(self):
+        ec2_api.connect_to_region = self.connect_to_region
+        connection_registry.clear()
+
+    def test_bulk_create_tags(self):
+        bulk_create_tags(self.instancewrappers, {'role': 'web'})
+        self.assertEquals(self.connections['eu-west-1'].calls,
+                          [('create_tags', ['i-1', 'i-2'], {'role': 'web'})])
+        self.assertEquals(self.connections['us-east-1'].calls,
+                          [('create_tags', ['i-3'], {'role': 'web'})])
+        self.assertEquals(self.instancewrappers[0]['tags'], {'a': 'b', 'role': 'web'})
+
+    def test_bulk_delete_tags(self):
+        bulk_delete_tags(self.instancewrappers, ['a'])
+        self.assertEquals(self.connections['eu-west-1'].calls,
+                          [('delete_tags', ['i-1', 'i-2'], ['a'])])
+        self.assertEquals(self.instancewrappers[2]['tags'], {})
+
+    def test_bulk_start_and_stop_instances(self):
+        bulk_start_instances(self.instancewrappers)
+        bulk_stop_instances(self.instancewrappers)
+        self.assertEquals(self.connections['eu-west-1'].calls,
+                          [('start_instances', ['i-1', 'i-2']), ('stop_instances', ['i-1', 'i-2'])])
+        self.assertEquals(self.connections['us-east-1'].calls,
+                          [('start_instances', ['i-3']), ('stop_instances', ['i-3'])])
+
+
+class TestSelectedInstances(TestCase):
+    def setUp(self):
+        self.tempdir = mkdtemp()
+        open(join(self.tempdir, 'testkey.pem'), 'w').close()
+        awsfab_settings.reset_settings(KEYPAIR_PATH=[self.tempdir],
+                                       EC2_INSTANCE_DEFAULT_SSHUSER='root')
+        self.envkeys = ('ec2instances', 'ec2instances_by_id', 'key_filename')
+        self.saved_env = dict((key, env.pop(key)) for key in self.envkeys if key in env)
+        env.key_filename = None
+
+    def tearDown(self):
+        for key in self.envkeys:
+            env.pop(key, None)
+        env.update(self.saved_env)
+        rmtree(self.tempdir)
+
+    def test_get_selected_stopped_instances(self):
+        for instanceid in ('i-5', 'i-2', 'i-3', 'i-1', 'i-4'):
+            instance = MockEc2Connection.MockInstance(instanceid, {})
+            instance.key_name = 'testkey'
+            instance.public_dns_name = None if instanceid != 'i-1' else 'i-1.example.com'
+            instance.ip_address = None
+            instance.private_ip_address = None if instanceid != 'i-2' else '10.0.0.2'
+            instance.state = 'stopped'
+            Ec2InstanceWrapper(instance).add_instance_to_env()
+        self.assertEquals(sorted(env.ec2instances.keys()),
+                          ['root@10.0.0.2', 'root@None', 'root@i-1.example.com'])
+        self.assertEquals([instancewrapper['id'] for instancewrapper in Ec2InstanceWrapper.get_selected()],
+                          ['i-1', 'i-2', 'i-3', 'i-4', 'i-5'])
+
+
+class TestListInstances(TestCase):
+    class MockPagingConnection(object):
+        def __init__(self, pages):
+            self.pages = pages
+            self.calls = []
+        def get_all_reservations(self, filters=None, max_results=None, next_token=None):
+            from boto.resultset import ResultSet
+            self.calls.append((filters, max_results, next_token))
+            index = int(next_token or 0)
+            reservations = ResultSet()
+            reservations.extend(self.pages[index])
+            if index + 1 < len(self.pages):
+                reservations.next_token = str(index + 1)
+            return reservations
+
+    def test_parse_tagvalues(self):
+        self.assertEquals(parse_tagvalues('role=web;env=prod'), {'role': 'web', 'env': 'prod'})
+        self.assertEquals(parse_tagvalues('a=b=c'), {'a': 'b=c'})
+        self.assertEquals(parse_tagvalues(''), {})
+
+    def test_get_instance_filters(self):
+        self.assertEquals(get_instance_filters(), {})
+        self.assertEquals(get_instance_filters(state='running;stopped', tags='role=web',
+                                               instance_type='m1.small', vpc='vpc-1'),
+                          {'instance-state-name': ['running', 'stopped'],
+                           'tag:role': 'web',
+                           'instance-type': ['m1.small'],
+                           'vpc-id': ['vpc-1']})
+        self.assertEquals(get_instance_filters(tags={'a': 'b'}), {'tag:a': 'b'})
+
+    def test_iter_reservations(self):
+        connection = self.MockPagingConnection([['r-1', 'r-2'], ['r-3'], []])
+        self.assertEquals(list(iter_reservations(connection, {'a': 'b'}, page_size=2)),
+                          ['r-1', 'r-2', 'r-3'])
+        self.assertEquals(connection.calls, [({'a': 'b'}, 2, None),
+                                             ({'a': 'b'}, 2, '1'),
+                                             ({'a': 'b'}, 2, '2')])
+
+    def test_instance_as_dict(self):
+        import json
+        from boto.ec2.connection import EC2Connection
+        instance = parse_reservations(EC2Connection('a', 'b'))[0].instances[0]
+        info = instance_as_dict(instance, 'eu-west-1')
+        self.assertEquals(info['id'], 'i-1')
+        self.assertEquals(info['region'], 'eu-west-1')
+        self.assertEquals(info['state'], 'running')
+        self.assertEquals(info['tags'], {'Name': 'web1', 'role': 'web'})
+        self.assertEquals(json.loads(json.dumps(info))['public_dns_name'], 'web1.example.com')
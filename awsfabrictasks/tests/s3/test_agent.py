@@ -0,0 +1,115 @@
+from unittest import TestCase
+from shutil import rmtree
+from tempfile import mkdtemp
+from os import makedirs
+from os.path import join, exists
+from StringIO import StringIO
+from threading import Thread
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import json
+
+from awsfabrictasks.s3 import agent
+
+
+class MockS3Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_PUT(self):
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.files[self.path] = data
+        self.server.contenttypes[self.path] = self.headers['Content-Type']
+        self.send_response(200)
+        self.send_header('ETag', '"{0}"'.format(agent.md5(data).hexdigest()))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestS3Agent(TestCase):
+    def setUp(self):
+        self.tempdir = mkdtemp()
+        self.server = HTTPServer(('127.0.0.1', 0), MockS3Handler)
+        self.server.files = {'/a.txt': 'hello', '/sub/b.txt': 'world'}
+        self.server.contenttypes = {}
+        self.thread = Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.baseurl = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        rmtree(self.tempdir)
+
+    def _write(self, path, data):
+        path = join(self.tempdir, path)
+        if not exists(join(self.tempdir, 'sub')):
+            makedirs(join(self.tempdir, 'sub'))
+        open(path, 'wb').write(data)
+
+    def test_download(self):
+        self._write('a.txt', 'hello')
+        job = {'action': 'download', 'directory': self.tempdir, 'workers': 2,
+               'files': [{'path': 'a.txt', 'url': self.baseurl + '/a.txt',
+                          'md5': '5d41402abc4b2a76b9719d911017c592'},
+                         {'path': 'sub/b.txt', 'url': self.baseurl + '/sub/b.txt',
+                          'md5': '7d793037a0760186574b0282f2f435e7'}]}
+        out = StringIO()
+        self.assertEquals(agent.transfer(job, out), 0)
+        self.assertEquals(open(join(self.tempdir, 'sub', 'b.txt')).read(), 'world')
+        self.assertTrue('a.txt: skipped (0 bytes)' in out.getvalue())
+        self.assertTrue('sub/b.txt: downloaded (5 bytes)' in out.getvalue())
+        self.assertTrue('downloaded 1, skipped 1: 2 files, 5 bytes' in out.getvalue())
+
+    def test_download_failures(self):
+        job = {'action': 'download', 'directory': self.tempdir, 'workers': 2,
+               'files': [{'path': 'a.txt', 'url': self.baseurl + '/a.txt', 'md5': 'invalid'},
+                         {'path': 'missing.txt', 'url': self.baseurl + '/missing.txt'}]}
+        out = StringIO()
+        self.assertEquals(agent.transfer(job, out), 2)
+        self.assertTrue('a.txt: FAILED: md5 mismatch' in out.getvalue())
+        self.assertTrue('missing.txt: FAILED: GET failed with HTTP status 404' in out.getvalue())
+        self.assertFalse(exists(join(self.tempdir, 'a.txt')))
+        self.assertFalse(exists(join(self.tempdir, 'a.txt.awsfab-part')))
+
+    def test_upload(self):
+        self._write('sub/c.txt', 'new')
+        job = {'action': 'upload', 'directory': self.tempdir, 'workers': 2,
+               'files': [{'path': 'sub/c.txt', 'url': self.baseurl + '/c.txt?Signature=x'}]}
+        self.assertEquals(agent.transfer(job, StringIO()), 0)
+        self.assertEquals(self.server.files['/c.txt?Signature=x'], 'new')
+        self.assertEquals(self.server.contenttypes['/c.txt?Signature=x'],
+                          agent.UPLOAD_CONTENT_TYPE)
+
+    def test_upload_too_large(self):
+        self._write('c.txt', 'new')
+        max_upload_size = agent.MAX_UPLOAD_SIZE
+        agent.MAX_UPLOAD_SIZE = 2
+        try:
+            job = {'action': 'upload', 'directory': self.tempdir, 'workers': 1,
+                   'files': [{'path': 'c.txt', 'url': self.baseurl + '/c.txt?Signature=x'}]}
+            out = StringIO()
+            self.assertEquals(agent.transfer(job, out), 1)
+        finally:
+            agent.MAX_UPLOAD_SIZE = max_upload_size
+        self.assertTrue('more than S3 accepts in a single PUT' in out.getvalue())
+        self.assertFalse('/c.txt?Signature=x' in self.server.files)
+
+    def test_scan(self):
+        self._write('a.txt', 'hello')
+        self._write('sub/b.txt', 'world')
+        self.assertEquals(agent.scan(self.tempdir), ['a.txt', 'sub/b.txt'])
+        self.assertEquals(agent.scan_files(self.tempdir, 2),
+                          {'a.txt': {'md5': '5d41402abc4b2a76b9719d911017c592', 'size': 5},
+                           'sub/b.txt': {'md5': '7d793037a0760186574b0282f2f435e7', 'size': 5}})
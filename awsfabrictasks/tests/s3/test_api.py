@@ -3,10 +3,26 @@ from shutil import rmtree
 from tempfile import mkdtemp
 from os import makedirs
 from os.path import join, exists, dirname
+from StringIO import StringIO
+from time import time
 
 from awsfabrictasks.s3.api import dirlist_absfilenames
 from awsfabrictasks.s3.api import localpath_to_s3path
 from awsfabrictasks.s3.api import s3path_to_localpath
+from awsfabrictasks.s3.api import S3File
+from awsfabrictasks.s3.api import S3_MIN_PARTSIZE
+from awsfabrictasks.s3.api import TokenBucket
+from awsfabrictasks.s3.api import TransferGovernor
+from awsfabrictasks.s3.api import configure_transfer_governor
+from awsfabrictasks.s3.api import S3PrefixSync
+from awsfabrictasks.s3.api import TransferStats
+from awsfabrictasks.s3.api import covering_prefixes
+from awsfabrictasks.s3.api import compare_localfiles_to_s3
+from awsfabrictasks.s3.api import parse_manifest
+from awsfabrictasks.s3.api import get_presigned_manifest
+from awsfabrictasks.s3.api import get_presigned_download_files
+from awsfabrictasks.s3.api import get_presigned_upload_files
+from awsfabrictasks.s3.api import s3_delete_many
 
 def makefile(tempdir, path, contents):
     path = join(tempdir, *path.split('/'))
@@ -50,3 +66,294 @@ class TestLocalpathToS3path(TestCase):
     def test_s3path_to_localpath(self):
         localpath = s3path_to_localpath('mydir/', 'mydir/hello/world.txt', join(self.tempdir, 'my', 'test'))
         self.assertEquals(localpath, join(self.tempdir, 'my', 'test', 'hello', 'world.txt'))
+
+
+class MockKey(object):
+    def __init__(self, name):
+        self.name = name
+        self.contents = None
+    def exists(self):
+        return False
+    def set_contents_from_string(self, data, **kwargs):
+        self.contents = data
+
+class MockMultiPartUpload(object):
+    def __init__(self):
+        self.parts = {}
+        self.completed = False
+        self.cancelled = False
+    def upload_part_from_file(self, fp, part_num, **kwargs):
+        if part_num == 3 and fp.getvalue() == 'fail':
+            raise IOError('Upload failed')
+        self.parts[part_num] = fp.read()
+    def complete_upload(self):
+        self.completed = True
+    def cancel_upload(self):
+        self.cancelled = True
+
+class MockBucket(object):
+    def __init__(self):
+        self.multipart = MockMultiPartUpload()
+    def initiate_multipart_upload(self, keyname):
+        return self.multipart
+
+
+class TestS3FileStream(TestCase):
+    def setUp(self):
+        configure_transfer_governor()
+        self.bucket = MockBucket()
+        self.s3file = S3File(self.bucket, MockKey('test'))
+
+    def test_small_stream(self):
+        self.s3file.set_contents_from_stream(StringIO('hello'), partsize=S3_MIN_PARTSIZE,
+                                             concurrency=2)
+        self.assertEquals(self.s3file.key.contents, 'hello')
+        self.assertEquals(self.bucket.multipart.parts, {})
+
+    def test_multipart_stream(self):
+        data = 'a' * S3_MIN_PARTSIZE + 'b' * S3_MIN_PARTSIZE + 'c' * 10
+        self.s3file.set_contents_from_stream(StringIO(data), partsize=S3_MIN_PARTSIZE,
+                                             concurrency=2)
+        parts = self.bucket.multipart.parts
+        self.assertEquals(sorted(parts.keys()), [1, 2, 3])
+        self.assertEquals(parts[1] + parts[2] + parts[3], data)
+        self.assertTrue(self.bucket.multipart.completed)
+
+    def test_multipart_stream_cancel_on_error(self):
+        data = 'a' * S3_MIN_PARTSIZE * 2 + 'fail'
+        self.assertRaises(IOError, self.s3file.set_contents_from_stream, StringIO(data),
+                          partsize=S3_MIN_PARTSIZE, concurrency=2)
+        self.assertTrue(self.bucket.multipart.cancelled)
+        self.assertFalse(self.bucket.multipart.completed)
+
+    def test_too_small_partsize(self):
+        self.assertRaises(ValueError, self.s3file.set_contents_from_stream,
+                          StringIO('x'), partsize=1024, concurrency=2)
+
+
+class TestTransferGovernor(TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(100)
+        start = time()
+        bucket.consume(100)
+        self.assertTrue(time() - start < 0.1)
+        bucket.consume(20)
+        self.assertTrue(time() - start >= 0.18)
+
+    def test_counters(self):
+        governor = TransferGovernor()
+        callback = governor.get_progress_callback()
+        callback(0, 300)
+        callback(100, 300)
+        callback(300, 300)
+        governor.request()
+        self.assertEquals(governor.bytes_transferred, 300)
+        self.assertEquals(governor.request_count, 1)
+
+
+class TestTransferStats(TestCase):
+    def setUp(self):
+        configure_transfer_governor()
+
+    def test_record(self):
+        stats = TransferStats()
+        with stats.phase('transfer'):
+            with stats.timed('upload', nbytes=100):
+                pass
+            stats.record('upload', 0.3, nbytes=50)
+        try:
+            with stats.timed('upload'):
+                raise IOError()
+        except IOError:
+            pass
+        stats.record('hash', 0.1, nbytes=1000)
+        result = stats.as_dict()
+        self.assertEquals(result['total_bytes'], 150)
+        self.assertEquals(result['operations']['hash']['bytes'], 1000)
+        self.assertTrue('transfer' in result['phases'])
+        upload = result['operations']['upload']
+        self.assertEquals(upload['count'], 3)
+        self.assertEquals(upload['errors'], 1)
+        self.assertEquals(upload['histogram'][0], 2)
+        self.assertEquals(upload['histogram'][4], 1)
+        self.assertTrue('upload' in stats.format_summary())
+
+
+class MockListedKey(object):
+    def __init__(self, name, size, etag, last_modified='2013-01-01T00:00:00.000Z'):
+        self.name = name
+        self.size = size
+        self.etag = '"{0}"'.format(etag)
+        self.last_modified = last_modified
+        self.is_latest = False
+
+class MockListBucket(object):
+    def __init__(self, name, keys):
+        self.name = name
+        self.keys = keys
+    def list(self, prefix):
+        return [key for key in self.keys if key.name.startswith(prefix)]
+
+
+class TestS3PrefixSync(TestCase):
+    def setUp(self):
+        configure_transfer_governor()
+        self.src = MockListBucket('src', [MockListedKey('a/same.txt', 10, 'x'),
+                                          MockListedKey('a/changed.txt', 10, 'x'),
+                                          MockListedKey('a/new.txt', 10, 'x'),
+                                          MockListedKey('a/big.bin', 10, 'x')])
+        self.dst = MockListBucket('dst', [MockListedKey('b/same.txt', 10, 'x'),
+                                          MockListedKey('b/changed.txt', 11, 'x'),
+                                          MockListedKey('b/big.bin', 10, 'y-2',
+                                                        last_modified='2013-02-01T00:00:00.000Z'),
+                                          MockListedKey('b/stale.txt', 10, 'x')])
+
+    def test_iterfiles(self):
+        result = {}
+        for syncfile in S3PrefixSync(self.src, 'a', self.dst, 'b/').iterfiles():
+            if syncfile.both_exists():
+                result[syncfile.dstpath] = syncfile.is_same()
+            elif syncfile.srcexists:
+                result[syncfile.dstpath] = 'create'
+            else:
+                self.assertEquals(syncfile.srcpath, 'a/stale.txt')
+                result[syncfile.dstpath] = 'delete'
+        self.assertEquals(result, {'b/same.txt': True,
+                                   'b/changed.txt': False,
+                                   'b/big.bin': True,
+                                   'b/new.txt': 'create',
+                                   'b/stale.txt': 'delete'})
+
+
+class MockDeleteError(object):
+    def __init__(self, key):
+        self.key = key
+        self.code = 'AccessDenied'
+        self.message = 'Access Denied'
+
+class MockDeleteResult(object):
+    def __init__(self, errors):
+        self.deleted = []
+        self.errors = errors
+
+class MockDeleteBucket(object):
+    def delete_keys(self, names, quiet=False):
+        return MockDeleteResult([MockDeleteError(name) for name in names
+                                 if name.startswith('locked/')])
+
+
+class TestS3DeleteMany(TestCase):
+    def setUp(self):
+        configure_transfer_governor()
+
+    def test_s3_delete_many(self):
+        deleted, errors = s3_delete_many(MockDeleteBucket(), ['a.txt', 'locked/b.txt', 'c.txt'])
+        self.assertEquals(deleted, ['a.txt', 'c.txt'])
+        self.assertEquals(errors, [('locked/b.txt', 'AccessDenied: Access Denied')])
+        self.assertEquals(s3_delete_many(MockDeleteBucket(), []), ([], []))
+
+
+class TestCompareLocalfiles(TestCase):
+    def setUp(self):
+        configure_transfer_governor()
+        self.tempdir = mkdtemp()
+        self.same = makefile(self.tempdir, 'same.txt', 'hello')
+        self.changed = makefile(self.tempdir, 'changed.txt', 'hellO')
+        self.bucket = MockListBucket('test', [
+            MockListedKey('a/same.txt', 5, '5d41402abc4b2a76b9719d911017c592'),
+            MockListedKey('a/b/changed.txt', 5, '5d41402abc4b2a76b9719d911017c592'),
+            MockListedKey('a/b/nolocal.txt', 5, 'x'),
+            MockListedKey('c/unrelated.txt', 5, 'x')])
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_covering_prefixes(self):
+        self.assertEquals(covering_prefixes(['a/b/c.txt', 'a/d.txt', 'x/y.txt']), ['a/', 'x/'])
+        self.assertEquals(covering_prefixes(['a/b/c.txt', 'a/b/d.txt']), ['a/b/'])
+        self.assertEquals(covering_prefixes(['root.txt', 'a/b.txt']), [''])
+
+    def test_compare_localfiles_to_s3(self):
+        pairs = [('a/same.txt', self.same),
+                 ('a/b/changed.txt', self.changed),
+                 ('a/b/nolocal.txt', join(self.tempdir, 'nolocal.txt')),
+                 ('a/missing.txt', self.same)]
+        statuses = [status for status, keyname, localfile
+                    in compare_localfiles_to_s3(self.bucket, pairs, 2)]
+        self.assertEquals(statuses, ['SAME', 'DIFFERENT', 'MISSING_LOCAL', 'MISSING_S3'])
+
+    def test_parse_manifest(self):
+        manifest = StringIO('# comment\n\na/b.txt   /tmp/my file.txt\nc.txt\t/tmp/c.txt\n')
+        self.assertEquals(parse_manifest(manifest), [('a/b.txt', '/tmp/my file.txt'),
+                                                     ('c.txt', '/tmp/c.txt')])
+        self.assertRaises(ValueError, parse_manifest, StringIO('invalid\n'))
+
+
+class TestPresignedManifest(TestCase):
+    def setUp(self):
+        self.tempdir = mkdtemp()
+        makedirs(join(self.tempdir, 'sub'))
+        open(join(self.tempdir, 'a.txt'), 'wb').write('hello')
+        open(join(self.tempdir, 'sub', 'b.txt'), 'wb').write('world')
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_get_presigned_manifest(self):
+        from boto.s3.connection import S3Connection
+        from boto.s3.bucket import Bucket
+        bucket = Bucket(S3Connection('a', 'b'), 'testbucket')
+        manifest = get_presigned_manifest(bucket, self.tempdir, 'staging/test', expires_in=60)
+        self.assertEquals([(path, md5sum) for path, md5sum, url in manifest],
+                          [('a.txt', '5d41402abc4b2a76b9719d911017c592'),
+                           ('sub/b.txt', '7d793037a0760186574b0282f2f435e7')])
+        self.assertTrue('staging/test/sub/b.txt' in manifest[1][2])
+        self.assertTrue('Signature=' in manifest[1][2])
+
+
+class TestPresignedAgentFiles(TestCase):
+    def setUp(self):
+        from boto.s3.connection import S3Connection
+        from boto.s3.bucket import Bucket
+        from boto.s3.key import Key
+        configure_transfer_governor()
+        class ListingBucket(Bucket):
+            def list(self, prefix):
+                return [key for key in self.keys if key.name.startswith(prefix)]
+        self.bucket = ListingBucket(S3Connection('a', 'b'), 'testbucket')
+        self.bucket.keys = []
+        for name, etag in (('data/a.txt', '5d41402abc4b2a76b9719d911017c592'),
+                           ('data/sub/', 'd41d8cd98f00b204e9800998ecf8427e'),
+                           ('data/sub/big.bin', '0123-2')):
+            key = Key(self.bucket, name)
+            key.etag = '"{0}"'.format(etag)
+            key.is_latest = False
+            self.bucket.keys.append(key)
+
+    def test_get_presigned_download_files(self):
+        files = get_presigned_download_files(self.bucket, 'data', expires_in=60)
+        self.assertEquals([(fileinfo['path'], fileinfo['md5']) for fileinfo in files],
+                          [('a.txt', '5d41402abc4b2a76b9719d911017c592'),
+                           ('sub/big.bin', None)])
+        self.assertTrue('data/sub/big.bin' in files[1]['url'])
+
+    def test_get_presigned_upload_files(self):
+        files = get_presigned_upload_files(self.bucket, 'data/',
+                                           {'a.txt': {'md5': '5d41402abc4b2a76b9719d911017c592',
+                                                      'size': 5},
+                                            'sub/big.bin': {'md5': '0123', 'size': 10},
+                                            'new.txt': {'md5': '0123', 'size': 10}},
+                                           expires_in=60)
+        self.assertEquals([fileinfo['path'] for fileinfo in files], ['new.txt', 'sub/big.bin'])
+        self.assertTrue('Signature=' in files[0]['url'])
+
+    def test_get_presigned_upload_files_too_large(self):
+        huge = 6 * 1024 * 1024 * 1024
+        # Unchanged files are not uploaded, so their size does not matter
+        files = get_presigned_upload_files(self.bucket, 'data/',
+                                           {'a.txt': {'md5': '5d41402abc4b2a76b9719d911017c592',
+                                                      'size': huge}},
+                                           expires_in=60)
+        self.assertEquals(files, [])
+        self.assertRaises(ValueError, get_presigned_upload_files, self.bucket, 'data/',
+                          {'new.bin': {'md5': '0123', 'size': huge}}, expires_in=60)
@@ -0,0 +1,88 @@
+from unittest import TestCase
+from threading import Thread
+
+from awsfabrictasks.conf import awsfab_settings
+from awsfabrictasks.connections import ConnectionRegistry
+
+
+class MockConnection(object):
+    def __init__(self, region_name, **auth):
+        self.region_name = region_name
+        self.auth = auth
+
+
+class TestConnectionRegistry(TestCase):
+    def setUp(self):
+        awsfab_settings.reset_settings(AUTH={'aws_access_key_id': 'a',
+                                             'aws_secret_access_key': 's'},
+                                       CONNECTION_MAX_IDLE=300)
+        self.registry = ConnectionRegistry()
+        self.connected = []
+
+    def connect(self, region_name, **auth):
+        if region_name == 'invalid':
+            return None
+        connection = MockConnection(region_name, **auth)
+        self.connected.append(connection)
+        return connection
+
+    def test_get_reuses(self):
+        first = self.registry.get('ec2', 'eu-west-1', self.connect)
+        self.assertEquals(first.region_name, 'eu-west-1')
+        self.assertEquals(first.auth['aws_access_key_id'], 'a')
+        self.assertTrue(self.registry.get('ec2', 'eu-west-1', self.connect) is first)
+        self.assertEquals(len(self.connected), 1)
+
+    def test_get_keyed_by_service_region_and_credentials(self):
+        first = self.registry.get('ec2', 'eu-west-1', self.connect)
+        self.assertFalse(self.registry.get('rds', 'eu-west-1', self.connect) is first)
+        self.assertFalse(self.registry.get('ec2', 'us-east-1', self.connect) is first)
+        awsfab_settings.AUTH = {'aws_access_key_id': 'b',
+                                'aws_secret_access_key': 's'}
+        other = self.registry.get('ec2', 'eu-west-1', self.connect)
+        self.assertEquals(other.auth['aws_access_key_id'], 'b')
+        self.assertEquals(len(self.connected), 4)
+
+    def test_get_invalid(self):
+        self.assertEquals(self.registry.get('ec2', 'invalid', self.connect), None)
+        self.assertEquals(self.registry.get('ec2', 'invalid', self.connect), None)
+
+    def test_idle_connection_replaced(self):
+        first = self.registry.get('ec2', 'eu-west-1', self.connect)
+        awsfab_settings.CONNECTION_MAX_IDLE = -1
+        self.assertFalse(self.registry.get('ec2', 'eu-west-1', self.connect) is first)
+
+    def test_discard_and_clear(self):
+        first = self.registry.get('ec2', 'eu-west-1', self.connect)
+        self.registry.discard('ec2', 'eu-west-1')
+        second = self.registry.get('ec2', 'eu-west-1', self.connect)
+        self.assertFalse(second is first)
+        self.registry.clear()
+        self.assertFalse(self.registry.get('ec2', 'eu-west-1', self.connect) is second)
+
+    def _get_in_threads(self, count):
+        results = []
+        def run():
+            first = self.registry.get('ec2', 'eu-west-1', self.connect)
+            results.append((first, self.registry.get('ec2', 'eu-west-1', self.connect)))
+        threads = [Thread(target=run) for index in xrange(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_get_per_thread(self):
+        mainconnection = self.registry.get('ec2', 'eu-west-1', self.connect)
+        results = self._get_in_threads(4)
+        for first, second in results:
+            self.assertTrue(first is second)
+            self.assertFalse(first is mainconnection)
+        self.assertEquals(len(set(id(first) for first, second in results)), 4)
+        self.assertTrue(self.registry.get('ec2', 'eu-west-1', self.connect) is mainconnection)
+
+    def test_clear_all_threads(self):
+        mainconnection = self.registry.get('ec2', 'eu-west-1', self.connect)
+        self.registry.clear()
+        self.assertFalse(self.registry.get('ec2', 'eu-west-1', self.connect) is mainconnection)
+        self.assertEquals(len(self.connected), 2)
@@ -0,0 +1,45 @@
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from os import stat
+from os.path import join
+from stat import S_IMODE
+from subprocess import Popen, PIPE
+
+from awsfabrictasks.hostslist import get_hostsfile_update_command
+from awsfabrictasks.hostslist import hostsfile_was_updated
+from awsfabrictasks.utils import LocalCommandResult
+
+
+class TestDistributeHostsfile(TestCase):
+    def setUp(self):
+        self.tempdir = mkdtemp()
+        self.hostsfile = join(self.tempdir, 'my hosts')
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def _update(self, hostsfile_string):
+        command = get_hostsfile_update_command(hostsfile_string, self.hostsfile, use_sudo=False)
+        process = Popen(['sh', '-c', command], stdin=PIPE, stdout=PIPE)
+        output = process.communicate(hostsfile_string)[0]
+        self.assertEquals(process.returncode, 0)
+        return output.strip()
+
+    def test_get_hostsfile_update_command(self):
+        self.assertEquals(self._update('10.0.0.1 a.ec2\n'), 'updated')
+        self.assertEquals(open(self.hostsfile).read(), '10.0.0.1 a.ec2\n')
+        self.assertEquals(S_IMODE(stat(self.hostsfile).st_mode), 0644)
+        self.assertEquals(self._update('10.0.0.1 a.ec2\n'), 'unchanged')
+        self.assertEquals(self._update('10.0.0.2 a.ec2\n'), 'updated')
+        self.assertEquals(open(self.hostsfile).read(), '10.0.0.2 a.ec2\n')
+
+    def test_get_hostsfile_update_command_sudo(self):
+        command = get_hostsfile_update_command('', '/etc/hosts')
+        self.assertTrue("else sudo sh -c 'cat > /etc/hosts.awsfab-tmp && " in command)
+
+    def test_hostsfile_was_updated(self):
+        self.assertTrue(hostsfile_was_updated(LocalCommandResult('a', 'cmd', 0, 1, 'updated\n')))
+        self.assertFalse(hostsfile_was_updated(LocalCommandResult('a', 'cmd', 0, 1, 'unchanged\n')))
+        self.assertFalse(hostsfile_was_updated(LocalCommandResult('a', 'cmd', 1, 1, 'updated\n')))
+        self.assertFalse(hostsfile_was_updated(LocalCommandResult('a', 'cmd', 1, 1, None)))
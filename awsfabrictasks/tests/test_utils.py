@@ -1,9 +1,35 @@
 from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from os import makedirs, chmod, stat, getuid, devnull, symlink
+from shutil import copyfile
+from os.path import join, exists, islink
+from stat import S_IMODE
+from pwd import getpwuid
+from subprocess import call, check_output
+import tarfile
+
+from awsfabrictasks import utils
 
 from awsfabrictasks.utils import force_slashend
 from awsfabrictasks.utils import force_noslashend
 from awsfabrictasks.utils import rsyncformat_path
 from awsfabrictasks.utils import guess_contenttype
+from awsfabrictasks.utils import parse_size
+from awsfabrictasks.utils import parallel_map
+from awsfabrictasks.utils import WorkerPool
+from awsfabrictasks.utils import run_local_commands
+from awsfabrictasks.utils import format_local_command_results
+from awsfabrictasks.utils import parse_rsync_stats
+from awsfabrictasks.utils import merge_rsync_stats
+from awsfabrictasks.utils import create_dir_archive
+from awsfabrictasks.utils import get_tar_extract_command
+from awsfabrictasks.utils import get_local_md5_manifest
+from awsfabrictasks.utils import get_remote_md5_manifest_command
+from awsfabrictasks.utils import parse_md5sum_output
+from awsfabrictasks.utils import compare_md5_manifests
+from awsfabrictasks.utils import get_delete_files_command
+from awsfabrictasks.utils import sudo_upload_dir_delta
 
 
 class TestUtils(TestCase):
@@ -25,3 +51,263 @@ class TestUtils(TestCase):
         self.assertEquals(guess_contenttype('hello.py'), 'text/x-python')
         self.assertEquals(guess_contenttype('hello.txt'), 'text/plain')
         self.assertEquals(guess_contenttype('hello.json'), 'application/json')
+
+    def test_parse_size(self):
+        self.assertEquals(parse_size('100'), 100)
+        self.assertEquals(parse_size('8M'), 8*1024*1024)
+        self.assertEquals(parse_size('1.5k'), 1536)
+        self.assertEquals(parse_size('2GB'), 2*1024*1024*1024)
+        self.assertEquals(parse_size(None), None)
+        self.assertRaises(ValueError, parse_size, 'lots')
+
+
+class TestWorkerPool(TestCase):
+    def test_parallel_map(self):
+        self.assertEquals(parallel_map(lambda x: x*2, range(20), 4), range(0, 40, 2))
+        self.assertEquals(parallel_map(lambda x: x, [], 4), [])
+
+    def test_reraise_first_error(self):
+        def fail(value):
+            raise ValueError(value)
+        pool = WorkerPool(2)
+        pool.submit(fail, 'broken')
+        pool.queue.join()
+        self.assertTrue(pool.failed())
+        self.assertFalse(pool.submit(fail, 'skipped'))
+        self.assertRaises(ValueError, pool.join)
+
+
+class TestRunLocalCommands(TestCase):
+    def test_run_local_commands(self):
+        from StringIO import StringIO
+        output = StringIO()
+        results = run_local_commands([('a', 'echo hello; echo world'),
+                                      ('b', 'echo failing >&2; exit 3')],
+                                     concurrency=2, output=output)
+        self.assertEquals([(result.label, result.returncode) for result in results],
+                          [('a', 0), ('b', 3)])
+        self.assertEquals(sorted(output.getvalue().splitlines()),
+                          ['[a] hello', '[a] world', '[b] failing'])
+        table = format_local_command_results(results).splitlines()
+        self.assertEquals(table[0].split(), ['HOST', 'STATUS', 'SECONDS'])
+        self.assertEquals(table[1].split()[:2], ['a', 'OK'])
+        self.assertEquals(table[2].split()[:3], ['b', 'FAILED', '(3)'])
+        self.assertEquals(table[3], '1 succeeded, 1 failed.')
+
+    def test_capture(self):
+        from StringIO import StringIO
+        results = run_local_commands([('a', 'echo hello')], concurrency=1,
+                                     output=StringIO(), capture=True)
+        self.assertEquals(results[0].output, 'hello\n')
+
+
+class TestRsyncStats(TestCase):
+    def test_parse_and_merge(self):
+        output = ('Number of files: 1,234 (reg: 1,000, dir: 234)\n'
+                  'Number of regular files transferred: 12\n'
+                  'Total file size: 5,000,000 bytes\n'
+                  'Total transferred file size: 1,000 bytes\n'
+                  'Total bytes sent: 2,000\n'
+                  'Total bytes received: 300\n')
+        stats = parse_rsync_stats(output)
+        self.assertEquals(stats, {'files': 1234, 'files_transferred': 12,
+                                  'total_file_size': 5000000, 'transferred_file_size': 1000,
+                                  'bytes_sent': 2000, 'bytes_received': 300})
+        self.assertEquals(parse_rsync_stats('Number of files transferred: 3'),
+                          {'files_transferred': 3})
+        self.assertEquals(merge_rsync_stats([stats, {'files': 1, 'bytes_sent': 1}])['files'], 1235)
+
+
+class TestTarUpload(TestCase):
+    def setUp(self):
+        self.tempdir = mkdtemp()
+        self.local_dir = join(self.tempdir, 'local')
+        makedirs(join(self.local_dir, 'sub'))
+        open(join(self.local_dir, 'a.txt'), 'w').write('a')
+        open(join(self.local_dir, 'sub', 'my file.txt'), 'w').write('b')
+        chmod(join(self.local_dir, 'a.txt'), 0755)
+        self.outside = join(self.tempdir, 'outside')
+        makedirs(self.outside)
+        chmod(self.outside, 0700)
+        self.target = join(self.outside, 'target')
+        open(self.target, 'w').write('secret')
+        chmod(self.target, 0600)
+        symlink(self.target, join(self.local_dir, 'link'))
+        symlink(self.outside, join(self.local_dir, 'dirlink'))
+        self.remote_dir = join(self.tempdir, 'remote dir')
+        makedirs(self.remote_dir)
+        symlink(self.outside, join(self.remote_dir, 'sub'))
+        self.untouched = join(self.remote_dir, 'untouched.txt')
+        open(self.untouched, 'w').write('c')
+        chmod(self.untouched, 0604)
+        self._create_archive()
+
+    def _create_archive(self):
+        self.archive = join(self.tempdir, 'upload.tar.gz')
+        self.listfile = join(self.tempdir, 'upload.list')
+        fp = open(self.archive, 'wb')
+        self.arcnames = create_dir_archive(self.local_dir, fp)
+        fp.close()
+        open(self.listfile, 'wb').write(''.join(arcname + '\0' for arcname in self.arcnames))
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def _mode(self, *path):
+        return S_IMODE(stat(join(self.remote_dir, *path)).st_mode)
+
+    def test_create_dir_archive(self):
+        archive = tarfile.open(self.archive)
+        self.assertEquals(sorted(archive.getnames()),
+                          ['.', './a.txt', './link', './sub', './sub/my file.txt'])
+        self.assertEquals(sorted(self.arcnames), sorted(archive.getnames()))
+        for member in archive.getmembers():
+            if member.isdir():
+                self.assertEquals(member.mode, 0777)
+            else:
+                self.assertTrue(member.isfile())
+                self.assertEquals(member.mode, 0666)
+
+    def test_extract(self):
+        command = get_tar_extract_command(self.archive, self.listfile, self.remote_dir,
+                                          owner=getpwuid(getuid()).pw_name, mode='750')
+        self.assertEquals(call(['bash', '-c', command]), 0)
+        self.assertEquals(open(join(self.remote_dir, 'sub', 'my file.txt')).read(), 'b')
+        self.assertEquals(self._mode('a.txt'), 0750)
+        self.assertEquals(self._mode('sub', 'my file.txt'), 0750)
+        self.assertEquals(self._mode('sub'), 0750)
+        self.assertEquals(self._mode(), 0750)
+        self.assertEquals(self._mode('untouched.txt'), 0604)
+        self.assertEquals(open(join(self.remote_dir, 'link')).read(), 'secret')
+        self.assertFalse(islink(join(self.remote_dir, 'link')))
+        self.assertEquals(self._mode('link'), 0750)
+        self.assertEquals(S_IMODE(stat(self.target).st_mode), 0600)
+        self.assertEquals(S_IMODE(stat(self.outside).st_mode), 0700)
+        self.assertFalse(exists(self.archive))
+        self.assertFalse(exists(self.listfile))
+
+    def test_extract_special_characters(self):
+        for filename in ('back\\slash', 'caf\xc3\xa9', 'tab\there'):
+            open(join(self.local_dir, 'sub', filename), 'w').write('d')
+        self._create_archive()
+        command = get_tar_extract_command(self.archive, self.listfile, self.remote_dir,
+                                          owner=getpwuid(getuid()).pw_name, mode='750')
+        self.assertEquals(call(['env', 'LC_ALL=C', 'bash', '-c', command]), 0)
+        for filename in ('back\\slash', 'caf\xc3\xa9', 'tab\there'):
+            self.assertEquals(open(join(self.remote_dir, 'sub', filename)).read(), 'd')
+            self.assertEquals(self._mode('sub', filename), 0750)
+
+    def test_extract_without_chattr(self):
+        command = get_tar_extract_command(self.archive, self.listfile,
+                                          join(self.tempdir, 'new', 'dir'))
+        self.assertEquals(call(['bash', '-c', 'umask 022; ' + command]), 0)
+        self.assertEquals(open(join(self.tempdir, 'new', 'dir', 'a.txt')).read(), 'a')
+        # Same as the default permissions sudo_upload_dir gives new files and directories
+        self.assertEquals(S_IMODE(stat(join(self.tempdir, 'new', 'dir', 'a.txt')).st_mode), 0644)
+        self.assertEquals(S_IMODE(stat(join(self.tempdir, 'new', 'dir', 'sub')).st_mode), 0755)
+
+    def test_extract_failure_removes_archive(self):
+        open(self.archive, 'w').write('invalid')
+        command = get_tar_extract_command(self.archive, self.listfile, self.remote_dir)
+        self.assertNotEquals(call(['bash', '-c', command], stderr=open(devnull, 'w')), 0)
+        self.assertFalse(exists(self.archive))
+        self.assertFalse(exists(self.listfile))
+
+
+class TestDeltaUpload(TestCase):
+    def setUp(self):
+        self.tempdir = mkdtemp()
+        makedirs(join(self.tempdir, 'sub', 'deep'))
+        for path, data in (('a.txt', 'hello'), ('sub/deep/b.txt', 'world'),
+                           ('sub/back\\slash', 'x'), ('sub/new\nline', 'y')):
+            open(join(self.tempdir, path), 'w').write(data)
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_remote_manifest_matches_local(self):
+        output = check_output(['bash', '-c', get_remote_md5_manifest_command(self.tempdir)])
+        local_manifest = get_local_md5_manifest(self.tempdir)
+        self.assertEquals(len(local_manifest), 4)
+        self.assertEquals(local_manifest['a.txt'], '5d41402abc4b2a76b9719d911017c592')
+        self.assertEquals(parse_md5sum_output(output), local_manifest)
+
+    def test_manifests_handle_symlinks_the_same_way(self):
+        symlink(join(self.tempdir, 'a.txt'), join(self.tempdir, 'sub', 'filelink'))
+        symlink(join(self.tempdir, 'sub', 'deep'), join(self.tempdir, 'dirlink'))
+        symlink(join(self.tempdir, 'missing'), join(self.tempdir, 'brokenlink'))
+        output = check_output(['bash', '-c', get_remote_md5_manifest_command(self.tempdir)])
+        local_manifest = get_local_md5_manifest(self.tempdir)
+        self.assertEquals(local_manifest['sub/filelink'], '5d41402abc4b2a76b9719d911017c592')
+        self.assertFalse('brokenlink' in local_manifest)
+        self.assertFalse('dirlink/b.txt' in local_manifest)
+        self.assertEquals(parse_md5sum_output(output), local_manifest)
+
+    def test_get_delete_files_command(self):
+        listfile = join(self.tempdir, 'delete.list')
+        open(listfile, 'wb').write('a.txt\0sub/new\nline\0missing.txt\0')
+        self.assertEquals(call(['bash', '-c', get_delete_files_command(listfile, self.tempdir)]), 0)
+        self.assertEquals(sorted(get_local_md5_manifest(self.tempdir)), ['sub/back\\slash', 'sub/deep/b.txt'])
+        self.assertFalse(exists(listfile))
+
+    def test_remote_manifest_missing_dir(self):
+        command = get_remote_md5_manifest_command(join(self.tempdir, 'missing'))
+        self.assertEquals(check_output(['bash', '-c', command]), '')
+
+    def test_compare_md5_manifests(self):
+        self.assertEquals(compare_md5_manifests({'same': '1', 'changed': '2', 'new': '3'},
+                                                {'same': '1', 'changed': 'x', 'extra': '4'}),
+                          (['changed', 'new'], ['extra']))
+        self.assertEquals(compare_md5_manifests({'a': '1'}, {'a': '1'}), ([], []))
+
+    def _local_put(self, local_path, remote_path, mode=None):
+        if hasattr(local_path, 'read'):
+            open(remote_path, 'wb').write(local_path.read())
+        else:
+            copyfile(local_path, remote_path)
+        if mode is not None:
+            chmod(remote_path, mode)
+
+    def _local_run(self, command):
+        output = check_output(['bash', '-c', command]).strip()
+        if command.startswith('mktemp '):
+            self.remote_tempdirs.append(output)
+        return output
+
+    def test_sudo_upload_dir_delta(self):
+        remote_dir = join(self.tempdir, 'remote')
+        makedirs(remote_dir)
+        open(join(remote_dir, 'stale.txt'), 'w').write('old')
+        self.remote_tempdirs = []
+        originals = utils.put, utils.run, utils.sudo
+        utils.put, utils.run, utils.sudo = self._local_put, self._local_run, self._local_run
+        try:
+            local_dir = join(self.tempdir, 'sub')
+            owner = getpwuid(getuid()).pw_name
+            changed, extra = sudo_upload_dir_delta(local_dir, remote_dir, owner=owner,
+                                                   mode='640', delete=True)
+            self.assertEquals(changed, ['back\\slash', 'deep/b.txt', 'new\nline'])
+            self.assertEquals(extra, ['stale.txt'])
+            self.assertEquals(sorted(get_local_md5_manifest(remote_dir)),
+                              ['back\\slash', 'deep/b.txt', 'new\nline'])
+            self.assertEquals(open(join(remote_dir, 'new\nline')).read(), 'y')
+            self.assertEquals(S_IMODE(stat(join(remote_dir, 'back\\slash')).st_mode), 0640)
+            self.assertEquals(S_IMODE(stat(join(remote_dir, 'new\nline')).st_mode), 0640)
+
+            open(join(local_dir, 'back\\slash'), 'w').write('changed')
+            self.assertEquals(sudo_upload_dir_delta(local_dir, remote_dir, delete=True),
+                              (['back\\slash'], []))
+            self.assertEquals(open(join(remote_dir, 'back\\slash')).read(), 'changed')
+        finally:
+            utils.put, utils.run, utils.sudo = originals
+        self.assertEquals(len(self.remote_tempdirs), 3)
+        for tempdir in self.remote_tempdirs:
+            self.assertFalse(exists(tempdir))
+
+    def test_create_dir_archive_paths(self):
+        archivefile = join(self.tempdir, 'upload.tar.gz')
+        fp = open(archivefile, 'wb')
+        create_dir_archive(self.tempdir, fp, paths=['sub/deep/b.txt'])
+        fp.close()
+        self.assertEquals(tarfile.open(archivefile).getnames(),
+                          ['.', './sub', './sub/deep', './sub/deep/b.txt'])
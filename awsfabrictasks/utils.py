@@ -1,10 +1,19 @@
-from fabric.api import put, sudo
+from fabric.api import put, run, sudo, hide
 from os import walk, remove
-from os.path import relpath, join
+from os.path import relpath, join, isfile
+from StringIO import StringIO
+from pipes import quote
+import tarfile
 from mimetypes import guess_type
 from tempfile import NamedTemporaryFile
+from threading import Thread, Lock
+from Queue import Queue
 from boto.utils import compute_md5
 import logging
+import sys
+import re
+from subprocess import Popen, PIPE, STDOUT
+from time import time
 
 
 #: Map of strings to loglevels (for the logging module)
@@ -146,12 +155,24 @@ def sudo_mkdir_p(remote_path, **chattr_kw):
     sudo_chattr(remote_path, **chattr_kw)
 
 
-def sudo_upload_dir(local_dir, remote_dir, **chattr_kw):
+def sudo_upload_dir(local_dir, remote_dir, method='file', **chattr_kw):
     """
     Upload all files and directories in ``local_dir`` to ``remote_dir``.
     Directories are created with :func:`sudo_mkdir_p` and files are uploaded
     with :func:`sudo_upload_file`. ``chattr_kw`` is forwarded in both cases.
-    """
+
+    :param method:
+        ``file`` to upload as described above, ``tar`` to use
+        :func:`sudo_upload_dir_tar`, which is a lot faster for directories
+        with many files, or ``delta`` to use :func:`sudo_upload_dir_delta`,
+        which only uploads new and changed files.
+    """
+    if method == 'tar':
+        return sudo_upload_dir_tar(local_dir, remote_dir, **chattr_kw)
+    elif method == 'delta':
+        return sudo_upload_dir_delta(local_dir, remote_dir, **chattr_kw)
+    elif method != 'file':
+        raise ValueError('Invalid method: {0!r}. Use "file", "tar" or "delta".'.format(method))
     for local_dirpath, dirnames, filenames in walk(local_dir):
         remote_dirpath = remote_dir
         rel = relpath(local_dirpath, local_dir)
@@ -166,6 +187,277 @@ def sudo_upload_dir(local_dir, remote_dir, **chattr_kw):
             sudo_upload_file(local_filepath, remote_filepath, **chattr_kw)
 
 
+def _iter_dir_arcnames(local_dir):
+    for dirpath, dirnames, filenames in walk(local_dir):
+        rel = relpath(dirpath, local_dir)
+        if rel == '.':
+            prefix = '.'
+        else:
+            prefix = './' + localpath_to_slashpath(rel)
+        yield prefix
+        for filename in filenames:
+            yield prefix + '/' + filename
+
+def _normalize_tarinfo_mode(tarinfo):
+    if tarinfo.isdir():
+        tarinfo.mode = 0777
+    else:
+        tarinfo.mode = 0666
+    return tarinfo
+
+def create_dir_archive(local_dir, fileobj, paths=None):
+    """
+    Write all files and directories in ``local_dir`` to ``fileobj`` as a
+    gzipped tar archive. The paths in the archive are relative to
+    ``local_dir`` (``local_dir`` itself is ``.``).
+
+    The archive contains the same as :func:`sudo_upload_dir` uploads:
+    Symlinks to files are stored as the files they point to, and symlinks to
+    directories are skipped (:func:`os.walk` does not follow them). All
+    files are stored with mode ``0666`` and all directories with mode
+    ``0777``, so they get the default permissions (given by the umask) when
+    they are extracted.
+
+    :param paths:
+        Only add these ``/``-separated paths relative to ``local_dir``, and the
+        directories containing them (including ``.``), instead of everything.
+    :return: A list of the paths (``arcnames``) added to the archive.
+    """
+    if paths is None:
+        arcnames = _iter_dir_arcnames(local_dir)
+    else:
+        arcnames = set(['.'])
+        for path in paths:
+            parts = path.split('/')
+            for index in xrange(1, len(parts) + 1):
+                arcnames.add('/'.join(['.'] + parts[:index]))
+        arcnames = sorted(arcnames)
+    added = []
+    archive = tarfile.open(fileobj=fileobj, mode='w:gz', dereference=True)
+    try:
+        for arcname in arcnames:
+            archive.add(join(local_dir, slashpath_to_localpath(arcname)),
+                        arcname=arcname, recursive=False, filter=_normalize_tarinfo_mode)
+            added.append(arcname)
+    finally:
+        archive.close()
+    return added
+
+def get_tar_extract_command(archive, listfile, remote_dir, owner=None, mode=None):
+    """
+    Get the shell command used by :func:`sudo_upload_dir_tar` to extract
+    ``archive`` (created with :func:`create_dir_archive`) into
+    ``remote_dir``, and apply ``owner`` and ``mode`` to the extracted files
+    and directories (and to ``remote_dir``) only. ``listfile`` is a file with
+    the ``\\0``-terminated paths returned by :func:`create_dir_archive`
+    (we do not use ``tar -t``, since it escapes special characters in the
+    paths it lists). The command is meant to run as root, and removes
+    ``archive`` and ``listfile`` when it is done.
+
+    Like with :func:`sudo_upload_dir`, directories are owned by root, and
+    files are owned by the user running ``sudo`` unless ``owner`` is given.
+    Unless ``mode`` is given, the permissions are the ones stored in the
+    archive (see :func:`create_dir_archive`) masked by the umask of root,
+    which gives the same permissions as :func:`sudo_upload_dir` as long as
+    root and the SSH user has the same umask. ``chown`` and ``chmod`` never
+    follow symlinks in ``remote_dir``.
+    """
+    archive = quote(archive)
+    listfile = quote(listfile)
+    commands = ['mkdir -p {0}'.format(quote(remote_dir)),
+                'cd {0}'.format(quote(remote_dir)),
+                'tar -xzf {0} --no-same-owner --no-same-permissions'.format(archive)]
+    if owner:
+        commands.append('xargs -0 -r chown -h {0} < {1}'.format(quote(owner), listfile))
+    else:
+        # Leave out the directories (tar replaces symlinks to directories
+        # with the directories in the archive).
+        skip_dirs = ("xargs -0 -r sh -c 'for path; do [ -d \"$path\" ] && [ ! -L \"$path\" ] "
+                     "|| printf \"%s\\0\" \"$path\"; done' sh")
+        commands.append('{0} < {1} | xargs -0 -r chown -h "${{SUDO_USER:-$(id -un)}}"'.format(
+            skip_dirs, listfile))
+    if mode:
+        # chmod follows symlinks, so leave them out.
+        skip_symlinks = ("xargs -0 -r sh -c 'for path; do [ -L \"$path\" ] "
+                         "|| printf \"%s\\0\" \"$path\"; done' sh")
+        commands.append('{0} < {1} | xargs -0 -r chmod {2}'.format(skip_symlinks, listfile,
+                                                                  quote(str(mode))))
+    return '({0}); status=$?; rm -f {1} {2}; exit $status'.format(' && '.join(commands),
+                                                                   archive, listfile)
+
+def sudo_upload_dir_tar(local_dir, remote_dir, owner=None, mode=None, paths=None):
+    """
+    Upload all files and directories in ``local_dir`` to ``remote_dir``, with
+    the same result as :func:`sudo_upload_dir`, but a lot faster.
+    ``local_dir`` is uploaded as a single gzipped tar archive (see
+    :func:`create_dir_archive`) with one ``put``, and extracted and
+    chowned/chmodded with a single ``sudo`` command (see
+    :func:`get_tar_extract_command`). Requires GNU tar on the remote host.
+
+    The archive and the list of the paths in it are uploaded with mode
+    ``0600`` to a private temporary directory, which is removed when we
+    are done.
+
+    :param paths: See :func:`create_dir_archive`.
+    """
+    tmpfile = NamedTemporaryFile(suffix='.tar.gz', delete=False)
+    try:
+        arcnames = create_dir_archive(local_dir, tmpfile, paths=paths)
+        tmpfile.close()
+        tempdir = run('mktemp -d -t awsfab-upload.XXXXXX')
+        try:
+            remote_archive = tempdir + '/upload.tar.gz'
+            remote_listfile = tempdir + '/upload.list'
+            put(tmpfile.name, remote_archive, mode=0600)
+            put(StringIO(''.join(arcname + '\0' for arcname in arcnames)), remote_listfile,
+                mode=0600)
+            sudo(get_tar_extract_command(remote_archive, remote_listfile, remote_dir,
+                                         owner=owner, mode=mode))
+        finally:
+            run('rm -rf {0}'.format(tempdir))
+    finally:
+        remove(tmpfile.name)
+
+def get_local_md5_manifest(local_dir):
+    """
+    Get a dict mapping the ``/``-separated path relative to ``local_dir`` of
+    each file in ``local_dir`` to its md5 checksum (see
+    :func:`compute_localfile_md5sum`). Symlinks to files are included with
+    the checksum of the file they point to (like they are uploaded by
+    :func:`sudo_upload_dir`), while broken symlinks and symlinks to
+    directories are not included.
+    """
+    manifest = {}
+    for dirpath, dirnames, filenames in walk(local_dir):
+        for filename in filenames:
+            localfile = join(dirpath, filename)
+            if not isfile(localfile):
+                continue
+            path = localpath_to_slashpath(relpath(localfile, local_dir))
+            manifest[path] = compute_localfile_md5sum(localfile)
+    return manifest
+
+def get_remote_md5_manifest_command(remote_dir):
+    """
+    Get a shell command that prints the md5 checksums of all the files in
+    ``remote_dir`` in the format of ``md5sum``, with paths relative to
+    ``remote_dir`` and prefixed with ``./``. Prints nothing if ``remote_dir``
+    does not exist. Parse the output with :func:`parse_md5sum_output`.
+    Symlinks are handled like in :func:`get_local_md5_manifest`.
+    """
+    remote_dir = quote(remote_dir)
+    return ('if [ -d {0} ]; then cd {0} && find . -xtype f -print0 '
+            '| xargs -0 -r md5sum; fi').format(remote_dir)
+
+def parse_md5sum_output(output):
+    """
+    Parse the output of the command from
+    :func:`get_remote_md5_manifest_command` into a dict like the one returned
+    by :func:`get_local_md5_manifest`.
+    """
+    manifest = {}
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        escaped = line.startswith('\\')
+        if escaped:
+            line = line[1:]
+        md5sum, path = line.split('  ', 1)
+        if escaped:
+            # md5sum escapes backslashes and newlines in filenames
+            path = path.replace('\\\\', '\0').replace('\\n', '\n').replace('\0', '\\')
+        if path.startswith('./'):
+            path = path[2:]
+        manifest[path] = md5sum
+    return manifest
+
+def compare_md5_manifests(local_manifest, remote_manifest):
+    """
+    Compare two manifests like the one returned by
+    :func:`get_local_md5_manifest`.
+
+    :return:
+        ``(changed, extra)``, where ``changed`` is a sorted list of the paths
+        that are missing or different in ``remote_manifest``, and ``extra``
+        is a sorted list of the paths that are only in ``remote_manifest``.
+    """
+    changed = sorted(path for path, md5sum in local_manifest.iteritems()
+                     if remote_manifest.get(path) != md5sum)
+    extra = sorted(set(remote_manifest).difference(local_manifest))
+    return changed, extra
+
+def sudo_upload_dir_delta(local_dir, remote_dir, owner=None, mode=None, delete=False):
+    """
+    Like :func:`sudo_upload_dir_tar`, but only upload, chown and chmod the
+    files that are new or changed since the last upload.
+
+    The md5 checksums of the files in ``remote_dir`` are retrieved with a
+    single ``sudo`` command (see :func:`get_remote_md5_manifest_command`),
+    and compared with the files in ``local_dir`` (see
+    :func:`compare_md5_manifests`). Nothing more is done if nothing changed.
+
+    :param delete:
+        Delete files in ``remote_dir`` that are not in ``local_dir``?
+        Directories are never deleted. The list of files to delete is
+        uploaded like the archive in :func:`sudo_upload_dir_tar`.
+    :return: ``(changed, extra)`` as returned by :func:`compare_md5_manifests`.
+    """
+    with hide('stdout'):
+        output = sudo(get_remote_md5_manifest_command(remote_dir))
+    changed, extra = compare_md5_manifests(get_local_md5_manifest(local_dir),
+                                           parse_md5sum_output(output))
+    if changed:
+        sudo_upload_dir_tar(local_dir, remote_dir, owner=owner, mode=mode, paths=changed)
+    if delete and extra:
+        tempdir = run('mktemp -d -t awsfab-delete.XXXXXX')
+        try:
+            remote_listfile = tempdir + '/delete.list'
+            put(StringIO(''.join(path + '\0' for path in extra)), remote_listfile, mode=0600)
+            sudo(get_delete_files_command(remote_listfile, remote_dir))
+        finally:
+            run('rm -rf {0}'.format(tempdir))
+    return changed, extra
+
+def get_delete_files_command(listfile, remote_dir):
+    """
+    Get the shell command used by :func:`sudo_upload_dir_delta` to delete the
+    files in ``listfile`` (a file with ``\\0``-terminated paths relative to
+    ``remote_dir``). The paths are passed to ``rm`` with ``xargs``, so the
+    number of files is not limited by the max length of a command. Removes
+    ``listfile`` when it is done.
+    """
+    listfile = quote(listfile)
+    return ('(cd {0} && xargs -0 -r rm -f -- < {1}); status=$?; '
+            'rm -f {1}; exit $status').format(quote(remote_dir), listfile)
+
+def benchmark_sudo_upload_dir(local_dir, remote_dir, **chattr_kw):
+    """
+    Upload ``local_dir`` with both methods of :func:`sudo_upload_dir` (into
+    ``<remote_dir>-file`` and ``<remote_dir>-tar``), and compare the time
+    they use and the uploaded files.
+
+    :return:
+        ``(elapsed, differences)``, where ``elapsed`` is a dict with the
+        seconds used by each method, and ``differences`` is a list of the
+        lines that differ in a listing of the path, owner, group, permissions
+        and size of the files in each of the target directories (empty if
+        the results are the same).
+    """
+    elapsed = {}
+    listings = {}
+    for method in ('file', 'tar'):
+        target = '{0}-{1}'.format(force_noslashend(remote_dir), method)
+        started = time()
+        with hide('everything'):
+            sudo_upload_dir(local_dir, target, method=method, **chattr_kw)
+        elapsed[method] = time() - started
+        with hide('everything'):
+            listing = sudo("find {0} -printf '%P %u %g %m %s\\n' | sort".format(quote(target)))
+        listings[method] = listing.splitlines()
+    differences = sorted(set(listings['file']).symmetric_difference(listings['tar']))
+    return elapsed, differences
+
+
 def parse_bool(data):
     """
     Return ``True`` if data is one of:: ``'true', 'True', True``. Otherwise,
@@ -252,3 +544,260 @@ def guess_contenttype(filename):
     :func:`mimetypes.guess_type`.
     """
     return guess_type(filename)[0]
+
+
+#: Suffixes understood by :func:`parse_size`.
+size_suffixes = {'K': 1024,
+                 'M': 1024 * 1024,
+                 'G': 1024 * 1024 * 1024}
+
+def parse_size(size):
+    """
+    Parse a size given as a number of bytes, optionally suffixed with ``K``,
+    ``M`` or ``G`` (powers of 1024). Useful for task arguments, which are
+    always strings. ``None`` is returned unchanged.
+
+    Example::
+    >>> parse_size('8M')
+    8388608
+    """
+    if size is None or isinstance(size, (int, long)):
+        return size
+    size = str(size).strip().upper()
+    if size.endswith('B'):
+        size = size[:-1]
+    multiplier = 1
+    if size and size[-1] in size_suffixes:
+        multiplier = size_suffixes[size[-1]]
+        size = size[:-1]
+    try:
+        return int(float(size) * multiplier)
+    except ValueError:
+        raise ValueError('Invalid size: {0!r}'.format(size))
+
+
+class WorkerPool(object):
+    """
+    A fixed number of worker threads consuming jobs from a bounded queue.
+
+    :meth:`.submit` blocks while the queue is full, so a producer can never
+    get more than ``queuesize`` jobs ahead of the workers. When a job raises
+    an exception, the remaining jobs are skipped, :meth:`.submit` returns
+    ``False``, and :meth:`.join` re-raises the first exception.
+
+    Example::
+
+        pool = WorkerPool(4)
+        for filename in filenames:
+            if not pool.submit(upload, filename):
+                break
+        pool.join()
+    """
+    def __init__(self, workers, queuesize=None):
+        """
+        :param workers: Number of worker threads.
+        :param queuesize:
+            Maximum number of jobs waiting for a worker. Defaults to
+            ``workers``.
+        """
+        self.workers = max(1, int(workers))
+        self.queue = Queue(maxsize=max(1, int(queuesize or self.workers)))
+        self.errors = []
+        self._lock = Lock()
+        self._threads = []
+        self._joined = False
+        for index in xrange(self.workers):
+            thread = Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                if self.errors:
+                    continue
+                func, args, kwargs = job
+                try:
+                    func(*args, **kwargs)
+                except Exception:
+                    with self._lock:
+                        self.errors.append(sys.exc_info())
+            finally:
+                self.queue.task_done()
+
+    def failed(self):
+        """
+        Return ``True`` if any job has raised an exception.
+        """
+        return bool(self.errors)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue ``func(*args, **kwargs)`` for execution by a worker.
+
+        :return: ``False`` if the job was not queued because an earlier job
+            failed, otherwise ``True``.
+        """
+        if self.errors:
+            return False
+        self.queue.put((func, args, kwargs))
+        return True
+
+    def join(self, reraise=True):
+        """
+        Wait for all queued jobs to finish, and stop the worker threads. Safe
+        to call more than once.
+
+        :param reraise:
+            Re-raise the first exception raised by a job? Defaults to ``True``.
+        """
+        if not self._joined:
+            self._joined = True
+            for thread in self._threads:
+                self.queue.put(None)
+            for thread in self._threads:
+                thread.join()
+        if reraise and self.errors:
+            exc_type, exc_value, traceback = self.errors[0]
+            raise exc_type, exc_value, traceback
+
+
+def parallel_map(func, items, workers):
+    """
+    Like the builtin ``map``, but runs ``func`` on the items using a
+    :class:`WorkerPool` with the given number of ``workers``. The results are
+    returned in the same order as ``items``.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    def run(index, item):
+        results[index] = func(item)
+    pool = WorkerPool(min(workers, len(items) or 1))
+    for index, item in enumerate(items):
+        if not pool.submit(run, index, item):
+            break
+    pool.join()
+    return results
+
+
+class LocalCommandResult(object):
+    """
+    The result of a command run by :func:`run_local_commands`.
+    """
+    def __init__(self, label, command, returncode, elapsed, output=None):
+        #: The label for the command.
+        self.label = label
+
+        #: The command.
+        self.command = command
+
+        #: The exit status of the command.
+        self.returncode = returncode
+
+        #: Number of seconds the command used.
+        self.elapsed = elapsed
+
+        #: The output of the command if :func:`run_local_commands` was
+        #: called with ``capture=True``, otherwise ``None``.
+        self.output = output
+
+    def is_ok(self):
+        """
+        Return ``True`` if the command exited with status ``0``.
+        """
+        return self.returncode == 0
+
+
+def run_local_commands(commands, concurrency, output=None, capture=False):
+    """
+    Run shell commands on the local host, with at most ``concurrency``
+    commands running at the same time. The output (stdout and stderr) of the
+    commands is written to ``output`` line by line as it arrives, with each
+    line prefixed by ``[<label>]``.
+
+    :param commands: List of ``(label, command)`` tuples.
+    :param concurrency: Max number of commands to run at the same time.
+    :param output: File-like object to write the output to. Defaults to ``sys.stdout``.
+    :param capture: Also store the output of each command in
+        :obj:`LocalCommandResult.output`?
+    :return:
+        List of :class:`LocalCommandResult` objects (in the same order as
+        ``commands``).
+    """
+    output = output or sys.stdout
+    outputlock = Lock()
+    def run(labelled_command):
+        label, command = labelled_command
+        start = time()
+        process = Popen(command, shell=True, stdout=PIPE, stderr=STDOUT)
+        captured = []
+        for line in iter(process.stdout.readline, ''):
+            if capture:
+                captured.append(line)
+            with outputlock:
+                output.write('[{0}] {1}'.format(label, line))
+                output.flush()
+        returncode = process.wait()
+        return LocalCommandResult(label, command, returncode, time() - start,
+                                  output=capture and ''.join(captured) or None)
+    return parallel_map(run, commands, concurrency)
+
+
+def format_local_command_results(results):
+    """
+    Format the results from :func:`run_local_commands` as a table with one
+    row for each command, and a summary row.
+    """
+    width = max([len('HOST')] + [len(result.label) for result in results])
+    rowformat = '{0:<' + str(width) + '}  {1:<12}  {2:>8}'
+    rows = [rowformat.format('HOST', 'STATUS', 'SECONDS')]
+    for result in results:
+        if result.is_ok():
+            status = 'OK'
+        else:
+            status = 'FAILED ({0})'.format(result.returncode)
+        rows.append(rowformat.format(result.label, status, '{0:.1f}'.format(result.elapsed)))
+    failed = len([result for result in results if not result.is_ok()])
+    rows.append('{ok} succeeded, {failed} failed.'.format(ok=len(results) - failed, failed=failed))
+    return '\n'.join(rows)
+
+
+#: Regular expressions for the numbers we parse from the output of
+#: ``rsync --stats`` in :func:`parse_rsync_stats`.
+RSYNC_STATS_PATTERNS = {
+    'files': r'Number of files: ([\d,]+)',
+    'files_transferred': r'Number of (?:regular )?files transferred: ([\d,]+)',
+    'total_file_size': r'Total file size: ([\d,]+)',
+    'transferred_file_size': r'Total transferred file size: ([\d,]+)',
+    'bytes_sent': r'Total bytes sent: ([\d,]+)',
+    'bytes_received': r'Total bytes received: ([\d,]+)'
+}
+
+def parse_rsync_stats(output):
+    """
+    Parse the numbers from the output of ``rsync --stats``.
+
+    :return:
+        Dict with the keys in :obj:`RSYNC_STATS_PATTERNS` that was found in
+        ``output`` mapped to their (int) value.
+    """
+    stats = {}
+    for key, pattern in RSYNC_STATS_PATTERNS.iteritems():
+        match = re.search(pattern, output)
+        if match:
+            stats[key] = int(match.group(1).replace(',', ''))
+    return stats
+
+def merge_rsync_stats(statslist):
+    """
+    Sum a list of stats dicts from :func:`parse_rsync_stats`.
+    """
+    merged = {}
+    for stats in statslist:
+        for key, value in stats.iteritems():
+            merged[key] = merged.get(key, 0) + value
+    return merged